@@ -8,19 +8,28 @@ from datetime import datetime
 import os
 import sys
 
-def analyze_reviews(json_file):
+# Колонки, которые нужны анализу (из Parquet читаются только они)
+ANALYSIS_COLUMNS = ['branch_name', 'rating', 'is_verified', 'date_created', 'text']
+
+def load_reviews(source):
+    """Отзывы из JSON файла парсера или из Parquet выгрузки (каталог, см. parquet_export.py)"""
+    if os.path.isdir(source):
+        from parquet_export import read_reviews
+        return read_reviews(columns=ANALYSIS_COLUMNS, path=source)
+    
+    with open(source, 'r', encoding='utf-8') as f:
+        return pd.DataFrame(json.load(f))
+
+def analyze_reviews(source):
     """Анализ собранных отзывов"""
     
     # Загружаем данные
-    with open(json_file, 'r', encoding='utf-8') as f:
-        reviews = json.load(f)
+    df = load_reviews(source)
     
-    if not reviews:
+    if df.empty:
         print("Нет данных для анализа")
         return
     
-    df = pd.DataFrame(reviews)
-    
     print("="*60)
     print("📊 АНАЛИЗ ОТЗЫВОВ")
     print("="*60)
@@ -131,6 +140,12 @@ def analyze_reviews(json_file):
 def main():
     """Главная функция"""
     
+    # Явно указанный источник: JSON файл или каталог Parquet выгрузки
+    if len(sys.argv) > 1:
+        print(f"📁 Анализируем: {sys.argv[1]}")
+        analyze_reviews(sys.argv[1])
+        return
+    
     # Ищем последний файл с отзывами
     output_dir = "output"
     json_files = [f for f in os.listdir(output_dir) if f.startswith("reviews_sandyq_tary_") and f.endswith(".json")]
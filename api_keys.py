@@ -0,0 +1,207 @@
+"""
+Пул ключей API 2GIS с суточными квотами.
+
+Ключи задаются в PARSER_API_KEYS через запятую, у каждого можно указать
+свою суточную квоту: "key1,key2:5000" (по умолчанию PARSER_KEY_DAILY_QUOTA).
+PARSER_API_KEY, если задан, входит в пул первым.
+
+Счетчики запросов за сутки (UTC) хранятся в Redis и общие для всех
+процессов. Каждый запрос берет ключ с наименьшей долей израсходованной
+квоты; ключ, на котором 2GIS ответил 403/429, выводится из пула на
+PARSER_KEY_COOLDOWN_SECONDS. Приоритет запроса ограничивает, какую долю
+квоты он может занять: фоновые обходы не съедают остаток, нужный опросу
+новых отзывов.
+
+Без Redis счетчики и паузы ведутся в пределах процесса.
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from cache_manager import CacheManager, get_cache_manager
+
+logger = logging.getLogger(__name__)
+
+KEY_DAILY_QUOTA = int(os.getenv("PARSER_KEY_DAILY_QUOTA", "10000"))
+KEY_COOLDOWN_SECONDS = int(os.getenv("PARSER_KEY_COOLDOWN_SECONDS", "900"))
+# Ответы 2GIS, после которых ключ считается ограниченным
+THROTTLE_STATUSES = (403, 429)
+
+PRIORITY_HIGH = "high"      # опрос новых отзывов, первичный парсинг новых филиалов
+PRIORITY_NORMAL = "normal"  # ежедневный обход
+PRIORITY_LOW = "low"        # полная выгрузка, обновление счетчиков
+# Доля суточной квоты ключа, доступная запросам приоритета
+PRIORITY_SHARE = {
+    PRIORITY_HIGH: 1.0,
+    PRIORITY_NORMAL: 0.9,
+    PRIORITY_LOW: 0.7,
+}
+
+# KEYS: пары (счетчик за сутки, пауза) на ключ; ARGV: доля квоты, TTL счетчика, квоты ключей.
+# Возвращает номер выбранного ключа (с 1) или 0, если подходящих нет
+_ACQUIRE_SCRIPT = """
+local share = tonumber(ARGV[1])
+local best, best_ratio = 0, nil
+for i = 1, #KEYS / 2 do
+    if redis.call('EXISTS', KEYS[2 * i]) == 0 then
+        local quota = tonumber(ARGV[2 + i])
+        local used = tonumber(redis.call('GET', KEYS[2 * i - 1]) or '0')
+        if used < quota * share then
+            local ratio = used / quota
+            if best_ratio == nil or ratio < best_ratio then
+                best, best_ratio = i, ratio
+            end
+        end
+    end
+end
+if best > 0 then
+    redis.call('INCR', KEYS[2 * best - 1])
+    redis.call('EXPIRE', KEYS[2 * best - 1], ARGV[2])
+end
+return best
+"""
+
+
+class ApiQuotaExhausted(Exception):
+    """Все ключи исчерпали доступную приоритету квоту или ограничены 2GIS"""
+
+
+class ApiKey:
+    def __init__(self, value: str, quota: int):
+        self.value = value
+        self.quota = quota
+        # В Redis и логах — хеш, а не сам ключ
+        self.id = hashlib.sha1(value.encode("utf-8")).hexdigest()[:10]
+
+
+def load_api_keys() -> List[ApiKey]:
+    """Ключи из PARSER_API_KEY и PARSER_API_KEYS"""
+    keys: Dict[str, ApiKey] = {}
+    single = os.getenv("PARSER_API_KEY", "").strip()
+    if single:
+        keys[single] = ApiKey(single, KEY_DAILY_QUOTA)
+    for item in os.getenv("PARSER_API_KEYS", "").split(","):
+        value, _, quota = item.strip().partition(":")
+        if value:
+            keys[value] = ApiKey(value, int(quota) if quota else KEY_DAILY_QUOTA)
+    return list(keys.values())
+
+
+class ApiKeyPool:
+    """Выбор ключа под квоты и паузы, общий для процессов через Redis"""
+
+    def __init__(self, keys: List[ApiKey], cache: Optional[CacheManager] = None):
+        self.keys = keys
+        self.cache = cache or get_cache_manager()
+        self._script = None
+        # Локальный fallback без Redis
+        self._lock = threading.Lock()
+        self._local_usage: Dict[str, int] = {}
+        self._local_cooldown: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _usage_key(self, key: ApiKey, day: str) -> str:
+        return self.cache._make_key('apikey', key.id, day)
+
+    def _cooldown_key(self, key: ApiKey) -> str:
+        return self.cache._make_key('apikey', key.id, 'cooldown')
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.utcnow().strftime("%Y%m%d")
+
+    def _acquire_redis(self, share: float) -> Optional[int]:
+        if not self.cache.is_available():
+            return None
+        try:
+            if self._script is None:
+                self._script = self.cache.redis_client.register_script(_ACQUIRE_SCRIPT)
+            day = self._today()
+            redis_keys = []
+            for key in self.keys:
+                redis_keys += [self._usage_key(key, day), self._cooldown_key(key)]
+            args = [share, 2 * 24 * 3600] + [key.quota for key in self.keys]
+            return int(self._script(keys=redis_keys, args=args))
+        except Exception as e:
+            logger.error(f"Ошибка выбора ключа API: {str(e)}")
+            return None
+
+    def _acquire_local(self, share: float) -> int:
+        day = self._today()
+        now = time.monotonic()
+        with self._lock:
+            best, best_ratio = 0, None
+            for index, key in enumerate(self.keys, 1):
+                if self._local_cooldown.get(key.id, 0) > now:
+                    continue
+                used = self._local_usage.get(f"{key.id}:{day}", 0)
+                if used < key.quota * share:
+                    ratio = used / key.quota
+                    if best_ratio is None or ratio < best_ratio:
+                        best, best_ratio = index, ratio
+            if best:
+                usage_key = f"{self.keys[best - 1].id}:{day}"
+                self._local_usage[usage_key] = self._local_usage.get(usage_key, 0) + 1
+            return best
+
+    def acquire(self, priority: str = PRIORITY_NORMAL) -> str:
+        """
+        Ключ для одного запроса (запрос сразу учитывается в квоте)
+
+        Raises:
+            ApiQuotaExhausted: доступной квоты нет ни у одного ключа
+        """
+        share = PRIORITY_SHARE.get(priority, PRIORITY_SHARE[PRIORITY_NORMAL])
+        index = self._acquire_redis(share)
+        if index is None:
+            index = self._acquire_local(share)
+        if not index:
+            raise ApiQuotaExhausted(f"Нет ключей API 2GIS с доступной квотой (приоритет {priority})")
+        return self.keys[index - 1].value
+
+    def mark_throttled(self, value: str):
+        """Вывести ключ из пула на KEY_COOLDOWN_SECONDS"""
+        key = next((key for key in self.keys if key.value == value), None)
+        if key is None:
+            return
+        logger.warning(f"Ключ API {key.id} ограничен 2GIS, пауза {KEY_COOLDOWN_SECONDS} сек")
+        with self._lock:
+            self._local_cooldown[key.id] = time.monotonic() + KEY_COOLDOWN_SECONDS
+        if self.cache.is_available():
+            try:
+                self.cache.redis_client.set(self._cooldown_key(key), 1, ex=KEY_COOLDOWN_SECONDS)
+            except Exception as e:
+                logger.error(f"Ошибка записи паузы ключа API {key.id}: {str(e)}")
+
+    def usage(self) -> List[Dict]:
+        """Расход квот за сегодня (для мониторинга)"""
+        day = self._today()
+        stats = []
+        for key in self.keys:
+            used = self._local_usage.get(f"{key.id}:{day}", 0)
+            cooldown = self._local_cooldown.get(key.id, 0) > time.monotonic()
+            if self.cache.is_available():
+                try:
+                    used = int(self.cache.redis_client.get(self._usage_key(key, day)) or 0)
+                    cooldown = bool(self.cache.redis_client.exists(self._cooldown_key(key)))
+                except Exception as e:
+                    logger.error(f"Ошибка чтения расхода ключа API {key.id}: {str(e)}")
+            stats.append({'key_id': key.id, 'used': used, 'quota': key.quota, 'cooldown': cooldown})
+        return stats
+
+
+_pool: Optional[ApiKeyPool] = None
+
+
+def get_api_key_pool() -> ApiKeyPool:
+    """Пул ключей процесса"""
+    global _pool
+    if _pool is None:
+        _pool = ApiKeyPool(load_api_keys())
+    return _pool
@@ -1,22 +1,37 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, and_
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func, desc, and_, text, tuple_
 from datetime import datetime, timedelta
-from typing import List, Optional
-from pydantic import BaseModel
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, List, Optional
+from pydantic import BaseModel, Field
 import database
-from database import Review, Branch, get_db
+from db_engine import get_pool_metrics
+from database import Review, Branch, BranchSnapshot, get_async_db, branch_pk_for
 from cache_manager import get_cache_manager
-from branches_loader import get_branch_by_iiko_id
+from fast_json import FastJSONResponse, dumps, loads
+from review_timeline import get_review_timeline, TIMELINE_CAP
+from review_events import get_review_event_broker, event_id_key
+from branches_loader import get_branch_by_iiko_id, get_branches_by_iiko_ids, IikoIdsUnavailable
+import asyncio
+import base64
+import csv
+import hashlib
+import io
+import json
 import os
+import zlib
 
 app = FastAPI(
     title="2GIS Reviews API",
     description="API для доступа к отзывам из 2GIS для сети Сандык Тары",
     version="2.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=FastJSONResponse
 )
 
 # CORS middleware
@@ -29,6 +44,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(IikoIdsUnavailable)
+async def iiko_ids_unavailable(request: Request, exc: IikoIdsUnavailable):
+    # Реестр загружен из CSV без id_iiko: 404 выдал бы существующий филиал за отсутствующий
+    return FastJSONResponse({"detail": str(exc)}, status_code=503)
+
 # Pydantic models
 class ReviewResponse(BaseModel):
     review_id: str
@@ -48,6 +68,53 @@ class ReviewResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class ReviewSearchResult(ReviewResponse):
+    rank: float
+    highlight: Optional[str] = None
+
+# Быстрый путь списков отзывов: только нужные колонки кортежами, dict без Pydantic.
+# Порядок колонок совпадает с полями ReviewResponse.
+REVIEW_COLUMNS = (
+    Review.review_id,
+    Branch.branch_id,
+    Branch.branch_name,
+    Review.user_name,
+    Review.rating,
+    Review.text,
+    Review.date_created,
+    Review.date_edited,
+    Review.is_verified,
+    Review.likes_count,
+    Review.comments_count,
+    Review.photos_count,
+    Review.photos_urls,
+)
+REVIEW_FIELDS = tuple(ReviewResponse.model_fields)
+
+class LatestReviewsBatchRequest(BaseModel):
+    branch_ids: List[str] = Field(default_factory=list, max_length=500)
+    iiko_ids: List[str] = Field(default_factory=list, max_length=500)
+    count: int = Field(10, ge=1, le=1000)
+
+class BranchLatestReviews(BaseModel):
+    branch_id: str
+    id_iiko: Optional[str] = None
+    reviews: List[ReviewResponse]
+
+class LatestReviewsBatchResponse(BaseModel):
+    results: List[BranchLatestReviews]
+    not_found: List[str]
+
+class ReviewChange(BaseModel):
+    change: str
+    updated_at: datetime
+    review: ReviewResponse
+
+class ChangeFeedResponse(BaseModel):
+    changes: List[ReviewChange]
+    next_cursor: Optional[str]
+    has_more: bool
+
 class BranchResponse(BaseModel):
     branch_id: str
     branch_name: str
@@ -68,6 +135,17 @@ class BranchStats(BaseModel):
     verified_count: int
     last_review_date: Optional[datetime]
 
+class RatingPoint(BaseModel):
+    captured_at: datetime
+    rating: Optional[float]
+    reviews_count: Optional[int]
+
+class RatingHistoryResponse(BaseModel):
+    branch_id: str
+    branch_name: str
+    interval: str
+    points: List[RatingPoint]
+
 class ReviewsStats(BaseModel):
     total_reviews: int
     average_rating: float
@@ -75,6 +153,327 @@ class ReviewsStats(BaseModel):
     rating_distribution: dict
     reviews_by_month: dict
 
+def _search_tsquery(search: str):
+    """tsquery из пользовательского ввода (синтаксис веб-поиска: фразы в кавычках, -исключение, or)"""
+    return func.websearch_to_tsquery(database.SEARCH_CONFIG, search)
+
+def _escape_like(value: str) -> str:
+    """Экранирование спецсимволов LIKE в пользовательском вводе"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _apply_search_filter(query, search: str, search_mode: str):
+    """Фильтр поиска: полнотекстовый (GIN по search_vector) или по подстроке (pg_trgm)"""
+    if search_mode == "substring":
+        return query.where(Review.text.ilike(f"%{_escape_like(search)}%", escape="\\"))
+    return query.where(Review.search_vector.op("@@")(_search_tsquery(search)))
+
+def _review_select(*extra_columns):
+    """SELECT колонок ReviewResponse (филиал через JOIN по целочисленному ключу)"""
+    return select(*REVIEW_COLUMNS, *extra_columns).join(Branch, Review.branch_pk == Branch.id)
+
+# Отзывы, которые 2GIS больше не показывает (review_changes.py), в списки не попадают;
+# лента изменений и /reviews/{review_id} их отдают
+VISIBLE_REVIEW = and_(Review.removed_at.is_(None), Review.hidden_reason.is_(None))
+
+def _review_dict(row) -> dict:
+    """Строка быстрого пути -> dict по схеме ReviewResponse"""
+    review = dict(zip(REVIEW_FIELDS, row))
+    if review["photos_urls"] is None:
+        review["photos_urls"] = []
+    return review
+
+def _json_list(items: List[dict], response: Optional[Response] = None) -> FastJSONResponse:
+    """Готовый ответ без повторной валидации; заголовки из response (ETag и т.п.) сохраняются"""
+    headers = dict(response.headers) if response is not None else None
+    return FastJSONResponse(items, headers=headers)
+
+def _apply_review_filters(
+    query,
+    branch_id: Optional[str] = None,
+    rating: Optional[int] = None,
+    verified_only: bool = False,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    search: Optional[str] = None,
+    search_mode: str = "fulltext"
+):
+    """Общие фильтры списка отзывов (/reviews и выгрузка)"""
+    query = query.where(VISIBLE_REVIEW)
+    
+    if branch_id:
+        query = query.where(Review.branch_pk == branch_pk_for(branch_id))
+    
+    if rating:
+        query = query.where(Review.rating == rating)
+    
+    if verified_only:
+        query = query.where(Review.is_verified == True)
+    
+    if date_from:
+        query = query.where(Review.date_created >= date_from)
+    
+    if date_to:
+        query = query.where(Review.date_created <= date_to)
+    
+    if search:
+        query = _apply_search_filter(query, search, search_mode)
+    
+    return query
+
+def _json_payloads(payloads: List[str], response: Optional[Response] = None) -> Response:
+    """Ответ из готовых JSON-строк ленты Redis — без разбора и повторной сериализации"""
+    headers = dict(response.headers) if response is not None else None
+    return Response("[" + ",".join(payloads) + "]", media_type="application/json", headers=headers)
+
+async def _count(db: AsyncSession, *criteria, entity=Review) -> int:
+    """SELECT count(*) с фильтрами"""
+    query = select(func.count()).select_from(entity)
+    if criteria:
+        query = query.where(*criteria)
+    return (await db.execute(query)).scalar_one()
+
+async def _get_branch_pk(db: AsyncSession, branch_id: str) -> Optional[int]:
+    """Суррогатный ключ филиала по ID 2GIS (None, если филиала нет)"""
+    return (await db.execute(
+        select(Branch.id).where(Branch.branch_id == branch_id)
+    )).scalar()
+
+# Окно свежих месячных партиций для "последних N отзывов"
+LATEST_REVIEWS_WINDOW_DAYS = 180
+
+def _latest_reviews_query(branch_pk, count: int, since: Optional[datetime] = None):
+    """Последние count видимых отзывов филиала (since — только партиции с этой даты)"""
+    query = _review_select().where(Review.branch_pk == branch_pk, VISIBLE_REVIEW)
+    if since is not None:
+        query = query.where(Review.date_created >= since)
+    return query.order_by(desc(Review.date_created)).limit(count)
+
+async def _latest_reviews(db: AsyncSession, branch_pk: int, count: int) -> List[dict]:
+    """
+    Последние отзывы филиала, отсортированные по дате (от новых к старым).
+    Сначала читаются только партиции последних месяцев; вся история —
+    лишь если у филиала в этом окне меньше count отзывов.
+    """
+    since = datetime.utcnow() - timedelta(days=LATEST_REVIEWS_WINDOW_DAYS)
+    rows = (await db.execute(_latest_reviews_query(branch_pk, count, since))).all()
+    if len(rows) < count:
+        rows = (await db.execute(_latest_reviews_query(branch_pk, count))).all()
+    return [_review_dict(row) for row in rows]
+
+# Сколько секунд клиент может не перепроверять ответ (данные меняются раз в сутки)
+RESPONSE_MAX_AGE = int(os.getenv("API_RESPONSE_MAX_AGE", "60"))
+
+def _client_has_current(request: Request, etag: str, modified: float) -> bool:
+    """Проверка If-None-Match (приоритетнее) или If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Слабое сравнение: W/ не учитывается
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _conditional_response(
+    request: Request,
+    response: Response,
+    branch_id: Optional[str] = None,
+    variant: str = ""
+) -> Optional[Response]:
+    """
+    ETag, Last-Modified и Cache-Control по версии данных из Redis (ее повышает ingest).
+    Возвращает 304, если у клиента актуальная версия — до обращения к Postgres.
+    variant — то, от чего ответ зависит помимо данных (например, текущий месяц).
+    Без Redis заголовки не ставятся и ответ формируется как обычно.
+    """
+    version = get_cache_manager().get_data_version(branch_id)
+    if version is None:
+        return None
+
+    raw = f"{app.version}:{version['scope']}:{version['version']}:{version['modified']}:{variant}"
+    etag = f'W/"{hashlib.md5(raw.encode()).hexdigest()}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(version['modified'], usegmt=True),
+        "Cache-Control": f"public, max-age={RESPONSE_MAX_AGE}",
+    }
+
+    if _client_has_current(request, etag, version['modified']):
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return None
+
+# Выгрузка: строк за одно чтение из серверного курсора и лимит времени ее транзакции
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_STATEMENT_TIMEOUT_MS = int(os.getenv("API_EXPORT_STATEMENT_TIMEOUT_MS", "600000"))
+
+def _csv_lines(rows) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+def _csv_row(row) -> list:
+    """Строка быстрого пути -> значения CSV (photos_urls — последняя колонка, URL через пробел)"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in row[:-1]]
+    values.append(" ".join(row[-1] or []))
+    return values
+
+async def _export_chunks(query, export_format: str, compress: bool):
+    """
+    Тело выгрузки порциями: серверный курсор -> NDJSON/CSV -> gzip на лету.
+    В памяти одновременно не больше EXPORT_CHUNK_SIZE строк.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    
+    def encode(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor else data
+    
+    if export_format == "csv":
+        yield encode(_csv_lines([REVIEW_FIELDS]))
+    
+    # Своя сессия: сессия зависимости get_async_db закрывается раньше, чем закончится стриминг
+    async with database.get_async_session_factory("api")() as db:
+        await db.execute(text(f"SET LOCAL statement_timeout = {EXPORT_STATEMENT_TIMEOUT_MS}"))
+        result = await db.stream(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        async for rows in result.partitions():
+            if export_format == "csv":
+                data = _csv_lines(_csv_row(row) for row in rows)
+            else:
+                data = b"".join(dumps(_review_dict(row)) + b"\n" for row in rows)
+            chunk = encode(data)
+            if chunk:
+                yield chunk
+    
+    if compressor:
+        yield compressor.flush()
+
+def _latest_reviews_batch_query(branch_pks: List[int], count: int, since: Optional[datetime] = None):
+    """
+    Последние count видимых отзывов каждого филиала одним запросом:
+    ROW_NUMBER() OVER (PARTITION BY branch_pk ORDER BY date_created DESC)
+    """
+    position = func.row_number().over(
+        partition_by=Review.branch_pk,
+        order_by=(desc(Review.date_created), desc(Review.id))
+    ).label("position")
+    query = _review_select(Review.branch_pk.label("branch_pk"), position).where(
+        Review.branch_pk.in_(branch_pks), VISIBLE_REVIEW
+    )
+    if since is not None:
+        query = query.where(Review.date_created >= since)
+    ranked = query.subquery()
+    return select(ranked).where(ranked.c.position <= count).order_by(ranked.c.branch_pk, ranked.c.position)
+
+async def _latest_reviews_batch(db: AsyncSession, branch_pks: List[int], count: int) -> Dict[int, List[dict]]:
+    """
+    Последние count отзывов каждого филиала (_latest_reviews_batch_query).
+    Как и _latest_reviews, сначала читаются только свежие партиции.
+    """
+    reviews_by_pk: Dict[int, List[dict]] = {pk: [] for pk in branch_pks}
+    since = datetime.utcnow() - timedelta(days=LATEST_REVIEWS_WINDOW_DAYS)
+    for row in (await db.execute(_latest_reviews_batch_query(branch_pks, count, since))).all():
+        reviews_by_pk[row.branch_pk].append(_review_dict(row))
+    
+    # Филиалам, у которых в окне меньше count отзывов, — вся история
+    short = [pk for pk, reviews in reviews_by_pk.items() if len(reviews) < count]
+    if short:
+        for pk in short:
+            reviews_by_pk[pk] = []
+        for row in (await db.execute(_latest_reviews_batch_query(short, count))).all():
+            reviews_by_pk[row.branch_pk].append(_review_dict(row))
+    
+    return reviews_by_pk
+
+async def _latest_reviews_with_timeline(db: AsyncSession, branch_pk: int, branch_id: str, count: int) -> List[dict]:
+    """
+    Последние отзывы из Postgres, когда ленты Redis нет.
+    Читается сразу TIMELINE_CAP отзывов, чтобы заполнить ленту: следующие
+    запросы к филиалу пойдут мимо базы.
+    """
+    timeline = get_review_timeline()
+    if not timeline.is_available():
+        return await _latest_reviews(db, branch_pk, count)
+    
+    reviews = await _latest_reviews(db, branch_pk, TIMELINE_CAP)
+    timeline.rebuild(branch_id, reviews)
+    return reviews[:count]
+
+# Изменения последних секунд лента не отдает: транзакция с более ранним
+# updated_at может зафиксироваться уже после того, как клиент прошел курсор
+CHANGE_FEED_LAG = timedelta(seconds=int(os.getenv("API_CHANGE_FEED_LAG_SECONDS", "60")))
+
+def _change_kind(row) -> str:
+    """Отметка ленты изменений: отзыв удален из 2GIS, скрыт модерацией или добавлен/изменен"""
+    if row.removed_at is not None:
+        return "removed"
+    if row.hidden_reason:
+        return "hidden"
+    return "upsert"
+
+def _encode_cursor(updated_at: datetime, review_pk: int) -> str:
+    raw = json.dumps({"u": updated_at.isoformat(), "i": review_pk}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    """Курсор ленты -> (updated_at, id); HTTP 400 для испорченного курсора"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return datetime.fromisoformat(data["u"]), int(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# Комментарий-пинг в SSE, чтобы прокси не закрывали простаивающее соединение
+SSE_KEEPALIVE_SECONDS = 15
+
+def _sse_message(event: dict) -> str:
+    return f"id: {event['id']}\nevent: review\ndata: {event['payload']}\n\n"
+
+async def _review_event_stream(request: Request, branch_id: Optional[str], last_event_id: Optional[str]):
+    """
+    SSE: сначала пропущенные события после Last-Event-ID (из Redis Stream),
+    затем новые из pub/sub. Replay начинается после подтверждения подписки
+    Redis, поэтому события между ними не теряются; повторы отсекаются по ID.
+    """
+    broker = get_review_event_broker()
+    subscription = await broker.subscribe()
+    try:
+        yield f"retry: {SSE_KEEPALIVE_SECONDS * 1000}\n\n"
+        
+        replayed_until = None
+        if last_event_id:
+            for event in await broker.replay(last_event_id):
+                replayed_until = event["id"]
+                if branch_id is None or event["branch_id"] == branch_id:
+                    yield _sse_message(event)
+        
+        while not subscription.overflowed:
+            if await request.is_disconnected():
+                break
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if replayed_until and event_id_key(event["id"]) <= event_id_key(replayed_until):
+                continue
+            if branch_id is None or event["branch_id"] == branch_id:
+                yield _sse_message(event)
+        # Переполнение очереди: соединение закрывается, клиент переподключится с Last-Event-ID
+    finally:
+        broker.unsubscribe(subscription)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await get_review_event_broker().stop()
+    await database.dispose_async_engine()
+
 @app.get("/", tags=["General"])
 async def root():
     """Root endpoint with API information"""
@@ -84,6 +483,10 @@ async def root():
         "description": "API для доступа к отзывам из 2GIS",
         "endpoints": {
             "reviews": "/api/v1/reviews",
+            "search": "/api/v1/reviews/search",
+            "export": "/api/v1/reviews/export",
+            "changes": "/api/v1/changes",
+            "stream": "/api/v1/reviews/stream",
             "branches": "/api/v1/branches",
             "stats": "/api/v1/stats",
             "docs": "/docs"
@@ -91,14 +494,13 @@ async def root():
     }
 
 @app.get("/health", tags=["General"])
-async def health_check(db: Session = Depends(get_db)):
+async def health_check(db: AsyncSession = Depends(get_async_db)):
     """Health check endpoint"""
     try:
         # Test database connection
-        from sqlalchemy import text
-        db.execute(text("SELECT 1"))
-        reviews_count = db.query(Review).count()
-        branches_count = db.query(Branch).count()
+        await db.execute(text("SELECT 1"))
+        reviews_count = await _count(db)
+        branches_count = await _count(db, entity=Branch)
         
         # Test cache connection
         cache = get_cache_manager()
@@ -110,6 +512,7 @@ async def health_check(db: Session = Depends(get_db)):
             "cache": cache_status,
             "reviews_count": reviews_count,
             "branches_count": branches_count,
+            "db_pool": get_pool_metrics("api"),
             "timestamp": datetime.utcnow()
         }
     except Exception as e:
@@ -121,6 +524,11 @@ async def get_cache_stats():
     cache = get_cache_manager()
     return cache.get_cache_stats()
 
+@app.get("/api/v1/db/pool", tags=["General"])
+async def get_db_pool_stats():
+    """Database pool metrics: checkout wait time and utilisation per profile"""
+    return get_pool_metrics()
+
 @app.post("/api/v1/cache/clear", tags=["Cache"])
 async def clear_cache():
     """Clear all cache"""
@@ -135,23 +543,9 @@ async def clear_branch_cache(branch_id: str):
     cache.invalidate_branch_cache(branch_id)
     return {"message": f"Cache cleared for branch {branch_id}"}
 
-@app.get("/api/v1/branches", response_model=List[BranchResponse], tags=["Branches"])
-async def get_branches(
-    db: Session = Depends(get_db),
-    city: Optional[str] = None,
-    skip: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=1000)
-):
-    """Get list of all branches with statistics"""
-    cache = get_cache_manager()
-    
-    # Пробуем получить из кэша
-    if not city and skip == 0 and limit == 100:
-        cached_branches = cache.get_branches_list_cache()
-        if cached_branches:
-            return cached_branches
-    
-    query = db.query(
+def _branches_query(city: Optional[str] = None):
+    """Филиалы с числом отзывов и средней оценкой"""
+    query = select(
         Branch.branch_id,
         Branch.branch_name,
         Branch.city,
@@ -159,8 +553,9 @@ async def get_branches(
         func.count(Review.id).label("total_reviews"),
         func.coalesce(func.avg(Review.rating), 0).label("average_rating")
     ).outerjoin(
-        Review, Branch.branch_id == Review.branch_id
+        Review, Review.branch_pk == Branch.id
     ).group_by(
+        Branch.id,
         Branch.branch_id,
         Branch.branch_name,
         Branch.city,
@@ -168,9 +563,32 @@ async def get_branches(
     )
     
     if city:
-        query = query.filter(Branch.city.ilike(f"%{city}%"))
+        query = query.where(Branch.city.ilike(f"%{city}%"))
+    return query
+
+@app.get("/api/v1/branches", response_model=List[BranchResponse], tags=["Branches"])
+async def get_branches(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    city: Optional[str] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """Get list of all branches with statistics"""
+    not_modified = _conditional_response(request, response)
+    if not_modified is not None:
+        return not_modified
+    
+    cache = get_cache_manager()
+    
+    # Пробуем получить из кэша
+    if not city and skip == 0 and limit == 100:
+        cached_branches = cache.get_branches_list_cache()
+        if cached_branches:
+            return cached_branches
     
-    branches = query.offset(skip).limit(limit).all()
+    branches = (await db.execute(_branches_query(city).offset(skip).limit(limit))).all()
     
     result = [
         BranchResponse(
@@ -191,15 +609,25 @@ async def get_branches(
     return result
 
 @app.get("/api/v1/branches/{branch_id}/stats", response_model=BranchStats, tags=["Branches"])
-async def get_branch_stats(branch_id: str, db: Session = Depends(get_db)):
+async def get_branch_stats(branch_id: str, db: AsyncSession = Depends(get_async_db)):
     """Get detailed statistics for a specific branch"""
-    branch = db.query(Branch).filter(Branch.branch_id == branch_id).first()
+    branch = (await db.execute(
+        select(Branch).where(Branch.branch_id == branch_id)
+    )).scalars().first()
     if not branch:
         raise HTTPException(status_code=404, detail="Branch not found")
     
-    reviews = db.query(Review).filter(Review.branch_id == branch_id).all()
+    # Агрегаты считаются в Postgres, отзывы целиком не загружаются
+    totals = (await db.execute(
+        select(
+            func.count(Review.id).label("total_reviews"),
+            func.avg(func.nullif(Review.rating, 0)).label("average_rating"),
+            func.count(Review.id).filter(Review.is_verified == True).label("verified_count"),
+            func.max(Review.date_created).label("last_review_date")
+        ).where(Review.branch_pk == branch.id)
+    )).one()
     
-    if not reviews:
+    if not totals.total_reviews:
         return BranchStats(
             branch_id=branch.branch_id,
             branch_name=branch.branch_name,
@@ -211,104 +639,274 @@ async def get_branch_stats(branch_id: str, db: Session = Depends(get_db)):
         )
     
     # Calculate rating distribution
-    rating_dist = {}
-    for i in range(1, 6):
-        count = len([r for r in reviews if r.rating and int(r.rating) == i])
-        rating_dist[str(i)] = count
+    rating_bucket = func.floor(Review.rating)
+    buckets = dict((await db.execute(
+        select(rating_bucket, func.count())
+        .where(Review.branch_pk == branch.id, Review.rating > 0)
+        .group_by(rating_bucket)
+    )).all())
+    rating_dist = {str(i): buckets.get(i, 0) for i in range(1, 6)}
     
-    # Calculate average rating
-    ratings = [r.rating for r in reviews if r.rating]
-    avg_rating = sum(ratings) / len(ratings) if ratings else 0
-    
-    # Count verified reviews
-    verified = len([r for r in reviews if r.is_verified])
-    
-    # Get last review date
-    last_review = max(reviews, key=lambda r: r.date_created) if reviews else None
+    avg_rating = float(totals.average_rating) if totals.average_rating else 0
     
     return BranchStats(
         branch_id=branch.branch_id,
         branch_name=branch.branch_name,
-        total_reviews=len(reviews),
+        total_reviews=totals.total_reviews,
         average_rating=round(avg_rating, 2),
         rating_distribution=rating_dist,
-        verified_count=verified,
-        last_review_date=last_review.date_created if last_review else None
+        verified_count=totals.verified_count,
+        last_review_date=totals.last_review_date
+    )
+
+@app.get("/api/v1/branches/{branch_id}/rating-history", response_model=RatingHistoryResponse, tags=["Branches"])
+async def get_branch_rating_history(
+    branch_id: str,
+    db: AsyncSession = Depends(get_async_db),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    interval: str = Query("day", regex="^(raw|day|week|month)$")
+):
+    """
+    Official 2GIS rating and review count of a branch over time, from the snapshots
+    taken on every crawl. interval=raw returns every snapshot; day/week/month return
+    the last snapshot of each period. Defaults to the last 365 days.
+    """
+    branch = (await db.execute(
+        select(Branch.id, Branch.branch_id, Branch.branch_name).where(Branch.branch_id == branch_id)
+    )).first()
+    if not branch:
+        raise HTTPException(status_code=404, detail="Branch not found")
+    
+    conditions = [
+        BranchSnapshot.branch_pk == branch.id,
+        BranchSnapshot.captured_at >= (date_from or datetime.utcnow() - timedelta(days=365))
+    ]
+    if date_to:
+        conditions.append(BranchSnapshot.captured_at <= date_to)
+    
+    if interval == "raw":
+        query = select(
+            BranchSnapshot.captured_at, BranchSnapshot.rating, BranchSnapshot.reviews_count
+        ).order_by(BranchSnapshot.captured_at)
+    else:
+        # Последний снимок периода (DISTINCT ON по индексу (branch_pk, captured_at))
+        period = func.date_trunc(interval, BranchSnapshot.captured_at)
+        query = select(
+            BranchSnapshot.captured_at, BranchSnapshot.rating, BranchSnapshot.reviews_count
+        ).distinct(period).order_by(period, desc(BranchSnapshot.captured_at))
+    rows = (await db.execute(query.where(*conditions))).all()
+    
+    return FastJSONResponse({
+        "branch_id": branch.branch_id,
+        "branch_name": branch.branch_name,
+        "interval": interval,
+        "points": [
+            {"captured_at": row.captured_at, "rating": row.rating, "reviews_count": row.reviews_count}
+            for row in rows
+        ],
+    })
+
+def _reviews_list_query(
+    branch_id: Optional[str] = None,
+    rating: Optional[int] = None,
+    verified_only: bool = False,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    search: Optional[str] = None,
+    search_mode: str = "fulltext",
+    sort_by: str = "date_created",
+    order: str = "desc"
+):
+    """Список отзывов /reviews с фильтрами и сортировкой (relevance — только с полнотекстовым поиском)"""
+    query = _apply_review_filters(
+        _review_select(), branch_id, rating, verified_only, date_from, date_to, search, search_mode
     )
+    if sort_by == "relevance":
+        sort_column = func.ts_rank_cd(Review.search_vector, _search_tsquery(search))
+    else:
+        sort_column = getattr(Review, sort_by)
+    return query.order_by(desc(sort_column) if order == "desc" else sort_column)
 
 @app.get("/api/v1/reviews", response_model=List[ReviewResponse], tags=["Reviews"])
 async def get_reviews(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     branch_id: Optional[str] = None,
     rating: Optional[int] = Query(None, ge=1, le=5),
     verified_only: bool = False,
     date_from: Optional[datetime] = None,
     date_to: Optional[datetime] = None,
     search: Optional[str] = None,
-    sort_by: str = Query("date_created", regex="^(date_created|rating|likes_count)$"),
+    search_mode: str = Query("fulltext", regex="^(fulltext|substring)$"),
+    sort_by: str = Query("date_created", regex="^(date_created|rating|likes_count|relevance)$"),
     order: str = Query("desc", regex="^(asc|desc)$"),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000)
 ):
     """Get reviews with filtering and pagination"""
-    query = db.query(Review)
+    if sort_by == "relevance" and (not search or search_mode != "fulltext"):
+        raise HTTPException(status_code=400, detail="sort_by=relevance requires a fulltext search")
+    query = _reviews_list_query(
+        branch_id, rating, verified_only, date_from, date_to, search, search_mode, sort_by, order
+    )
+    
+    # Apply pagination
+    rows = (await db.execute(query.offset(skip).limit(limit))).all()
+    
+    return _json_list([_review_dict(row) for row in rows])
+
+def _export_query(
+    branch_id: Optional[str] = None,
+    rating: Optional[int] = None,
+    verified_only: bool = False,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    search: Optional[str] = None,
+    search_mode: str = "fulltext"
+):
+    """Выгрузка: те же фильтры, порядок по (date_created, id)"""
+    return _apply_review_filters(
+        _review_select(), branch_id, rating, verified_only, date_from, date_to, search, search_mode
+    ).order_by(Review.date_created, Review.id)
+
+@app.get("/api/v1/reviews/export", tags=["Reviews"])
+async def export_reviews(
+    export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+    compress: bool = True,
+    branch_id: Optional[str] = None,
+    rating: Optional[int] = Query(None, ge=1, le=5),
+    verified_only: bool = False,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    search: Optional[str] = None,
+    search_mode: str = Query("fulltext", regex="^(fulltext|substring)$")
+):
+    """Stream all reviews matching the filters as NDJSON or CSV (gzip by default) in constant memory"""
+    query = _export_query(branch_id, rating, verified_only, date_from, date_to, search, search_mode)
+    
+    filename = f"reviews_{datetime.utcnow():%Y%m%d_%H%M%S}.{export_format}"
+    if compress:
+        filename += ".gz"
+        media_type = "application/gzip"
+    elif export_format == "csv":
+        media_type = "text/csv; charset=utf-8"
+    else:
+        media_type = "application/x-ndjson"
+    
+    return StreamingResponse(
+        _export_chunks(query, export_format, compress),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/api/v1/reviews/stream", tags=["Reviews"])
+async def stream_reviews(
+    request: Request,
+    branch_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """Server-sent events with newly ingested reviews; reconnect with Last-Event-ID to catch up"""
+    if last_event_id:
+        try:
+            event_id_key(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    
+    return StreamingResponse(
+        _review_event_stream(request, branch_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _search_query(
+    q: str,
+    branch_id: Optional[str] = None,
+    rating: Optional[int] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    highlight: bool = True
+):
+    """Полнотекстовый поиск: ранг, фрагменты с подсветкой, порядок по релевантности"""
+    tsquery = _search_tsquery(q)
+    rank = func.ts_rank_cd(Review.search_vector, tsquery).label("rank")
+    columns = [rank]
+    if highlight:
+        columns.append(func.ts_headline(
+            database.SEARCH_CONFIG,
+            func.coalesce(Review.text, ""),
+            tsquery,
+            "StartSel=<b>, StopSel=</b>, MaxFragments=2, MinWords=5, MaxWords=25"
+        ).label("highlight"))
+    
+    query = _review_select(*columns).where(Review.search_vector.op("@@")(tsquery), VISIBLE_REVIEW)
     
-    # Apply filters
     if branch_id:
-        query = query.filter(Review.branch_id == branch_id)
+        query = query.where(Review.branch_pk == branch_pk_for(branch_id))
     
     if rating:
-        query = query.filter(Review.rating == rating)
-    
-    if verified_only:
-        query = query.filter(Review.is_verified == True)
+        query = query.where(Review.rating == rating)
     
     if date_from:
-        query = query.filter(Review.date_created >= date_from)
+        query = query.where(Review.date_created >= date_from)
     
     if date_to:
-        query = query.filter(Review.date_created <= date_to)
-    
-    if search:
-        query = query.filter(
-            func.lower(Review.text).contains(func.lower(search))
-        )
-    
-    # Apply sorting
-    sort_column = getattr(Review, sort_by)
-    if order == "desc":
-        query = query.order_by(desc(sort_column))
-    else:
-        query = query.order_by(sort_column)
+        query = query.where(Review.date_created <= date_to)
     
-    # Apply pagination
-    reviews = query.offset(skip).limit(limit).all()
+    return query.order_by(desc(rank), desc(Review.date_created))
+
+@app.get("/api/v1/reviews/search", response_model=List[ReviewSearchResult], tags=["Reviews"])
+async def search_reviews(
+    q: str = Query(..., min_length=1, max_length=200),
+    db: AsyncSession = Depends(get_async_db),
+    branch_id: Optional[str] = None,
+    rating: Optional[int] = Query(None, ge=1, le=5),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    highlight: bool = True,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """Full-text search over review texts with relevance ranking and highlighted fragments"""
+    query = _search_query(q, branch_id, rating, date_from, date_to, highlight)
+    rows = (await db.execute(query.offset(skip).limit(limit))).all()
     
-    return reviews
+    results = []
+    for row in rows:
+        review = _review_dict(row)
+        review["rank"] = round(row.rank, 6)
+        review["highlight"] = row.highlight if highlight else None
+        results.append(review)
+    return _json_list(results)
 
 @app.get("/api/v1/reviews/{review_id}", response_model=ReviewResponse, tags=["Reviews"])
-async def get_review(review_id: str, db: Session = Depends(get_db)):
+async def get_review(review_id: str, db: AsyncSession = Depends(get_async_db)):
     """Get a specific review by ID"""
-    review = db.query(Review).filter(Review.review_id == review_id).first()
+    review = (await db.execute(
+        select(Review).where(Review.review_id == review_id)
+    )).scalars().first()
     if not review:
         raise HTTPException(status_code=404, detail="Review not found")
     return review
 
 @app.get("/api/v1/stats", response_model=ReviewsStats, tags=["Statistics"])
-async def get_overall_stats(db: Session = Depends(get_db)):
+async def get_overall_stats(request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
     """Get overall statistics for all reviews"""
-    total_reviews = db.query(Review).count()
-    total_branches = db.query(Branch).count()
+    # reviews_by_month считается от текущей даты — ответ меняется и со сменой месяца
+    not_modified = _conditional_response(request, response, variant=datetime.utcnow().strftime("%Y-%m"))
+    if not_modified is not None:
+        return not_modified
+    
+    total_reviews = await _count(db)
+    total_branches = await _count(db, entity=Branch)
     
     # Calculate average rating
-    avg_rating_result = db.query(func.avg(Review.rating)).scalar()
+    avg_rating_result = (await db.execute(select(func.avg(Review.rating)))).scalar()
     avg_rating = float(avg_rating_result) if avg_rating_result else 0
     
     # Rating distribution
     rating_dist = {}
     for i in range(1, 6):
-        count = db.query(Review).filter(Review.rating == i).count()
-        rating_dist[str(i)] = count
+        rating_dist[str(i)] = await _count(db, Review.rating == i)
     
     # Reviews by month (last 12 months)
     reviews_by_month = {}
@@ -323,14 +921,13 @@ async def get_overall_stats(db: Session = Depends(get_db)):
         else:
             end_date = start_date.replace(month=start_date.month + 1)
         
-        count = db.query(Review).filter(
+        reviews_by_month[month_key] = await _count(
+            db,
             and_(
                 Review.date_created >= start_date,
                 Review.date_created < end_date
             )
-        ).count()
-        
-        reviews_by_month[month_key] = count
+        )
     
     return ReviewsStats(
         total_reviews=total_reviews,
@@ -342,15 +939,15 @@ async def get_overall_stats(db: Session = Depends(get_db)):
 
 @app.get("/api/v1/stats/recent", tags=["Statistics"])
 async def get_recent_activity(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     days: int = Query(7, ge=1, le=90)
 ):
     """Get recent review activity"""
     cutoff_date = datetime.utcnow() - timedelta(days=days)
     
-    recent_reviews = db.query(Review).filter(
-        Review.date_created >= cutoff_date
-    ).all()
+    recent_reviews = (await db.execute(
+        select(Review.date_created, Review.rating).where(Review.date_created >= cutoff_date)
+    )).all()
     
     # Group by date
     reviews_by_date = {}
@@ -380,42 +977,149 @@ async def get_recent_activity(
         "reviews_by_date": reviews_by_date
     }
 
+@app.post("/api/v1/reviews/latest/batch", response_model=LatestReviewsBatchResponse, tags=["Reviews"])
+async def get_latest_reviews_batch(
+    batch: LatestReviewsBatchRequest,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Get latest reviews for many branches (2GIS or iiko IDs) in one request"""
+    not_found: List[str] = []
+    
+    # iiko ID -> ID 2GIS одним проходом по реестру филиалов
+    iiko_by_branch: Dict[str, str] = {}
+    if batch.iiko_ids:
+        registry = await run_in_threadpool(get_branches_by_iiko_ids, batch.iiko_ids)
+        for id_iiko in batch.iiko_ids:
+            branch_id = (registry.get(id_iiko) or {}).get('id_2gis')
+            if branch_id:
+                iiko_by_branch.setdefault(branch_id, id_iiko)
+            else:
+                not_found.append(id_iiko)
+    
+    branch_ids = list(dict.fromkeys([*batch.branch_ids, *iiko_by_branch]))
+    
+    # Лента Redis (как у запроса одного филиала), филиалы без ленты — одним оконным запросом
+    timeline = get_review_timeline()
+    reviews_by_branch = {
+        branch_id: [loads(payload) for payload in payloads]
+        for branch_id, payloads in timeline.latest_many(branch_ids, batch.count).items()
+    }
+    missing = [branch_id for branch_id in branch_ids if branch_id not in reviews_by_branch]
+    if missing:
+        pk_rows = (await db.execute(
+            select(Branch.id, Branch.branch_id).where(Branch.branch_id.in_(missing))
+        )).all()
+        branch_id_by_pk = {row.id: row.branch_id for row in pk_rows}
+        
+        if branch_id_by_pk:
+            # Читается сразу TIMELINE_CAP отзывов, чтобы заполнить ленты
+            rebuild = batch.count <= TIMELINE_CAP and timeline.is_available()
+            loaded = await _latest_reviews_batch(
+                db, list(branch_id_by_pk), TIMELINE_CAP if rebuild else batch.count
+            )
+            for pk, reviews in loaded.items():
+                if rebuild:
+                    timeline.rebuild(branch_id_by_pk[pk], reviews)
+                reviews_by_branch[branch_id_by_pk[pk]] = reviews[:batch.count]
+    
+    results = []
+    for branch_id in branch_ids:
+        if branch_id not in reviews_by_branch:
+            not_found.append(iiko_by_branch.get(branch_id, branch_id))
+            continue
+        results.append({
+            "branch_id": branch_id,
+            "id_iiko": iiko_by_branch.get(branch_id),
+            "reviews": reviews_by_branch[branch_id],
+        })
+    
+    return FastJSONResponse({"results": results, "not_found": not_found})
+
+def _change_feed_query(after: Optional[tuple] = None, branch_id: Optional[str] = None):
+    """Лента изменений: строки после (updated_at, id) по ключу keyset, без последних CHANGE_FEED_LAG"""
+    query = _review_select(
+        Review.updated_at.label("changed_at"),
+        Review.id.label("change_pk"),
+        Review.removed_at,
+        Review.hidden_reason
+    ).where(
+        Review.updated_at < datetime.utcnow() - CHANGE_FEED_LAG
+    )
+    if after:
+        query = query.where(tuple_(Review.updated_at, Review.id) > tuple_(*after))
+    if branch_id:
+        query = query.where(Review.branch_pk == branch_pk_for(branch_id))
+    return query.order_by(Review.updated_at, Review.id)
+
+@app.get("/api/v1/changes", response_model=ChangeFeedResponse, tags=["Reviews"])
+async def get_changes(
+    db: AsyncSession = Depends(get_async_db),
+    cursor: Optional[str] = None,
+    branch_id: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000)
+):
+    """
+    Change feed: reviews inserted or updated after the cursor, ordered by (updated_at, id).
+    Start without a cursor, then pass next_cursor back until has_more is false.
+    change is "upsert" (new or edited), "hidden" (hidden by 2GIS moderation)
+    or "removed" (no longer returned by 2GIS).
+    """
+    query = _change_feed_query(_decode_cursor(cursor) if cursor else None, branch_id)
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    changes = [
+        {"change": _change_kind(row), "updated_at": row.changed_at, "review": _review_dict(row)}
+        for row in rows
+    ]
+    next_cursor = _encode_cursor(rows[-1].changed_at, rows[-1].change_pk) if rows else cursor
+    
+    return FastJSONResponse({"changes": changes, "next_cursor": next_cursor, "has_more": has_more})
+
 @app.get("/api/v1/{branch_id}/{count}", response_model=List[ReviewResponse], tags=["Reviews"])
 async def get_latest_reviews_by_branch(
     branch_id: str,
     count: int,
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get latest reviews for a specific branch"""
     # Валидация параметра count
     if count < 1 or count > 1000:
         raise HTTPException(status_code=400, detail="Count must be between 1 and 1000")
     
+    not_modified = _conditional_response(request, response, branch_id=branch_id)
+    if not_modified is not None:
+        return not_modified
+    
+    # Лента Redis (write-through из ingest); Postgres — если ее нет
+    payloads = get_review_timeline().latest(branch_id, count)
+    if payloads is not None:
+        return _json_payloads(payloads, response)
+    
     # Проверяем существование филиала
-    branch = db.query(Branch).filter(Branch.branch_id == branch_id).first()
-    if not branch:
+    branch_pk = await _get_branch_pk(db, branch_id)
+    if branch_pk is None:
         raise HTTPException(status_code=404, detail="Branch not found")
     
-    # Получаем последние отзывы, отсортированные по дате (от новых к старым)
-    reviews = db.query(Review).filter(
-        Review.branch_id == branch_id
-    ).order_by(desc(Review.date_created)).limit(count).all()
-    
-    return reviews
+    return _json_list(await _latest_reviews_with_timeline(db, branch_pk, branch_id, count), response)
 
 @app.get("/api/v1/by-iiko/{id_iiko}/{count}", response_model=List[ReviewResponse], tags=["Reviews"])
 async def get_latest_reviews_by_iiko_id(
     id_iiko: str,
     count: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get latest reviews for a specific branch by iiko ID"""
     # Валидация параметра count
     if count < 1 or count > 1000:
         raise HTTPException(status_code=400, detail="Count must be between 1 and 1000")
     
-    # Ищем филиал по id_iiko в Google Sheets
-    branch_data = get_branch_by_iiko_id(id_iiko)
+    # Ищем филиал по id_iiko в Google Sheets (синхронный вызов — вне event loop)
+    branch_data = await run_in_threadpool(get_branch_by_iiko_id, id_iiko)
     if not branch_data:
         raise HTTPException(
             status_code=404, 
@@ -430,20 +1134,19 @@ async def get_latest_reviews_by_iiko_id(
             detail=f"Branch '{branch_data.get('name')}' has no 2GIS ID configured"
         )
     
+    payloads = get_review_timeline().latest(branch_id, count)
+    if payloads is not None:
+        return _json_payloads(payloads)
+    
     # Проверяем существование филиала в базе данных
-    branch = db.query(Branch).filter(Branch.branch_id == branch_id).first()
-    if not branch:
+    branch_pk = await _get_branch_pk(db, branch_id)
+    if branch_pk is None:
         raise HTTPException(
             status_code=404, 
             detail=f"Branch '{branch_data.get('name')}' (2GIS ID: {branch_id}) not found in reviews database"
         )
     
-    # Получаем последние отзывы, отсортированные по дате (от новых к старым)
-    reviews = db.query(Review).filter(
-        Review.branch_id == branch_id
-    ).order_by(desc(Review.date_created)).limit(count).all()
-    
-    return reviews
+    return _json_list(await _latest_reviews_with_timeline(db, branch_pk, branch_id, count))
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Сравнение сериализации списка отзывов в api_v2.
+
+1. Прежний путь: ORM-объекты -> ReviewResponse (from_attributes) -> stdlib json,
+   как это делает FastAPI при response_model.
+2. Быстрый путь: кортежи колонок -> dict -> orjson (FastJSONResponse).
+
+Данные синтетические, база не нужна.
+
+Запуск:
+    python benchmark_serialization.py            # 1000 строк
+    python benchmark_serialization.py 5000 50    # строк, повторов
+"""
+import os
+import sys
+import json
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import List
+
+# api_v2 создает engine лениво — соединение с базой не открывается
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/benchmark")
+
+from pydantic import TypeAdapter
+
+from api_v2 import ReviewResponse, REVIEW_FIELDS, _review_dict
+from fast_json import FastJSONResponse, orjson
+
+
+def make_rows(count: int) -> List[tuple]:
+    """Строки в порядке REVIEW_COLUMNS"""
+    now = datetime(2025, 1, 1, 12, 0, 0)
+    return [
+        (
+            str(70000000016000000 + i),
+            "70000001012345678",
+            "Сандык Тары, Абая 10",
+            f"Пользователь {i}",
+            float(i % 5 + 1),
+            "Очень вкусно, быстрое обслуживание, приятная атмосфера. " * 3,
+            now - timedelta(minutes=i),
+            None,
+            i % 3 == 0,
+            i % 7,
+            i % 2,
+            1,
+            ["https://i0.photo.2gis.com/images/branch/0/30258560077177347_3a24.jpg"],
+        )
+        for i in range(count)
+    ]
+
+
+def legacy_path(objects, adapter: TypeAdapter) -> bytes:
+    """response_model: валидация атрибутов ORM, dump в JSON-совместимые типы, stdlib json"""
+    content = adapter.dump_python(adapter.validate_python(objects, from_attributes=True), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def fast_path(rows) -> bytes:
+    return FastJSONResponse([_review_dict(row) for row in rows]).body
+
+
+def measure(func, *args, repeats: int) -> float:
+    """Лучшее время одного вызова, мс"""
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    rows = make_rows(count)
+    objects = [SimpleNamespace(**dict(zip(REVIEW_FIELDS, row))) for row in rows]
+    adapter = TypeAdapter(List[ReviewResponse])
+
+    # Оба пути должны отдавать один и тот же документ
+    assert json.loads(legacy_path(objects, adapter)) == json.loads(fast_path(rows))
+
+    legacy_ms = measure(legacy_path, objects, adapter, repeats=repeats)
+    fast_ms = measure(fast_path, rows, repeats=repeats)
+
+    print(f"Строк: {count}, повторов: {repeats}, encoder: {'orjson' if orjson else 'stdlib json'}")
+    print(f"  Pydantic + json:  {legacy_ms:8.2f} мс")
+    print(f"  dict + orjson:    {fast_ms:8.2f} мс")
+    print(f"  Ускорение:        {legacy_ms / fast_ms:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,19 @@
 """
 Универсальный модуль для загрузки данных о филиалах из Google Sheets.
 Заменяет функциональность загрузки из CSV файла.
+
+Google Sheets читает только фоновый обновитель (refresh_branches.py): он
+публикует снимок списка филиалов с хешем содержимого в Redis и в файл.
+Остальные процессы (API, бот, парсеры, Celery) читают этот снимок и
+никогда не ждут ответа Google. Пока снимка нет — читается CSV; если в нем
+нет колонки id_iiko, поиск по ID iiko выбрасывает IikoIdsUnavailable, а не
+молча ничего не находит.
 """
 
 import os
 import csv
+import json
+import hashlib
 import gspread
 import logging
 from typing import List, Dict, Optional
@@ -14,6 +23,8 @@ from functools import lru_cache
 import time
 from datetime import datetime, timedelta
 
+from cache_manager import get_cache_manager
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
@@ -23,18 +34,109 @@ SERVICE_ACCOUNT_FILE = "basic-zenith-465712-s5-63bf748b2e1c.json"
 CSV_FALLBACK_PATH = "data/sandyq_tary_branches.csv"
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
 
-# Кэш для хранения данных филиалов
+# Общий снимок списка филиалов
+SNAPSHOT_KEY = "branches:snapshot"
+SNAPSHOT_HASH_KEY = "branches:snapshot:hash"
+SNAPSHOT_PATH = os.getenv("BRANCHES_SNAPSHOT_PATH", "data/branches_snapshot.json")
+
+# Кэш процесса; раз в _cache_ttl секунд сверяется хеш общего снимка
 _branches_cache = None
 _cache_timestamp = None
-_cache_ttl = 300  # 5 минут
+_cache_hash = None
+_cache_ttl = int(os.getenv("BRANCHES_SNAPSHOT_CHECK_SECONDS", "30"))
+
+
+class IikoIdsUnavailable(Exception):
+    """В загруженном списке филиалов нет ID iiko (CSV без колонки id_iiko, снимка еще нет)"""
+
+
+def branches_hash(branches: List[Dict[str, str]]) -> str:
+    """Хеш содержимого списка филиалов (не зависит от порядка ключей)"""
+    payload = json.dumps(branches, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _read_snapshot_file() -> Optional[Dict]:
+    try:
+        with open(SNAPSHOT_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка чтения снимка филиалов {SNAPSHOT_PATH}: {e}")
+        return None
+
+
+def _write_snapshot_file(snapshot: Dict):
+    # Через временный файл: читатели не увидят недописанный снимок
+    os.makedirs(os.path.dirname(SNAPSHOT_PATH) or ".", exist_ok=True)
+    tmp_path = SNAPSHOT_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+
+def read_snapshot(known_hash: Optional[str] = None) -> Optional[Dict]:
+    """
+    Прочитать общий снимок филиалов: Redis, затем файл
+
+    Args:
+        known_hash: Хеш снимка, который уже есть у процесса
+
+    Returns:
+        Снимок {'hash', 'source', 'refreshed_at', 'branches'};
+        {'hash': known_hash} без списка, если снимок не изменился;
+        None, если снимок еще не публиковался
+    """
+    cache = get_cache_manager()
+    if cache.is_available():
+        try:
+            current_hash = cache.redis_client.get(SNAPSHOT_HASH_KEY)
+            if current_hash and current_hash == known_hash:
+                return {'hash': known_hash}
+            if current_hash:
+                data = cache.redis_client.get(SNAPSHOT_KEY)
+                if data:
+                    return json.loads(data)
+        except Exception as e:
+            logger.error(f"Ошибка чтения снимка филиалов из Redis: {e}")
+
+    snapshot = _read_snapshot_file()
+    if snapshot and snapshot.get('hash') == known_hash:
+        return {'hash': known_hash}
+    return snapshot
+
+
+def publish_snapshot(branches: List[Dict[str, str]], source: str) -> Dict:
+    """Записать снимок филиалов в файл и в Redis"""
+    snapshot = {
+        'hash': branches_hash(branches),
+        'source': source,
+        'refreshed_at': datetime.utcnow().isoformat(),
+        'branches': branches,
+    }
+    _write_snapshot_file(snapshot)
+
+    cache = get_cache_manager()
+    if cache.is_available():
+        try:
+            # Тело и хеш одной транзакцией: хеш не опережает тело
+            pipe = cache.redis_client.pipeline()
+            pipe.set(SNAPSHOT_KEY, json.dumps(snapshot, ensure_ascii=False))
+            pipe.set(SNAPSHOT_HASH_KEY, snapshot['hash'])
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Ошибка записи снимка филиалов в Redis: {e}")
+
+    return snapshot
 
 
 class BranchesLoader:
     """Класс для загрузки данных о филиалах из Google Sheets с fallback на CSV"""
     
     def __init__(self):
+        # Клиент создается при первом обращении к Sheets — читателям снимка он не нужен
         self.client = None
-        self._initialize_client()
     
     def _initialize_client(self):
         """Инициализация Google Sheets клиента"""
@@ -56,6 +158,8 @@ class BranchesLoader:
     
     def _load_from_google_sheets(self) -> List[Dict[str, str]]:
         """Загрузка данных из Google Sheets"""
+        if not self.client:
+            self._initialize_client()
         if not self.client:
             raise Exception("Google Sheets клиент не инициализирован")
         
@@ -119,6 +223,7 @@ class BranchesLoader:
                     name_key = None
                     id_key = None
                     steady_key = None
+                    iiko_key = None
                     
                     for key in row.keys():
                         if 'Название точки' in key:
@@ -127,6 +232,8 @@ class BranchesLoader:
                             id_key = key
                         elif 'ИД steady' in key:
                             steady_key = key
+                        elif 'id_iiko' in key:
+                            iiko_key = key
                     
                     if not name_key or not id_key:
                         continue
@@ -134,6 +241,7 @@ class BranchesLoader:
                     name = row.get(name_key, '').strip()
                     id_2gis = row.get(id_key, '').strip()
                     id_steady = row.get(steady_key, '').strip() if steady_key else ''
+                    id_iiko = (row.get(iiko_key) or '').strip() if iiko_key else ''
                     
                     # Проверяем валидность ID
                     if name and id_2gis and id_2gis.lower() not in ['', 'null']:
@@ -144,6 +252,8 @@ class BranchesLoader:
                             }
                             if id_steady and id_steady.lower() not in ['', 'null']:
                                 branch_data['id_steady'] = id_steady
+                            if id_iiko and id_iiko.lower() not in ['', 'null']:
+                                branch_data['id_iiko'] = id_iiko
                             branches.append(branch_data)
                         else:
                             logger.warning(f"Пропущена точка '{name}' - невалидный ID: {id_2gis}")
@@ -152,63 +262,82 @@ class BranchesLoader:
                             logger.warning(f"Пропущена точка '{name}' - отсутствует ID 2GIS")
             
             logger.info(f"Загружено {len(branches)} филиалов из CSV (fallback)")
+            if branches and not any('id_iiko' in branch for branch in branches):
+                logger.error(
+                    f"В {CSV_FALLBACK_PATH} нет ID iiko: поиск по id_iiko недоступен "
+                    f"до публикации снимка (refresh_branches.py)"
+                )
             return branches
             
         except Exception as e:
             logger.error(f"Ошибка загрузки из CSV: {e}")
             raise
     
+    def fetch_branches(self) -> Optional[List[Dict[str, str]]]:
+        """
+        Загрузка филиалов из Google Sheets (только для обновителя снимка)
+
+        Returns:
+            Список филиалов или None, если Sheets недоступен
+        """
+        try:
+            return self._load_from_google_sheets()
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить из Google Sheets: {e}")
+            return None
+
     def load_branches(self, use_cache: bool = True) -> List[Dict[str, str]]:
         """
-        Загрузка филиалов с кэшированием и fallback на CSV
+        Загрузка филиалов из общего снимка с fallback на CSV.
+        Google Sheets здесь не вызывается.
         
         Args:
-            use_cache: Использовать кэш или загружать заново
+            use_cache: Использовать кэш процесса или сразу сверить снимок
             
         Returns:
-            Список филиалов
+            Список филиалов (тот же объект, пока снимок не изменился)
         """
-        global _branches_cache, _cache_timestamp
+        global _branches_cache, _cache_timestamp, _cache_hash
         
         # Проверяем кэш
-        if use_cache and _branches_cache and _cache_timestamp:
+        if use_cache and _branches_cache is not None and _cache_timestamp:
             if datetime.now() - _cache_timestamp < timedelta(seconds=_cache_ttl):
                 logger.debug("Используем кэшированные данные филиалов")
                 return _branches_cache
         
-        # Пытаемся загрузить из Google Sheets
+        snapshot = read_snapshot(known_hash=_cache_hash if _branches_cache is not None else None)
+        if snapshot is not None:
+            if 'branches' in snapshot:
+                _branches_cache = snapshot['branches']
+                _cache_hash = snapshot['hash']
+                logger.info(
+                    f"Загружен снимок филиалов {snapshot['hash'][:12]} "
+                    f"({len(_branches_cache)} шт., источник: {snapshot.get('source')})"
+                )
+            _cache_timestamp = datetime.now()
+            return _branches_cache
+        
+        # Снимок еще не опубликован — локальный CSV, без обращения к Google
         try:
-            branches = self._load_from_google_sheets()
+            branches = self._load_from_csv_fallback()
             
-            # Обновляем кэш
+            # Обновляем кэш (даже для fallback данных)
             _branches_cache = branches
+            _cache_hash = None
             _cache_timestamp = datetime.now()
             
             return branches
             
-        except Exception as e:
-            logger.warning(f"Не удалось загрузить из Google Sheets: {e}")
-            logger.info("Переключаемся на CSV fallback")
+        except Exception as csv_error:
+            logger.error(f"Ошибка загрузки из CSV fallback: {csv_error}")
             
-            try:
-                branches = self._load_from_csv_fallback()
-                
-                # Обновляем кэш (даже для fallback данных)
-                _branches_cache = branches
-                _cache_timestamp = datetime.now()
-                
-                return branches
-                
-            except Exception as csv_error:
-                logger.error(f"Ошибка загрузки из CSV fallback: {csv_error}")
-                
-                # Если есть старые кэшированные данные, используем их
-                if _branches_cache:
-                    logger.warning("Используем устаревшие кэшированные данные")
-                    return _branches_cache
-                
-                # Если ничего нет, выбрасываем исключение
-                raise Exception(f"Не удалось загрузить данные ни из Google Sheets, ни из CSV: {e}")
+            # Если есть старые кэшированные данные, используем их
+            if _branches_cache is not None:
+                logger.warning("Используем устаревшие кэшированные данные")
+                return _branches_cache
+            
+            # Если ничего нет, выбрасываем исключение
+            raise Exception(f"Нет ни снимка филиалов, ни CSV: {csv_error}")
 
 
 # Глобальный экземпляр загрузчика
@@ -234,18 +363,132 @@ def load_branches_from_csv(csv_path: Optional[str] = None) -> List[Dict[str, str
         return []
 
 
+def normalize_branch_name(name: str) -> str:
+    """Название филиала -> ключ индекса: без регистра и повторных пробелов"""
+    return ' '.join(str(name).split()).casefold()
+
+
+class BranchRegistry:
+    """
+    Неизменяемый снимок списка филиалов с хеш-индексами.
+
+    Строится один раз на каждую загрузку списка; при обновлении кэша
+    создается новый объект, и ссылка на него подменяется целиком — читатели
+    видят либо старый, либо новый снимок, но не промежуточное состояние.
+    При повторяющихся ключах побеждает первый филиал, как при прежнем
+    линейном поиске. Возвращаемые словари общие — изменять их нельзя.
+    """
+
+    __slots__ = ('source', 'branches', '_by_2gis', '_by_iiko', '_by_steady', '_by_name')
+
+    def __init__(self, branches: List[Dict[str, str]]):
+        # Ссылка на исходный список: по ней get_branch_registry() понимает, что кэш обновился
+        object.__setattr__(self, 'source', branches)
+        snapshot = tuple(dict(branch) for branch in branches)
+        object.__setattr__(self, 'branches', snapshot)
+
+        indexes = {'_by_2gis': {}, '_by_iiko': {}, '_by_steady': {}, '_by_name': {}}
+        for branch in snapshot:
+            for index, key in (
+                ('_by_2gis', branch.get('id_2gis')),
+                ('_by_iiko', branch.get('id_iiko')),
+                ('_by_steady', branch.get('id_steady')),
+                ('_by_name', normalize_branch_name(branch['name']) if branch.get('name') else None),
+            ):
+                if key:
+                    indexes[index].setdefault(key, branch)
+        for index, mapping in indexes.items():
+            object.__setattr__(self, index, mapping)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BranchRegistry неизменяем")
+
+    def __len__(self) -> int:
+        return len(self.branches)
+
+    def by_2gis(self, id_2gis: str) -> Optional[Dict[str, str]]:
+        return self._by_2gis.get(id_2gis)
+
+    def by_iiko(self, id_iiko: str) -> Optional[Dict[str, str]]:
+        if not self._by_iiko and self.branches:
+            raise IikoIdsUnavailable("В списке филиалов нет ID iiko — снимок филиалов еще не опубликован")
+        return self._by_iiko.get(id_iiko)
+
+    def by_steady(self, id_steady: str) -> Optional[Dict[str, str]]:
+        return self._by_steady.get(id_steady)
+
+    def by_name(self, name: str) -> Optional[Dict[str, str]]:
+        return self._by_name.get(normalize_branch_name(name))
+
+
+_registry = BranchRegistry([])
+
+
+def get_branch_registry() -> BranchRegistry:
+    """
+    Текущий реестр филиалов.
+
+    Пока кэш загрузчика свежий, load_branches() возвращает тот же список,
+    и реестр отдается без перестроения и копирования.
+    """
+    global _registry
+    try:
+        branches = _loader.load_branches()
+    except Exception as e:
+        logger.error(f"Критическая ошибка загрузки филиалов: {e}")
+        return _registry
+
+    registry = _registry
+    if branches is not registry.source:
+        registry = BranchRegistry(branches)
+        _registry = registry
+    return registry
+
+
+def refresh_branches_snapshot(force: bool = False) -> Optional[Dict]:
+    """
+    Перечитать Google Sheets и опубликовать снимок, если список изменился.
+    Вызывается фоновым обновителем (refresh_branches.py).
+
+    Args:
+        force: Опубликовать снимок, даже если хеш не изменился
+
+    Returns:
+        Опубликованный снимок или None (Sheets недоступен либо изменений нет)
+    """
+    branches = _loader.fetch_branches()
+    if branches is None:
+        # Прошлый снимок остается в силе
+        return None
+
+    new_hash = branches_hash(branches)
+    # Снимок должен совпадать и в файле, и в Redis (Redis мог быть очищен)
+    current = _read_snapshot_file()
+    unchanged = current is not None and current.get('hash') == new_hash
+    cache = get_cache_manager()
+    if unchanged and cache.is_available():
+        try:
+            unchanged = cache.redis_client.get(SNAPSHOT_HASH_KEY) == new_hash
+        except Exception as e:
+            logger.error(f"Ошибка чтения хеша снимка филиалов из Redis: {e}")
+    if not force and unchanged:
+        logger.info(f"Список филиалов не изменился ({new_hash[:12]})")
+        return None
+
+    snapshot = publish_snapshot(branches, source='google_sheets')
+    logger.info(f"Опубликован снимок филиалов {new_hash[:12]} ({len(branches)} шт.)")
+    return snapshot
+
+
 def reload_branches_cache():
-    """Принудительно обновить кэш данных филиалов"""
-    global _branches_cache, _cache_timestamp
-    _branches_cache = None
-    _cache_timestamp = None
+    """Принудительно обновить снимок из Google Sheets и кэш данных филиалов"""
+    refresh_branches_snapshot()
     return _loader.load_branches(use_cache=False)
 
 
 def get_branches_count() -> int:
     """Получить количество загруженных филиалов"""
-    branches = load_branches_from_csv()
-    return len(branches)
+    return len(get_branch_registry())
 
 
 def get_branch_by_id(branch_id: str) -> Optional[Dict[str, str]]:
@@ -258,16 +501,12 @@ def get_branch_by_id(branch_id: str) -> Optional[Dict[str, str]]:
     Returns:
         Данные филиала или None если не найден
     """
-    branches = load_branches_from_csv()
-    for branch in branches:
-        if branch.get('id_2gis') == branch_id:
-            return branch
-    return None
+    return get_branch_registry().by_2gis(branch_id)
 
 
 def get_branch_by_name(branch_name: str) -> Optional[Dict[str, str]]:
     """
-    Найти филиал по названию
+    Найти филиал по названию (без учета регистра и лишних пробелов)
     
     Args:
         branch_name: Название филиала
@@ -275,11 +514,7 @@ def get_branch_by_name(branch_name: str) -> Optional[Dict[str, str]]:
     Returns:
         Данные филиала или None если не найден
     """
-    branches = load_branches_from_csv()
-    for branch in branches:
-        if branch.get('name') == branch_name:
-            return branch
-    return None
+    return get_branch_registry().by_name(branch_name)
 
 
 def get_branch_by_iiko_id(iiko_id: str) -> Optional[Dict[str, str]]:
@@ -292,11 +527,39 @@ def get_branch_by_iiko_id(iiko_id: str) -> Optional[Dict[str, str]]:
     Returns:
         Данные филиала или None если не найден
     """
-    branches = load_branches_from_csv()
-    for branch in branches:
-        if branch.get('id_iiko') == iiko_id:
-            return branch
-    return None
+    return get_branch_registry().by_iiko(iiko_id)
+
+
+def get_branch_by_steady_id(steady_id: str) -> Optional[Dict[str, str]]:
+    """
+    Найти филиал по ID steady
+    
+    Args:
+        steady_id: ID филиала в steady
+        
+    Returns:
+        Данные филиала или None если не найден
+    """
+    return get_branch_registry().by_steady(steady_id)
+
+
+def get_branches_by_iiko_ids(iiko_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Найти филиалы по нескольким ID iiko
+    
+    Args:
+        iiko_ids: ID филиалов в iiko
+        
+    Returns:
+        Словарь {id_iiko: данные филиала} только для найденных
+    """
+    registry = get_branch_registry()
+    found = {}
+    for iiko_id in iiko_ids:
+        branch = registry.by_iiko(iiko_id)
+        if branch is not None:
+            found[iiko_id] = branch
+    return found
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@
 import json
 import logging
 import os
+import time
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Any
 import redis
@@ -182,6 +183,78 @@ class CacheManager:
         
         logger.info(f"Всего инвалидировано ключей: {total_deleted}")
     
+    # Версии данных для условных ответов API (ETag / Last-Modified).
+    # Хранятся отдельно от кэша и не сбрасываются его очисткой:
+    # версия меняется только когда ingest действительно изменил данные.
+    
+    def _version_dependent_keys(self, branch_id: Optional[str]) -> List[str]:
+        """Ключи кэша ответов, которые отдаются под ETag версии данных"""
+        keys = [self._make_key('branches_list'), self._make_key('general_stats')]
+        keys.extend(self.redis_client.keys('recent_reviews:*'))
+        if branch_id:
+            keys.append(self._make_key('branch_stats', branch_id))
+            keys.extend(self.redis_client.keys(f'reviews:{branch_id}:*'))
+        return keys
+    
+    def bump_data_version(self, branch_id: Optional[str] = None) -> bool:
+        """
+        Отметить изменение данных филиала (если указан) и общих данных.
+        Кэш ответов, зависящих от версии, удаляется в той же транзакции:
+        иначе новый ETag отдавался бы со старым телом, и клиент закрепил бы его 304-ми.
+        """
+        if not self.is_available():
+            return False
+        
+        try:
+            keys = [self._make_key('data_version', 'global')]
+            if branch_id:
+                keys.append(self._make_key('data_version', 'branch', branch_id))
+            
+            pipe = self.redis_client.pipeline()
+            pipe.delete(*self._version_dependent_keys(branch_id))
+            for key in keys:
+                pipe.hincrby(key, 'version', 1)
+                pipe.hset(key, 'modified', time.time())
+            pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления версии данных {branch_id or 'global'}: {str(e)}")
+            return False
+    
+    def get_data_version(self, branch_id: Optional[str] = None) -> Optional[Dict]:
+        """
+        Текущая версия данных: {'scope', 'version', 'modified'}.
+        Пока у филиала нет своей версии, действует общая — любое изменение
+        филиала меняет и ее. None, если Redis недоступен.
+        """
+        if not self.is_available():
+            return None
+        
+        try:
+            if branch_id:
+                branch_key = self._make_key('data_version', 'branch', branch_id)
+                data = self.redis_client.hgetall(branch_key)
+                if data:
+                    return {'scope': branch_key, 'version': int(data['version']), 'modified': float(data['modified'])}
+            
+            global_key = self._make_key('data_version', 'global')
+            data = self.redis_client.hgetall(global_key)
+            if not data:
+                # Первое обращение: фиксируем текущий момент как начало отсчета
+                pipe = self.redis_client.pipeline()
+                pipe.hsetnx(global_key, 'version', 1)
+                pipe.hsetnx(global_key, 'modified', time.time())
+                pipe.hgetall(global_key)
+                data = pipe.execute()[-1]
+            return {'scope': global_key, 'version': int(data['version']), 'modified': float(data['modified'])}
+        except Exception as e:
+            logger.error(f"Ошибка получения версии данных {branch_id or 'global'}: {str(e)}")
+            return None
+    
+    def reset_data_versions(self) -> int:
+        """Сбросить все версии данных (после массовой загрузки в обход ingest)"""
+        return self.delete_pattern(self._make_key('data_version', '*'))
+    
     def get_cache_stats(self) -> Dict:
         """Получение статистики кэша"""
         if not self.is_available():
@@ -5,11 +5,9 @@
 import os
 import logging
 from datetime import datetime, timedelta
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
 from dotenv import load_dotenv
 
-from database import TelegramUserState
+from database import TelegramUserState, SessionLocal, use_profile
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -21,11 +19,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Подключение к базе данных
-DATABASE_URL = os.getenv('DATABASE_URL')
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
 def cleanup_old_states():
     """Очистить старые состояния пользователей"""
     db = SessionLocal()
@@ -47,4 +40,5 @@ def cleanup_old_states():
         db.close()
 
 if __name__ == "__main__":
+    use_profile('script')
     cleanup_old_states()
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+Контрольные точки длинных обходов филиалов (daily_parse, parse_sandyq_tary).
+
+Состояние запуска хранится в output/checkpoints/{job}.json:
+
+    {
+      "job": "daily_parse",
+      "run_id": "20250201_030000",
+      "status": "running" | "completed",
+      "branches": {
+        "70000001012345678": {"status": "done", "offset": 150, "result": {...}},
+        ...
+      }
+    }
+
+Файл переписывается атомарно после каждого шага, поэтому после падения
+или kill запуск с --resume пропускает завершенные филиалы, а незавершенный
+продолжает с сохраненного offset. Данные, собранные по страницам
+(полная выгрузка), лежат рядом в output/checkpoints/{job}/{branch_id}.jsonl.
+"""
+import os
+import json
+import shutil
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = os.getenv("CRAWL_CHECKPOINT_DIR", "output/checkpoints")
+
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+
+BRANCH_IN_PROGRESS = "in_progress"
+BRANCH_DONE = "done"
+BRANCH_FAILED = "failed"
+
+
+class CrawlCheckpoint:
+    """Контрольная точка одного запуска обхода"""
+
+    def __init__(self, job: str, resume: bool = False, directory: Optional[str] = None):
+        """
+        Args:
+            job: Имя задачи (имя файла контрольной точки)
+            resume: Продолжить незавершенный запуск, если он есть
+            directory: Каталог контрольных точек (по умолчанию CHECKPOINT_DIR)
+        """
+        self.job = job
+        self.directory = directory or CHECKPOINT_DIR
+        self.path = os.path.join(self.directory, f"{job}.json")
+        self.data_dir = os.path.join(self.directory, job)
+        self.resumed = False
+
+        state = self._load() if resume else None
+        if state is not None and state.get("status") != STATUS_COMPLETED:
+            self.state = state
+            self.resumed = True
+            done = sum(1 for branch in state["branches"].values() if branch.get("status") == BRANCH_DONE)
+            logger.info(f"♻️ Продолжаем запуск {job} {state['run_id']}: завершено филиалов {done}")
+        else:
+            if resume:
+                logger.info(f"Незавершенного запуска {job} нет, начинаем новый")
+            self.state = {
+                "job": job,
+                "run_id": datetime.now().strftime("%Y%m%d_%H%M%S"),
+                "status": STATUS_RUNNING,
+                "started_at": datetime.now().isoformat(),
+                "branches": {},
+            }
+            # Данные прошлого запуска больше не нужны
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+            self.save()
+
+    @property
+    def run_id(self) -> str:
+        return self.state["run_id"]
+
+    def _load(self) -> Optional[Dict]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Контрольная точка {self.path} повреждена, начинаем заново: {e}")
+            return None
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.state["saved_at"] = datetime.now().isoformat()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def branch(self, branch_id: str) -> Dict:
+        """Состояние филиала ({} — филиал еще не начат)"""
+        return self.state["branches"].get(branch_id, {})
+
+    def is_done(self, branch_id: str) -> bool:
+        return self.branch(branch_id).get("status") == BRANCH_DONE
+
+    def offset(self, branch_id: str) -> int:
+        """С какого offset продолжать незавершенный филиал"""
+        return self.branch(branch_id).get("offset", 0)
+
+    def start_branch(self, branch_id: str):
+        branch = self.state["branches"].setdefault(branch_id, {"offset": 0})
+        branch["status"] = BRANCH_IN_PROGRESS
+        branch["started_at"] = datetime.now().isoformat()
+        self.save()
+
+    def update_offset(self, branch_id: str, offset: int, reviews: Optional[List[Dict]] = None):
+        """
+        Отметить обработанные страницы филиала
+
+        Args:
+            offset: Offset следующей страницы
+            reviews: Отзывы страницы — дописываются в файл данных филиала до сохранения offset
+        """
+        if reviews:
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(self._data_path(branch_id), 'a', encoding='utf-8') as f:
+                for review in reviews:
+                    f.write(json.dumps(review, ensure_ascii=False) + "\n")
+        self.state["branches"].setdefault(branch_id, {})["offset"] = offset
+        self.save()
+
+    def collected(self, branch_id: str) -> List[Dict]:
+        """Отзывы филиала, собранные по страницам (без дублей по review_id)"""
+        reviews: Dict = {}
+        try:
+            with open(self._data_path(branch_id), 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        review = json.loads(line)
+                        reviews[review.get("review_id")] = review
+        except FileNotFoundError:
+            pass
+        return list(reviews.values())
+
+    def complete_branch(self, branch_id: str, result: Optional[Dict] = None):
+        branch = self.state["branches"].setdefault(branch_id, {})
+        branch["status"] = BRANCH_DONE
+        branch["finished_at"] = datetime.now().isoformat()
+        if result is not None:
+            branch["result"] = result
+        self.save()
+
+    def fail_branch(self, branch_id: str, error: str):
+        # Неудачный филиал не считается завершенным: --resume попробует его снова
+        branch = self.state["branches"].setdefault(branch_id, {})
+        branch["status"] = BRANCH_FAILED
+        branch["error"] = error
+        self.save()
+
+    def results(self) -> List[Dict]:
+        """Результаты завершенных филиалов (для итогового отчета продолженного запуска)"""
+        return [
+            branch["result"]
+            for branch in self.state["branches"].values()
+            if branch.get("status") == BRANCH_DONE and "result" in branch
+        ]
+
+    def finish(self):
+        """Запуск завершен: следующий --resume начнет новый"""
+        self.state["status"] = STATUS_COMPLETED
+        self.state["finished_at"] = datetime.now().isoformat()
+        self.save()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def _data_path(self, branch_id: str) -> str:
+        return os.path.join(self.data_dir, f"{branch_id}.jsonl")
@@ -0,0 +1,232 @@
+"""
+Распределенный обход филиалов через Celery.
+
+Каждый филиал — отдельная задача crawl_branch. Задачи раскладываются по
+очередям crawl_0 … crawl_{CRAWL_SHARDS-1} консистентным хешированием ID
+филиала: филиал всегда попадает в одну и ту же очередь, а при изменении
+числа шардов переезжает лишь ~1/N филиалов. Каждый узел слушает свой
+набор очередей, поэтому мощность обхода растет с числом воркеров.
+
+Общий лимит запросов к 2GIS — token bucket в Redis (rate_limiter.py),
+повторный обход филиала исключает блокировка crawl:{branch_id} (lease_lock.py).
+Результаты собирает chord: finalize_crawl пишет ParseReport и ставит
+уведомления в очередь.
+
+Запуск:
+    celery -A crawl_queue worker -Q crawl_0,crawl_1,crawl_coordinator --concurrency=2
+    python crawl_queue.py          # синхронизировать филиалы и разослать задачи обхода
+"""
+import os
+import bisect
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from celery import Celery, chord
+from celery.signals import worker_process_init
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Инициализация Celery
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+app = Celery('crawl_queue', broker=redis_url, backend=redis_url)
+
+# Число очередей обхода; воркеры распределяют их между собой через -Q
+CRAWL_SHARDS = int(os.getenv("CRAWL_SHARDS", "4"))
+COORDINATOR_QUEUE = "crawl_coordinator"
+# Виртуальных узлов на шард в кольце хешей (равномернее распределение)
+VIRTUAL_NODES = 64
+
+app.conf.update(
+    task_serializer='json',
+    accept_content=['json'],
+    result_serializer='json',
+    timezone='Asia/Almaty',
+    enable_utc=True,
+    task_default_queue=COORDINATOR_QUEUE,
+    task_routes={
+        'crawl_queue.start_crawl': {'queue': COORDINATOR_QUEUE},
+        'crawl_queue.finalize_crawl': {'queue': COORDINATOR_QUEUE},
+    },
+    # Обход филиала длинный: по одной задаче на процесс, подтверждение после выполнения
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    result_expires=24 * 3600,
+)
+
+
+def _ring_hash(value: str) -> int:
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def _build_ring(shards: int):
+    ring = sorted(
+        (_ring_hash(f"crawl_{shard}#{node}"), f"crawl_{shard}")
+        for shard in range(shards)
+        for node in range(VIRTUAL_NODES)
+    )
+    return [point for point, _ in ring], [queue for _, queue in ring]
+
+
+_RING_POINTS, _RING_QUEUES = _build_ring(CRAWL_SHARDS)
+
+
+def queue_for_branch(branch_id: str) -> str:
+    """Очередь обхода филиала (консистентный хеш ID 2GIS)"""
+    index = bisect.bisect(_RING_POINTS, _ring_hash(branch_id)) % len(_RING_POINTS)
+    return _RING_QUEUES[index]
+
+
+@worker_process_init.connect
+def _init_worker_process(**kwargs):
+    # Пул соединений профиля воркера создается в каждом дочернем процессе
+    from database import use_profile
+    use_profile('worker')
+
+
+_parser = None
+
+
+def _get_parser():
+    """Парсер процесса воркера с общим лимитом запросов"""
+    global _parser
+    if _parser is None:
+        from parser import TwoGISReviewsParser
+        from rate_limiter import get_crawl_rate_limiter
+        _parser = TwoGISReviewsParser()
+        _parser.throttle = get_crawl_rate_limiter().acquire
+    return _parser
+
+
+def _branch_result(branch: Dict, status: str, error: Optional[str] = None) -> Dict:
+    result = {
+        'branch_name': branch['name'],
+        'branch_id': branch['id_2gis'],
+        'status': status,
+        'total_reviews': 0,
+        'new_reviews': 0,
+    }
+    if error:
+        result['error'] = error
+    return result
+
+
+@app.task(name='crawl_queue.crawl_branch')
+def crawl_branch(branch: Dict) -> Dict:
+    """
+    Обход одного филиала
+
+    Args:
+        branch: Филиал из branches_loader ({'name', 'id_2gis', ...})
+
+    Returns:
+        Результат обхода; ошибки не пробрасываются, чтобы chord дождался всех филиалов
+    """
+    from database import SessionLocal
+    from daily_parse import ingest_branch
+    from lease_lock import branch_lock
+
+    lock = branch_lock(branch['id_2gis'])
+    if not lock.acquire():
+        logger.info(f"⏭  Филиал {branch['name']} обходит другой процесс, пропускаем")
+        return _branch_result(branch, 'skipped')
+
+    session = SessionLocal()
+    try:
+        return ingest_branch(_get_parser(), branch, session, lock=lock)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обхода филиала {branch['name']}: {e}")
+        session.rollback()
+        return _branch_result(branch, 'failed', str(e))
+    finally:
+        session.close()
+        lock.release()
+
+
+@app.task(name='crawl_queue.finalize_crawl')
+def finalize_crawl(results: List[Dict], started_at: str) -> Dict:
+    """Собрать результаты обхода в ParseReport и поставить уведомления в очередь"""
+    from database import ParseReport, SessionLocal
+    from daily_parse import notify_new_reviews
+
+    start_time = datetime.fromisoformat(started_at)
+    successful = [r for r in results if r['status'] == 'success']
+    failed = [r for r in results if r['status'] == 'failed']
+    skipped = [r for r in results if r['status'] == 'skipped']
+    total_new_reviews = sum(r.get('new_reviews', 0) for r in results)
+    duration = (datetime.now() - start_time).total_seconds()
+
+    session = SessionLocal()
+    try:
+        session.add(ParseReport(
+            parse_date=start_time,
+            total_branches=len(results),
+            successful_branches=len(successful),
+            failed_branches=len(failed),
+            total_reviews=sum(r.get('total_reviews', 0) for r in results),
+            new_reviews=total_new_reviews,
+            updated_reviews=sum(r.get('updated_reviews', 0) for r in results),
+            duration_seconds=duration,
+            errors=str(failed)
+        ))
+        session.commit()
+    finally:
+        session.close()
+
+    logger.info(
+        f"📊 Обход завершен за {duration:.0f} сек: успешно {len(successful)}/{len(results)}, "
+        f"ошибок {len(failed)}, пропущено {len(skipped)}, новых отзывов {total_new_reviews}"
+    )
+
+    if total_new_reviews > 0:
+        notify_new_reviews()
+
+    return {
+        'successful_branches': len(successful),
+        'failed_branches': len(failed),
+        'skipped_branches': len(skipped),
+        'new_reviews': total_new_reviews,
+        'duration_seconds': duration,
+    }
+
+
+@app.task(name='crawl_queue.start_crawl')
+def start_crawl() -> Optional[str]:
+    """
+    Синхронизировать филиалы и разослать задачи обхода по шардам
+
+    Returns:
+        ID задачи finalize_crawl (None, если филиалов нет)
+    """
+    from branches_loader import load_branches_from_csv
+    from sync_branches import sync_branches_to_db
+
+    if not sync_branches_to_db():
+        logger.error("❌ Ошибка при синхронизации филиалов")
+        return None
+    branches = load_branches_from_csv()
+    if not branches:
+        logger.error("❌ Не удалось загрузить список филиалов")
+        return None
+
+    header = [
+        crawl_branch.s(dict(branch)).set(queue=queue_for_branch(branch['id_2gis']))
+        for branch in branches
+    ]
+    result = chord(header)(finalize_crawl.s(datetime.now().isoformat()))
+    logger.info(f"🚀 Разослано задач обхода: {len(header)} по {CRAWL_SHARDS} очередям")
+    return result.id
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    task = start_crawl.delay()
+    print(f"Обход поставлен в очередь: {task.id}")
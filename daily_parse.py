@@ -2,24 +2,37 @@
 # -*- coding: utf-8 -*-
 """
 Скрипт для ежедневного инкрементального парсинга отзывов.
-Добавляет в базу данных только новые отзывы.
+Добавляет в базу данных новые отзывы, обновляет измененные (по хешу
+содержимого) и отмечает удаленные из 2GIS (review_changes.py).
+
+Запуск:
+    python daily_parse.py            # новый обход
+    python daily_parse.py --resume   # продолжить прерванный обход с первого незавершенного филиала
 """
 
 import os
 import sys
 import logging
+import argparse
 from datetime import datetime, timedelta
 import time
-from typing import List, Dict, Set
-from sqlalchemy import create_engine, select, func
-from sqlalchemy.orm import sessionmaker
+from typing import List, Dict, Set, Optional
+from sqlalchemy import select, func
 from dotenv import load_dotenv
 
 from parser import TwoGISReviewsParser
-from database import Review, Branch, ParseReport
+from database import Review, Branch, ParseReport, SessionLocal, use_profile, ensure_branch, record_branch_snapshot
 from branches_loader import load_branches_from_csv
 from sync_branches import sync_branches_to_db
 from cache_manager import get_cache_manager
+from review_timeline import get_review_timeline, review_payload
+from review_events import publish_new_reviews
+from review_changes import (
+    review_values, load_review_states, is_unchanged, update_changed_reviews, mark_removed_reviews
+)
+from crawl_checkpoint import CrawlCheckpoint
+from lease_lock import LeaseLock, run_lock, branch_lock
+from rate_limiter import get_crawl_rate_limiter
 import requests
 
 # Загрузка переменных окружения
@@ -40,38 +53,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Подключение к базе данных
-DATABASE_URL = os.getenv('DATABASE_URL')
-if not DATABASE_URL:
-    logger.error("DATABASE_URL не задан в переменных окружения")
-    sys.exit(1)
-
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
 
-def get_existing_review_ids(session, branch_id: str) -> Set[str]:
+def get_existing_review_ids(session, branch_pk: int) -> Set[str]:
     """Получение множества ID существующих отзывов для филиала"""
     existing_ids = session.execute(
-        select(Review.review_id).where(Review.branch_id == branch_id)
+        select(Review.review_id).where(Review.branch_pk == branch_pk)
     ).scalars().all()
     return set(existing_ids)
 
 
-def get_latest_review_date(session, branch_id: str):
+def get_latest_review_date(session, branch_pk: int):
     """Получение даты последнего отзыва для филиала"""
     latest_date = session.execute(
-        select(func.max(Review.date_created)).where(Review.branch_id == branch_id)
+        select(func.max(Review.date_created)).where(Review.branch_pk == branch_pk)
     ).scalar()
     return latest_date
 
 
-def save_new_reviews_to_db(session, reviews: List[Dict], branch_id: str, branch_name: str, existing_ids: Set[str]) -> int:
-    """Сохранение только новых отзывов в базу данных"""
+def save_new_reviews_to_db(session, reviews: List[Dict], branch_pk: int, existing_ids: Set[str],
+                           added: Optional[List[Review]] = None) -> int:
+    """Сохранение только новых отзывов в базу данных (added — куда сложить созданные объекты)"""
     new_count = 0
     
     for review_data in reviews:
-        review_id = review_data.get('id') or review_data.get('review_id')
+        review_id = review_data.get('review_id') or review_data.get('id')
         
         # Пропускаем отзывы без ID
         if not review_id:
@@ -83,35 +88,16 @@ def save_new_reviews_to_db(session, reviews: List[Dict], branch_id: str, branch_
             continue
             
         try:
-            # Преобразование даты
-            date_str = review_data.get('date_created', '')
-            date_created = None
-            if date_str:
-                try:
-                    date_created = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                except:
-                    try:
-                        date_created = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-                    except:
-                        logger.warning(f"Не удалось распарсить дату: {date_str}")
-            
-            review = Review(
-                review_id=review_id,
-                branch_id=branch_id,
-                branch_name=branch_name,
-                user_name=review_data.get('user', {}).get('name', 'Аноним'),
-                rating=int(review_data.get('rating', 0)),
-                text=review_data.get('text', ''),
-                date_created=date_created,
-                is_verified=review_data.get('verified', False),
-                likes_count=review_data.get('likes_count', 0),
-                comments_count=review_data.get('comments_count', 0),
-                photos_count=review_data.get('photos_count', 0),
-                photos_urls=review_data.get('photos_urls', [])
-            )
+            values = review_values(review_data)
+            if values['date_created'] is None:
+                logger.warning(f"Пропущен отзыв {review_id} без даты создания")
+                continue
+            review = Review(branch_pk=branch_pk, **values)
             
             session.add(review)
             new_count += 1
+            if added is not None:
+                added.append(review)
             
         except Exception as e:
             logger.error(f"Ошибка при добавлении отзыва {review_id}: {e}")
@@ -120,40 +106,78 @@ def save_new_reviews_to_db(session, reviews: List[Dict], branch_id: str, branch_
     return new_count
 
 
-def parse_branch_incrementally(parser: TwoGISReviewsParser, branch: Dict, session) -> Dict:
-    """Инкрементальный парсинг отзывов для одного филиала"""
+def _failed_result(branch: Dict, error: str) -> Dict:
+    return {
+        'branch_name': branch['name'],
+        'branch_id': branch['id_2gis'],
+        'status': 'failed',
+        'error': error,
+        'total_reviews': 0,
+        'new_reviews': 0
+    }
+
+
+def parse_branch_incrementally(parser: TwoGISReviewsParser, branch: Dict, session,
+                               stop_when_known: bool = False, lock: Optional[LeaseLock] = None,
+                               priority: Optional[str] = None) -> Dict:
+    """
+    Инкрементальный парсинг отзывов для одного филиала
+
+    stop_when_known — остановить обход на первой странице без новых отзывов
+    (частый опрос планировщиком); без него обходятся все страницы.
+    lock — блокировка филиала: если аренда потеряна, обход прерывается
+    и ничего не записывается (филиал уже обходит новый владелец).
+    priority — приоритет квоты ключей для филиала (по умолчанию приоритет парсера).
+    """
     branch_name = branch['name']
     branch_id = branch['id_2gis']
     
     logger.info(f"🔄 Начинаем парсинг филиала: {branch_name} (ID: {branch_id})")
     
-    # Получаем существующие отзывы
-    existing_ids = get_existing_review_ids(session, branch_id)
-    latest_date = get_latest_review_date(session, branch_id)
+    # Получаем существующие отзывы (ID и хеши содержимого для сверки)
+    branch_pk = ensure_branch(session, branch_id, branch_name)
+    states = load_review_states(session, branch_pk)
+    existing_ids = set(states)
+    latest_date = get_latest_review_date(session, branch_pk)
     
     logger.info(f"  📊 В базе уже есть {len(existing_ids)} отзывов")
     if latest_date:
         logger.info(f"  📅 Последний отзыв от: {latest_date}")
     
     try:
-        # Парсим все отзывы (API 2GIS не поддерживает фильтрацию по дате)
-        all_reviews = parser.parse_all_reviews(branch_id, branch_name)
+        # API 2GIS не поддерживает фильтрацию по дате: страницы идут от новых и недавно
+        # отредактированных к старым, поэтому страница без новых и измененных — последняя нужная
+        def stop_when(page: List[Dict]) -> bool:
+            if lock is not None and lock.lost:
+                return True
+            return stop_when_known and all(
+                is_unchanged(states.get(review.get('review_id')), review) for review in page
+            )
+        
+        all_reviews = parser.parse_all_reviews(branch_id, branch_name, stop_when=stop_when, priority=priority)
+        if lock is not None and lock.lost:
+            logger.error(f"  ❌ Блокировка филиала {branch_name} потеряна, результаты обхода не сохраняются")
+            return _failed_result(branch, 'Блокировка филиала потеряна')
+        # Официальный рейтинг из meta первой страницы — без лишних запросов
+        record_branch_snapshot(session, branch_pk, parser.last_meta)
         
         if not all_reviews:
             logger.warning(f"  ⚠️  Не удалось получить отзывы для {branch_name}")
-            return {
-                'branch_name': branch_name,
-                'branch_id': branch_id,
-                'status': 'failed',
-                'error': 'Не удалось получить отзывы',
-                'total_reviews': 0,
-                'new_reviews': 0
-            }
+            return _failed_result(branch, 'Не удалось получить отзывы')
+        
+        # Новые отзывы — вставка, измененные (по хешу) — обновление только их строк
+        added = []
+        new_count = save_new_reviews_to_db(session, all_reviews, branch_pk, existing_ids, added)
+        changed = update_changed_reviews(session, all_reviews, states, branch_pk)
         
-        # Сохраняем только новые отзывы
-        new_count = save_new_reviews_to_db(session, all_reviews, branch_id, branch_name, existing_ids)
+        # Удаленные — разность множеств, только если обход дошел до последней страницы
+        removed_count = 0
+        if parser.last_walk_complete:
+            removed_count = mark_removed_reviews(session, states, (review.get('review_id') for review in all_reviews))
         
         logger.info(f"  ✅ Добавлено новых отзывов: {new_count} из {len(all_reviews)}")
+        if changed or removed_count:
+            logger.info(f"  ✏️  Изменено: {len(changed)}, удалено из 2GIS: {removed_count}")
         
         return {
             'branch_name': branch_name,
@@ -161,26 +185,127 @@ def parse_branch_incrementally(parser: TwoGISReviewsParser, branch: Dict, sessio
             'status': 'success',
             'total_reviews': len(all_reviews),
             'new_reviews': new_count,
-            'existing_reviews': len(existing_ids)
+            'updated_reviews': len(changed),
+            'removed_reviews': removed_count,
+            'existing_reviews': len(existing_ids),
+            # Для ленты Redis и SSE: собираются до коммита, пока объекты не истекли.
+            # Скрытые модерацией отзывы в ленту не попадают (как и в списки API)
+            'new_review_payloads': [
+                review_payload(review, branch_id, branch_name) for review in added if not review.hidden_reason
+            ],
+            'changed_review_payloads': [
+                review_payload(review, branch_id, branch_name) for review in changed if not review.hidden_reason
+            ],
+            # Из ленты нужно убрать отзывы: удаленные из 2GIS или скрытые после правки
+            'timeline_stale': removed_count > 0 or any(review.hidden_reason for review in changed)
         }
         
     except Exception as e:
         logger.error(f"  ❌ Ошибка при парсинге {branch_name}: {e}")
-        return {
-            'branch_name': branch_name,
-            'branch_id': branch_id,
-            'status': 'failed',
-            'error': str(e),
-            'total_reviews': 0,
-            'new_reviews': 0
-        }
+        return _failed_result(branch, str(e))
+
 
+def ingest_branch(parser: TwoGISReviewsParser, branch: Dict, session, stop_when_known: bool = False,
+                  lock: Optional[LeaseLock] = None, priority: Optional[str] = None) -> Dict:
+    """
+    Обход филиала с коммитом и публикацией новых отзывов
+    (версия данных для ETag, лента Redis, SSE). Используется daily_parse и crawl_queue.
+    Если аренда lock потеряна до коммита, изменения откатываются.
 
-def main():
+    Returns:
+        Результат parse_branch_incrementally без тел новых отзывов
+    """
+    result = parse_branch_incrementally(
+        parser, branch, session, stop_when_known=stop_when_known, lock=lock, priority=priority
+    )
+    
+    if lock is not None and lock.lost:
+        session.rollback()
+        if result['status'] == 'success':
+            logger.error(f"  ❌ Блокировка филиала {branch['name']} потеряна до коммита, изменения отменены")
+            result = _failed_result(branch, 'Блокировка филиала потеряна')
+        return result
+    
+    # Коммит после каждого филиала
+    session.commit()
+    
+    new_reviews = result.pop('new_review_payloads', [])
+    changed_reviews = result.pop('changed_review_payloads', [])
+    timeline_stale = result.pop('timeline_stale', False)
+    if timeline_stale:
+        # Лента только дописывается: без удаленных и скрытых ее перестроит первое чтение из Postgres
+        get_review_timeline().reset(result['branch_id'])
+    elif new_reviews or changed_reviews:
+        # Измененные перезаписывают свои записи в ленте; SSE — только о новых
+        get_review_timeline().add(result['branch_id'], new_reviews + changed_reviews)
+    # Новая версия данных филиала (и сброс кэша ответов) — после записи ленты,
+    # чтобы новый ETag не отдавался со старыми данными
+    if new_reviews or changed_reviews or timeline_stale or result.get('updated_reviews'):
+        get_cache_manager().bump_data_version(result['branch_id'])
+    if new_reviews:
+        publish_new_reviews(result['branch_id'], new_reviews)
+    
+    return result
+
+
+def enqueue_review_notifications():
+    """Поставить Telegram уведомления о новых отзывах в очередь"""
+    logger.info("\n📱 Добавление уведомлений в очередь...")
+    try:
+        from telegram_notifications_queue import send_notifications_for_new_reviews
+        send_notifications_for_new_reviews()
+        logger.info("✅ Telegram уведомления добавлены в очередь")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при добавлении уведомлений в очередь: {e}")
+
+
+def notify_new_reviews():
+    """Поставить уведомления о новых отзывах в очередь и очистить кэш API (после полного обхода)"""
+    enqueue_review_notifications()
+    
+    # Очистка кэша API после добавления новых отзывов
+    logger.info("\n🔄 Очистка кэша API...")
+    try:
+        # Очистка Redis кэша
+        cache = get_cache_manager()
+        if cache.is_available():
+            cache.invalidate_all_cache()
+            logger.info("✅ Redis кэш очищен")
+        
+        # Очистка API кэша через HTTP запрос
+        try:
+            response = requests.post("http://127.0.0.1:8004/api/v1/cache/clear", timeout=5)
+            if response.status_code == 200:
+                logger.info("✅ API кэш очищен")
+            else:
+                logger.warning(f"⚠️ Не удалось очистить API кэш: {response.status_code}")
+        except requests.RequestException as e:
+            logger.warning(f"⚠️ Не удалось подключиться к API для очистки кэша: {e}")
+            
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка при очистке кэша: {e}")
+
+
+def main(resume: bool = False):
+    """Ежедневный парсинг под блокировкой запуска: параллельный запуск сразу завершается"""
+    lock = run_lock('daily_parse')
+    if not lock.acquire():
+        logger.warning("⏭  Ежедневный парсинг уже выполняется в другом процессе, выходим")
+        return
+    try:
+        run_daily_parse(resume)
+    finally:
+        lock.release()
+
+
+def run_daily_parse(resume: bool = False):
     """Основная функция для ежедневного парсинга"""
     start_time = datetime.now()
     logger.info("🚀 Запуск ежедневного инкрементального парсинга отзывов")
     
+    # Один пул профиля парсера на весь процесс (включая sync_branches и уведомления)
+    use_profile('crawler')
+    
     # Синхронизация филиалов из Google Sheets
     logger.info("🔄 Синхронизация филиалов из Google Sheets...")
     if not sync_branches_to_db():
@@ -195,31 +320,56 @@ def main():
     
     logger.info(f"📋 Загружено {len(branches)} филиалов для парсинга")
     
-    # Инициализация парсера
+    # Инициализация парсера (лимит запросов общий с воркерами crawl_queue)
     parser = TwoGISReviewsParser()
+    parser.throttle = get_crawl_rate_limiter().acquire
     
     # Создание сессии БД
     session = SessionLocal()
     
+    # Контрольная точка: при --resume завершенные филиалы прошлого запуска пропускаются
+    checkpoint = CrawlCheckpoint('daily_parse', resume=resume)
+    
     try:
-        # Парсинг каждого филиала
-        results = []
-        total_new_reviews = 0
-        successful_branches = 0
+        # Парсинг каждого филиала (результаты завершенных ранее — из контрольной точки)
+        results = checkpoint.results()
+        total_new_reviews = sum(r.get('new_reviews', 0) for r in results)
+        total_updated_reviews = sum(r.get('updated_reviews', 0) for r in results)
+        successful_branches = len(results)
+        skipped_branches = 0
         
         for i, branch in enumerate(branches, 1):
-            logger.info(f"\n{'='*60}")
-            logger.info(f"Обработка филиала {i}/{len(branches)}")
+            if checkpoint.is_done(branch['id_2gis']):
+                logger.info(f"⏭  Филиал {i}/{len(branches)} {branch['name']} уже обработан в этом запуске")
+                continue
             
-            result = parse_branch_incrementally(parser, branch, session)
-            results.append(result)
+            # Филиал, который сейчас обходит другой процесс (sync_branches, ручной запуск), пропускаем
+            lock = branch_lock(branch['id_2gis'])
+            if not lock.acquire():
+                logger.info(f"⏭  Филиал {branch['name']} обходит другой процесс, пропускаем")
+                skipped_branches += 1
+                continue
             
-            if result['status'] == 'success':
-                successful_branches += 1
-                total_new_reviews += result['new_reviews']
-            
-            # Коммит после каждого филиала
-            session.commit()
+            try:
+                logger.info(f"\n{'='*60}")
+                logger.info(f"Обработка филиала {i}/{len(branches)}")
+                
+                checkpoint.start_branch(branch['id_2gis'])
+                result = ingest_branch(parser, branch, session, lock=lock)
+                
+                if result['status'] == 'success':
+                    successful_branches += 1
+                    total_new_reviews += result['new_reviews']
+                    total_updated_reviews += result.get('updated_reviews', 0)
+                
+                # Отметка после коммита: падение между ними лишь повторит филиал без дублей
+                results.append(result)
+                if result['status'] == 'success':
+                    checkpoint.complete_branch(result['branch_id'], result)
+                else:
+                    checkpoint.fail_branch(result['branch_id'], result.get('error', ''))
+            finally:
+                lock.release()
             
             # Пауза между запросами
             if i < len(branches):
@@ -233,15 +383,17 @@ def main():
             parse_date=start_time,
             total_branches=len(branches),
             successful_branches=successful_branches,
-            failed_branches=len(branches) - successful_branches,
+            failed_branches=len(branches) - successful_branches - skipped_branches,
             total_reviews=sum(r.get('total_reviews', 0) for r in results),
             new_reviews=total_new_reviews,
+            updated_reviews=total_updated_reviews,
             duration_seconds=duration,
             errors=str([r for r in results if r['status'] == 'failed'])
         )
         
         session.add(report)
         session.commit()
+        checkpoint.finish()
         
         # Итоговая статистика
         logger.info(f"\n{'='*60}")
@@ -249,7 +401,10 @@ def main():
         logger.info(f"  ⏱️  Время выполнения: {duration:.2f} сек")
         logger.info(f"  🏢 Обработано филиалов: {successful_branches}/{len(branches)}")
         logger.info(f"  📝 Добавлено новых отзывов: {total_new_reviews}")
-        logger.info(f"  ❌ Филиалов с ошибками: {len(branches) - successful_branches}")
+        logger.info(f"  ✏️  Обновлено измененных отзывов: {total_updated_reviews}")
+        logger.info(f"  ❌ Филиалов с ошибками: {len(branches) - successful_branches - skipped_branches}")
+        if skipped_branches:
+            logger.info(f"  ⏭  Пропущено (обходил другой процесс): {skipped_branches}")
         
         # Вывод филиалов с новыми отзывами
         branches_with_new = [r for r in results if r.get('new_reviews', 0) > 0]
@@ -260,35 +415,7 @@ def main():
         
         # Отправка Telegram уведомлений если есть новые отзывы
         if total_new_reviews > 0:
-            logger.info("\n📱 Добавление уведомлений в очередь...")
-            try:
-                from telegram_notifications_queue import send_notifications_for_new_reviews
-                send_notifications_for_new_reviews()
-                logger.info("✅ Telegram уведомления добавлены в очередь")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при добавлении уведомлений в очередь: {e}")
-            
-            # Очистка кэша API после добавления новых отзывов
-            logger.info("\n🔄 Очистка кэша API...")
-            try:
-                # Очистка Redis кэша
-                cache = get_cache_manager()
-                if cache.is_available():
-                    cache.invalidate_all_cache()
-                    logger.info("✅ Redis кэш очищен")
-                
-                # Очистка API кэша через HTTP запрос
-                try:
-                    response = requests.post("http://127.0.0.1:8004/api/v1/cache/clear", timeout=5)
-                    if response.status_code == 200:
-                        logger.info("✅ API кэш очищен")
-                    else:
-                        logger.warning(f"⚠️ Не удалось очистить API кэш: {response.status_code}")
-                except requests.RequestException as e:
-                    logger.warning(f"⚠️ Не удалось подключиться к API для очистки кэша: {e}")
-                    
-            except Exception as e:
-                logger.warning(f"⚠️ Ошибка при очистке кэша: {e}")
+            notify_new_reviews()
         else:
             logger.info("\n📱 Новых отзывов нет, уведомления не требуются")
         
@@ -302,4 +429,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Ежедневный инкрементальный парсинг отзывов")
+    arg_parser.add_argument('--resume', action='store_true', help="Продолжить прерванный обход")
+    args = arg_parser.parse_args()
+    main(resume=args.resume)
\ No newline at end of file
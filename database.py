@@ -1,23 +1,35 @@
-from sqlalchemy import create_engine, Column, String, Integer, Float, Boolean, DateTime, Text, Index, JSON
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, Text, Index, JSON, Computed, ForeignKey, UniqueConstraint, DDL, event, select, text as sa_text
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship, deferred
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 from datetime import datetime
+from typing import Optional
 import os
 from dotenv import load_dotenv
 
+from db_engine import DATABASE_URL, get_engine, get_async_engine, dispose_async_engines
+
 load_dotenv()
 
 # Database configuration
-DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL не найден в переменных окружения")
 
-# Create engine
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Профиль пула процесса по умолчанию (api, bot, crawler, worker, script), см. db_engine.py
+DB_PROFILE = os.getenv("DB_PROFILE", "script")
+
+# Create engine (соединения открываются только при первом запросе)
+engine = get_engine(DB_PROFILE)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+_async_session_factories = {}
+
 Base = declarative_base()
 
+# Конфигурация полнотекстового поиска Postgres для текстов отзывов
+SEARCH_CONFIG = "russian"
+
 class Branch(Base):
     __tablename__ = "branches"
     
@@ -38,14 +50,16 @@ class Branch(Base):
 class Review(Base):
     __tablename__ = "reviews"
     
-    id = Column(Integer, primary_key=True, index=True)
-    branch_id = Column(String(50), index=True, nullable=False)
-    branch_name = Column(String(255), nullable=False)
-    review_id = Column(String(100), unique=True, index=True, nullable=False)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Суррогатный ключ филиала; ID 2GIS и название хранятся только в branches
+    branch_pk = Column(Integer, ForeignKey("branches.id"), nullable=False)
+    # Уникальность в секционированной таблице возможна только вместе с ключом партиционирования
+    review_id = Column(String(100), nullable=False)
     user_name = Column(String(255))
     rating = Column(Float)
     text = Column(Text)
-    date_created = Column(DateTime)
+    # Ключ партиционирования (по месяцам), входит в первичный ключ
+    date_created = Column(DateTime, primary_key=True, default=datetime.utcnow)
     date_edited = Column(DateTime)
     is_verified = Column(Boolean, default=False)
     likes_count = Column(Integer, default=0)
@@ -53,16 +67,57 @@ class Review(Base):
     photos_count = Column(Integer, default=0)
     photos_urls = Column(JSON)  # Массив URL фотографий
     sent_to_telegram = Column(Boolean, default=False)  # Отправлено ли в Telegram
+    # Сверка с 2GIS (review_changes.py): хеш содержимого, причина скрытия модерацией,
+    # время, когда отзыв пропал из полного обхода филиала
+    content_hash = Column(String(32))
+    hidden_reason = Column(String(100))
+    removed_at = Column(DateTime)
+    # Полнотекстовый индекс текста отзыва (русская морфология), вычисляется Postgres
+    search_vector = deferred(Column(
+        TSVECTOR,
+        Computed(f"to_tsvector('{SEARCH_CONFIG}', coalesce(text, ''))", persisted=True)
+    ))
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # Indexes
+    # Indexes (по реальным запросам API, бота и аналитики; управляются migrations.py).
+    # Таблица секционирована по месяцам date_created (партиции создает partitions.py),
+    # фильтры по периоду читают только партиции нужных месяцев.
     __table_args__ = (
-        Index("idx_branch_id", "branch_id"),
+        UniqueConstraint("review_id", "date_created", name="reviews_review_id_key"),
+        Index("idx_reviews_review_id", "review_id"),
+        # Последние N отзывов филиала и отзывы филиала за период
+        Index("idx_reviews_branch_pk_date", branch_pk, date_created.desc()),
+        # Очередь уведомлений: только неотправленные отзывы
+        Index("idx_reviews_unsent", "id", postgresql_where=sa_text("sent_to_telegram = false")),
+        # created_at растет вместе с id, BRIN достаточно и он почти ничего не весит
+        Index("idx_reviews_created_at_brin", "created_at", postgresql_using="brin"),
+        Index("idx_reviews_search_vector", "search_vector", postgresql_using="gin"),
         Index("idx_rating", "rating"),
         Index("idx_date_created", "date_created"),
-        Index("idx_created_at", "created_at"),
+        # Лента изменений: WHERE (updated_at, id) > курсор ORDER BY updated_at, id
+        Index("idx_reviews_updated_at_id", "updated_at", "id"),
+        {"postgresql_partition_by": "RANGE (date_created)"},
     )
+    
+    # Филиал подгружается тем же запросом (JOIN по целочисленному ключу)
+    branch = relationship(Branch, lazy="joined", innerjoin=True)
+    
+    @property
+    def branch_id(self) -> str:
+        """ID филиала в 2GIS"""
+        return self.branch.branch_id
+    
+    @property
+    def branch_name(self) -> str:
+        return self.branch.branch_name
+
+# Партиция по умолчанию: вставка не падает, даже если партиция месяца еще не создана
+event.listen(
+    Review.__table__,
+    "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS reviews_default PARTITION OF reviews DEFAULT").execute_if(dialect="postgresql")
+)
 
 class ParseReport(Base):
     __tablename__ = "parse_reports"
@@ -79,6 +134,53 @@ class ParseReport(Base):
     duration_seconds = Column(Float)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class BranchPollSchedule(Base):
+    """Расписание опроса филиала планировщиком (poll_scheduler.py)"""
+    __tablename__ = "branch_poll_schedule"
+    
+    branch_pk = Column(Integer, ForeignKey("branches.id", ondelete="CASCADE"), primary_key=True)
+    next_poll_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_polled_at = Column(DateTime)
+    # Оценка частоты новых отзывов, отзывов в сутки
+    arrival_rate = Column(Float, default=0)
+    last_new_reviews = Column(Integer, default=0)
+    last_status = Column(String(20))
+    
+    __table_args__ = (
+        Index("idx_branch_poll_next", "next_poll_at"),
+    )
+
+class BranchSnapshot(Base):
+    """Официальный рейтинг и число отзывов филиала по данным 2GIS на момент обхода"""
+    __tablename__ = "branch_snapshots"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    branch_pk = Column(Integer, ForeignKey("branches.id", ondelete="CASCADE"), nullable=False)
+    captured_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # meta.branch_rating и meta.branch_reviews_count ответа 2GIS
+    rating = Column(Float)
+    reviews_count = Column(Integer)
+    
+    __table_args__ = (
+        Index("idx_branch_snapshots_branch_time", "branch_pk", "captured_at"),
+    )
+
+class ReviewEdit(Base):
+    """Прежние значения измененного отзыва (review_changes.py, REVIEW_EDIT_HISTORY=1)"""
+    __tablename__ = "review_edits"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    review_id = Column(String(100), nullable=False)
+    branch_pk = Column(Integer, ForeignKey("branches.id", ondelete="CASCADE"), nullable=False)
+    edited_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # Только изменившиеся поля: {"text": "...", "rating": 5.0}
+    previous = Column(JSON)
+    content_hash = Column(String(32))
+    
+    __table_args__ = (
+        Index("idx_review_edits_review_id", "review_id", "edited_at"),
+    )
+
 class TelegramUser(Base):
     __tablename__ = "telegram_users"
     
@@ -124,6 +226,69 @@ def get_db():
     finally:
         db.close()
 
+def branch_pk_for(branch_id: str):
+    """
+    Подзапрос суррогатного ключа филиала по ID 2GIS.
+    Postgres вычисляет его один раз (InitPlan), поэтому фильтр
+    Review.branch_pk == branch_pk_for(...) использует индекс по branch_pk.
+    """
+    return select(Branch.id).where(Branch.branch_id == branch_id).scalar_subquery()
+
+def ensure_branch(session, branch_id: str, branch_name: str) -> int:
+    """Получить ключ филиала по ID 2GIS, создав филиал при отсутствии"""
+    branch_pk = session.execute(
+        select(Branch.id).where(Branch.branch_id == branch_id)
+    ).scalar()
+    if branch_pk is None:
+        branch = Branch(branch_id=branch_id, branch_name=branch_name or branch_id)
+        session.add(branch)
+        session.flush()
+        branch_pk = branch.id
+    return branch_pk
+
+def record_branch_snapshot(session, branch_pk: int, meta: Optional[dict]) -> bool:
+    """Сохранить официальный рейтинг филиала из meta первой страницы обхода (без коммита)"""
+    if not meta or (meta.get('branch_rating') is None and meta.get('branch_reviews_count') is None):
+        return False
+    rating = meta.get('branch_rating')
+    session.add(BranchSnapshot(
+        branch_pk=branch_pk,
+        rating=float(rating) if rating is not None else None,
+        reviews_count=meta.get('branch_reviews_count')
+    ))
+    return True
+
+def use_profile(profile: str):
+    """
+    Переключить engine процесса на профиль его роли.
+    Вызывается в точке входа до первой работы с БД, чтобы все модули
+    процесса (SessionLocal) использовали один пул с настройками роли.
+    """
+    global engine
+    engine = get_engine(profile)
+    SessionLocal.configure(bind=engine)
+    return engine
+
+def get_async_session_factory(profile: str = "api"):
+    """Фабрика async сессий (asyncpg) для профиля"""
+    factory = _async_session_factories.get(profile)
+    if factory is None:
+        factory = async_sessionmaker(
+            get_async_engine(profile), class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+        _async_session_factories[profile] = factory
+    return factory
+
+async def dispose_async_engine():
+    """Закрыть пулы async engine (при остановке API)"""
+    _async_session_factories.clear()
+    await dispose_async_engines()
+
+async def get_async_db():
+    """FastAPI dependency: async сессия, не блокирующая event loop"""
+    async with get_async_session_factory("api")() as db:
+        yield db
+
 def init_db():
     """Initialize database tables"""
     Base.metadata.create_all(bind=engine)
@@ -0,0 +1,253 @@
+"""
+Единая фабрика подключений к базе данных с профилями по ролям процессов.
+
+Каждый процесс (API, бот, парсер, Celery воркер, разовый скрипт) получает
+свой профиль пула: размер, переполнение, pre-ping, recycle и statement_timeout.
+Engine кэшируется по профилю, поэтому модули, импортированные в один процесс,
+используют общий пул, а не создают каждый свой.
+
+Настройки профиля переопределяются переменными окружения вида
+DB_<PROFILE>_<SETTING>, например DB_API_POOL_SIZE=20 или DB_CRAWLER_STATEMENT_TIMEOUT_MS=0.
+"""
+import os
+import time
+import logging
+import threading
+from typing import Dict, Optional
+
+from sqlalchemy import create_engine, exc as sa_exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Async (asyncpg) подключение для FastAPI; по умолчанию выводится из DATABASE_URL
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or (
+    (DATABASE_URL or "")
+    .replace("postgresql+psycopg2://", "postgresql+asyncpg://", 1)
+    .replace("postgresql://", "postgresql+asyncpg://", 1)
+    .replace("postgres://", "postgresql+asyncpg://", 1)
+)
+
+# statement_timeout_ms = 0 — без ограничения (миграции, выгрузки)
+ENGINE_PROFILES: Dict[str, Dict] = {
+    'api': {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 10,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+        'statement_timeout_ms': 15000,
+    },
+    'bot': {
+        'pool_size': 5,
+        'max_overflow': 5,
+        'pool_timeout': 15,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+        'statement_timeout_ms': 30000,
+    },
+    'crawler': {
+        'pool_size': 2,
+        'max_overflow': 2,
+        'pool_timeout': 30,
+        'pool_recycle': 3600,
+        'pool_pre_ping': True,
+        'statement_timeout_ms': 120000,
+    },
+    'worker': {
+        'pool_size': 2,
+        'max_overflow': 3,
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+        'statement_timeout_ms': 60000,
+    },
+    'script': {
+        'pool_size': 1,
+        'max_overflow': 2,
+        'pool_timeout': 30,
+        'pool_recycle': 3600,
+        'pool_pre_ping': True,
+        'statement_timeout_ms': 0,
+    },
+}
+
+_engines: Dict[str, Engine] = {}
+_async_engines: Dict[str, AsyncEngine] = {}
+_pool_metrics: Dict[str, "PoolMetrics"] = {}
+_lock = threading.Lock()
+
+
+class PoolMetrics:
+    """Счетчики ожидания соединения из пула"""
+
+    def __init__(self, profile: str, settings: Dict):
+        self.profile = profile
+        self.capacity = settings['pool_size'] + max(settings['max_overflow'], 0)
+        self.engine = None
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait_seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += wait_seconds
+            self.wait_max = max(self.wait_max, wait_seconds)
+
+    def snapshot(self) -> Dict:
+        checked_out = self.engine.pool.checkedout() if self.engine is not None else 0
+        with self._lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                'profile': self.profile,
+                'capacity': self.capacity,
+                'checked_out': checked_out,
+                'utilisation': round(checked_out / self.capacity, 3) if self.capacity else 0,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': round(self.wait_total / attempts * 1000, 3) if attempts else 0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }
+
+
+class _InstrumentedPoolMixin:
+    """Замер времени ожидания соединения при checkout из пула"""
+
+    metrics: PoolMetrics = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except sa_exc.TimeoutError:
+            self.metrics.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - started)
+        return connection
+
+
+def _parse_setting(value: str, default):
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+
+def get_profile_settings(profile: str) -> Dict:
+    """Настройки профиля с учетом переопределений из окружения"""
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"Неизвестный профиль БД: {profile}. Доступны: {', '.join(ENGINE_PROFILES)}")
+
+    settings = dict(ENGINE_PROFILES[profile])
+    prefix = f"DB_{profile.upper()}_"
+    for key, default in settings.items():
+        value = os.getenv(prefix + key.upper())
+        if value is not None:
+            settings[key] = _parse_setting(value, default)
+    return settings
+
+
+def _metrics_for(key: str, settings: Dict, base_pool):
+    """Класс пула, привязанный к счетчикам профиля (переживает engine.dispose())"""
+    metrics = PoolMetrics(key, settings)
+    _pool_metrics[key] = metrics
+    pool_class = type(f"Instrumented{base_pool.__name__}", (_InstrumentedPoolMixin, base_pool), {'metrics': metrics})
+    return metrics, pool_class
+
+
+def get_engine(profile: str = 'script') -> Engine:
+    """Получить (создать при первом вызове) синхронный engine профиля"""
+    engine = _engines.get(profile)
+    if engine is not None:
+        return engine
+
+    with _lock:
+        if profile in _engines:
+            return _engines[profile]
+        if not DATABASE_URL:
+            raise ValueError("DATABASE_URL не найден в переменных окружения")
+
+        settings = get_profile_settings(profile)
+        metrics, pool_class = _metrics_for(profile, settings, QueuePool)
+
+        connect_args = {}
+        if settings['statement_timeout_ms']:
+            connect_args['options'] = f"-c statement_timeout={settings['statement_timeout_ms']}"
+
+        engine = create_engine(
+            DATABASE_URL,
+            poolclass=pool_class,
+            pool_size=settings['pool_size'],
+            max_overflow=settings['max_overflow'],
+            pool_timeout=settings['pool_timeout'],
+            pool_recycle=settings['pool_recycle'],
+            pool_pre_ping=settings['pool_pre_ping'],
+            connect_args=connect_args,
+        )
+        metrics.engine = engine
+        _engines[profile] = engine
+        logger.info(f"Создан engine БД для профиля '{profile}' (pool_size={settings['pool_size']})")
+        return engine
+
+
+def get_async_engine(profile: str = 'api') -> AsyncEngine:
+    """Получить (создать при первом вызове) async engine профиля на asyncpg"""
+    engine = _async_engines.get(profile)
+    if engine is not None:
+        return engine
+
+    with _lock:
+        if profile in _async_engines:
+            return _async_engines[profile]
+        if not DATABASE_URL:
+            raise ValueError("DATABASE_URL не найден в переменных окружения")
+
+        settings = get_profile_settings(profile)
+        metrics, pool_class = _metrics_for(f"{profile}:async", settings, AsyncAdaptedQueuePool)
+
+        server_settings = {}
+        if settings['statement_timeout_ms']:
+            server_settings['statement_timeout'] = str(settings['statement_timeout_ms'])
+
+        engine = create_async_engine(
+            ASYNC_DATABASE_URL,
+            poolclass=pool_class,
+            pool_size=settings['pool_size'],
+            max_overflow=settings['max_overflow'],
+            pool_timeout=settings['pool_timeout'],
+            pool_recycle=settings['pool_recycle'],
+            pool_pre_ping=settings['pool_pre_ping'],
+            connect_args={'server_settings': server_settings},
+        )
+        metrics.engine = engine.sync_engine
+        _async_engines[profile] = engine
+        logger.info(f"Создан async engine БД для профиля '{profile}' (pool_size={settings['pool_size']})")
+        return engine
+
+
+async def dispose_async_engines():
+    """Закрыть пулы всех async engine процесса"""
+    for profile in list(_async_engines):
+        engine = _async_engines.pop(profile)
+        _pool_metrics.pop(f"{profile}:async", None)
+        await engine.dispose()
+
+
+def get_pool_metrics(profile: Optional[str] = None) -> Dict:
+    """Метрики пулов, созданных в текущем процессе"""
+    metrics = {key: m.snapshot() for key, m in _pool_metrics.items() if m.engine is not None}
+    if profile is not None:
+        return {key: value for key, value in metrics.items() if key.split(':')[0] == profile}
+    return metrics
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Вывод планов выполнения (EXPLAIN ANALYZE) для запросов API.
+
+Запросы эндпоинтов строятся функциями из api_v2.py, остальные повторяют
+формы бота и аналитики, чтобы после изменения индексов можно было
+проверить, что планировщик их использует.
+
+Запуск:
+    python explain_queries.py                 # все запросы
+    python explain_queries.py latest_by_branch  # только выбранные
+"""
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, desc, and_
+
+import api_v2
+import database
+from database import Review, Branch, branch_pk_for
+
+
+def _pick_sample_branch_id(conn) -> str:
+    """Филиал с наибольшим числом отзывов — худший случай для планов"""
+    branch_id = conn.execute(
+        select(Branch.branch_id)
+        .join(Review, Review.branch_pk == Branch.id)
+        .group_by(Branch.branch_id)
+        .order_by(desc(func.count()))
+        .limit(1)
+    ).scalar()
+    return branch_id or ""
+
+
+def build_queries(branch_id: str) -> dict:
+    """
+    Запросы API с типичными параметрами.
+
+    Запросы эндпоинтов собираются теми же функциями api_v2 (фильтр видимых
+    отзывов, JOIN branches, порядок keyset), что и в продакшене, — иначе
+    планы не совпадали бы с реальными.
+    """
+    now = datetime.utcnow()
+    month_ago = now - timedelta(days=30)
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    branch_pk = branch_pk_for(branch_id)
+    window_start = now - timedelta(days=api_v2.LATEST_REVIEWS_WINDOW_DAYS)
+
+    return {
+        # GET /api/v1/{branch_id}/{count}, /api/v1/by-iiko/{id_iiko}/{count}
+        'latest_by_branch': api_v2._latest_reviews_query(branch_pk, 50),
+        # То же, первая попытка API: только партиции последних месяцев
+        'latest_by_branch_window': api_v2._latest_reviews_query(branch_pk, 50, window_start),
+        # POST /api/v1/reviews/latest/batch
+        'latest_batch': api_v2._latest_reviews_batch_query([branch_pk], 50, window_start),
+        # GET /api/v1/reviews?branch_id=...&date_from=...
+        'reviews_by_branch_period': api_v2._reviews_list_query(branch_id, date_from=month_ago).limit(100),
+        # GET /api/v1/reviews (без фильтров)
+        'reviews_all_latest': api_v2._reviews_list_query().limit(100),
+        # GET /api/v1/reviews/search
+        'reviews_fulltext_search': api_v2._search_query('вкусно').limit(20),
+        # GET /api/v1/reviews?search=...&search_mode=substring
+        'reviews_substring_search': api_v2._reviews_list_query(
+            search='обслуживан', search_mode='substring'
+        ).limit(100),
+        # GET /api/v1/reviews/export?branch_id=...
+        'reviews_export': api_v2._export_query(branch_id),
+        # Аналитика бота и отзывы за период
+        'analytics_period': select(Review)
+            .where(and_(
+                Review.branch_pk == branch_pk,
+                Review.date_created >= month_ago,
+                Review.date_created <= now
+            ))
+            .order_by(Review.date_created),
+        # GET /api/v1/branches
+        'branches_with_stats': api_v2._branches_query().limit(100),
+        # GET /api/v1/branches/{branch_id}/stats
+        'branch_stats': select(
+                func.count(Review.id),
+                func.avg(func.nullif(Review.rating, 0)),
+                func.max(Review.date_created)
+            )
+            .where(Review.branch_pk == branch_pk),
+        # GET /api/v1/stats — распределение оценок и отзывы по месяцам
+        'stats_rating_count': select(func.count())
+            .select_from(Review)
+            .where(Review.rating == 5),
+        'stats_month_count': select(func.count())
+            .select_from(Review)
+            .where(and_(Review.date_created >= month_start, Review.date_created < now)),
+        # GET /api/v1/stats/recent
+        'recent_activity': select(Review.date_created, Review.rating)
+            .where(Review.date_created >= now - timedelta(days=7)),
+        # GET /api/v1/reviews/{review_id}
+        'review_by_id': select(Review)
+            .where(Review.review_id == '0')
+            .limit(1),
+        # GET /api/v1/changes?cursor=...
+        'change_feed': api_v2._change_feed_query((month_ago, 0)).limit(501),
+        # Очередь Telegram уведомлений
+        'unsent_reviews': select(Review)
+            .where(Review.sent_to_telegram == False),
+    }
+
+
+def explain(conn, name: str, statement) -> str:
+    """Выполнить EXPLAIN ANALYZE для запроса и вернуть план текстом"""
+    compiled = statement.compile(conn)
+    rows = conn.exec_driver_sql(
+        "EXPLAIN (ANALYZE, BUFFERS, FORMAT TEXT) " + str(compiled),
+        compiled.params
+    ).all()
+    return "\n".join(row[0] for row in rows)
+
+
+def main():
+    selected = set(sys.argv[1:])
+
+    database.use_profile('script')
+    with database.engine.connect() as conn:
+        branch_id = _pick_sample_branch_id(conn)
+        queries = build_queries(branch_id)
+
+        unknown = selected - set(queries)
+        if unknown:
+            print(f"❌ Неизвестные запросы: {', '.join(sorted(unknown))}")
+            print(f"Доступны: {', '.join(queries)}")
+            sys.exit(1)
+
+        print(f"Филиал для примеров: {branch_id or '(нет данных)'}")
+        for name, statement in queries.items():
+            if selected and name not in selected:
+                continue
+            print(f"\n{'='*60}")
+            print(f"📋 {name}")
+            print('='*60)
+            try:
+                print(explain(conn, name, statement))
+            except Exception as e:
+                print(f"❌ Ошибка: {e}")
+            finally:
+                # EXPLAIN ANALYZE выполняет запрос; не оставляем транзакцию открытой
+                conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
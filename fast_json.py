@@ -0,0 +1,53 @@
+"""
+Быстрая JSON-сериализация ответов API.
+
+Используется orjson (в разы быстрее stdlib json и сам кодирует datetime);
+без него — stdlib json в том же формате: datetime в ISO 8601, как у Pydantic.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _orjson_default(value: Any):
+    # orjson сам кодирует datetime, но не Decimal (avg() из Postgres)
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError
+
+
+def dumps(content: Any) -> bytes:
+    """Сериализовать в JSON (UTF-8 байты)"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def loads(data):
+    """Разобрать JSON (строка или байты)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse с сериализацией через orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
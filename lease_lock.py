@@ -0,0 +1,141 @@
+"""
+Распределенная блокировка-аренда в Redis для задач парсинга.
+
+Блокировка — ключ lock:{name} со случайным токеном и TTL. Пока владелец
+жив, фоновый поток продлевает аренду (heartbeat); если процесс упал или
+завис, ключ истекает через TTL и блокировку может взять другой запуск.
+Снять или продлить блокировку может только владелец токена.
+
+Используется на двух уровнях:
+    run:{job}           — один запуск daily_parse / sync_branches одновременно;
+    crawl:{branch_id}   — обход филиала; параллельный запуск пропускает
+                          филиал, который уже обходит другой процесс.
+
+Без Redis блокировка считается взятой: задачи работают как раньше, без координации.
+"""
+import os
+import uuid
+import logging
+import threading
+from typing import Optional
+
+from cache_manager import CacheManager, get_cache_manager
+
+logger = logging.getLogger(__name__)
+
+# Время жизни аренды без продления, секунд
+LOCK_TTL = int(os.getenv("LEASE_LOCK_TTL", "60"))
+
+# KEYS: lock; ARGV: token, ttl_ms
+_EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lock; ARGV: token
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LockNotAcquired(Exception):
+    """Блокировку держит другой процесс (with LeaseLock(...) не выполняет блок)"""
+
+
+class LeaseLock:
+    """Аренда ключа lock:{name} с продлением в фоновом потоке"""
+
+    def __init__(self, name: str, ttl: int = LOCK_TTL, cache: Optional[CacheManager] = None):
+        self.name = name
+        self.ttl = ttl
+        self.cache = cache or get_cache_manager()
+        self.key = self.cache._make_key('lock', name)
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+        # Аренда истекла или перехвачена, пока задача еще работала
+        self.lost = False
+        self._coordinated = False
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def acquire(self) -> bool:
+        """
+        Взять блокировку без ожидания
+
+        Returns:
+            False, если блокировку держит другой процесс
+        """
+        if not self.cache.is_available():
+            logger.warning(f"Redis недоступен, {self.name} выполняется без блокировки")
+            self.acquired = True
+            return True
+
+        try:
+            if not self.cache.redis_client.set(self.key, self.token, nx=True, px=self.ttl * 1000):
+                return False
+        except Exception as e:
+            logger.error(f"Ошибка взятия блокировки {self.name}: {str(e)}")
+            self.acquired = True
+            return True
+
+        self.acquired = True
+        self._coordinated = True
+        self._stop.clear()
+        self._heartbeat = threading.Thread(
+            target=self._renew, name=f"lease-{self.name}", daemon=True
+        )
+        self._heartbeat.start()
+        return True
+
+    def _renew(self):
+        extend = self.cache.redis_client.register_script(_EXTEND_SCRIPT)
+        interval = max(self.ttl / 3, 1)
+        while not self._stop.wait(interval):
+            try:
+                if not extend(keys=[self.key], args=[self.token, self.ttl * 1000]):
+                    self.lost = True
+                    logger.error(f"Блокировка {self.name} потеряна: аренда истекла или перехвачена")
+                    return
+            except Exception as e:
+                # Временная ошибка Redis: следующая попытка до истечения TTL
+                logger.warning(f"Не удалось продлить блокировку {self.name}: {str(e)}")
+
+    def release(self):
+        """Снять блокировку (только свою)"""
+        if not self.acquired:
+            return
+        self.acquired = False
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        if not self._coordinated:
+            return
+        self._coordinated = False
+        try:
+            self.cache.redis_client.register_script(_RELEASE_SCRIPT)(keys=[self.key], args=[self.token])
+        except Exception as e:
+            logger.error(f"Ошибка снятия блокировки {self.name}: {str(e)}")
+
+    def __enter__(self) -> "LeaseLock":
+        if not self.acquire():
+            raise LockNotAcquired(f"Блокировку {self.name} держит другой процесс")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+def run_lock(job: str) -> LeaseLock:
+    """Блокировка запуска задачи целиком"""
+    return LeaseLock(f"run:{job}")
+
+
+def branch_lock(branch_id: str) -> LeaseLock:
+    """Блокировка обхода одного филиала"""
+    return LeaseLock(f"crawl:{branch_id}")
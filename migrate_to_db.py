@@ -8,8 +8,11 @@ import json
 import glob
 from datetime import datetime
 from sqlalchemy.orm import Session
-from database import engine, Branch, Review, ParseReport, init_db
+import database
+from database import Branch, Review, ParseReport, init_db, ensure_branch
 import pandas as pd
+from cache_manager import get_cache_manager
+from review_timeline import get_review_timeline
 
 def parse_datetime(date_str):
     """Parse datetime string to datetime object"""
@@ -39,7 +42,7 @@ def migrate_branches_from_csv():
         print(f"Branches CSV file not found: {csv_path}")
         return 0
     
-    session = Session(engine)
+    session = Session(database.engine)
     added_count = 0
     
     try:
@@ -73,7 +76,7 @@ def migrate_branches_from_csv():
 
 def migrate_reviews_from_csv(csv_file):
     """Migrate reviews from a single CSV file to database"""
-    session = Session(engine)
+    session = Session(database.engine)
     added_count = 0
     updated_count = 0
     
@@ -94,11 +97,13 @@ def migrate_reviews_from_csv(csv_file):
                     existing.comments_count = int(row.get('comments_count', 0))
                     existing.date_edited = parse_datetime(row.get('date_edited'))
                     updated_count += 1
+                elif not parse_datetime(row.get('date_created')):
+                    # Дата создания входит в ключ уникальности — без нее отзыв не переносится
+                    print(f"Skipped review {row.get('review_id', '')} without date_created")
                 else:
                     # Add new review
                     review = Review(
-                        branch_id=row.get('branch_id', ''),
-                        branch_name=row.get('branch_name', ''),
+                        branch_pk=ensure_branch(session, row.get('branch_id', ''), row.get('branch_name', '')),
                         review_id=row.get('review_id', ''),
                         user_name=row.get('user_name', 'Аноним'),
                         rating=float(row['rating']) if row.get('rating') else None,
@@ -124,7 +129,7 @@ def migrate_reviews_from_csv(csv_file):
 
 def migrate_reviews_from_json(json_file):
     """Migrate reviews from a single JSON file to database"""
-    session = Session(engine)
+    session = Session(database.engine)
     added_count = 0
     updated_count = 0
     
@@ -146,11 +151,13 @@ def migrate_reviews_from_json(json_file):
                 existing.comments_count = row.get('comments_count', 0)
                 existing.date_edited = parse_datetime(row.get('date_edited'))
                 updated_count += 1
+            elif not parse_datetime(row.get('date_created')):
+                # Дата создания входит в ключ уникальности — без нее отзыв не переносится
+                print(f"Skipped review {row.get('review_id', '')} without date_created")
             else:
                 # Add new review
                 review = Review(
-                    branch_id=row.get('branch_id', ''),
-                    branch_name=row.get('branch_name', ''),
+                    branch_pk=ensure_branch(session, row.get('branch_id', ''), row.get('branch_name', '')),
                     review_id=row.get('review_id', ''),
                     user_name=row.get('user_name', 'Аноним'),
                     rating=row.get('rating'),
@@ -178,6 +185,7 @@ def main():
     """Main migration function"""
     print("Starting database migration...")
     start_time = datetime.utcnow()
+    database.use_profile('script')
     
     # Initialize database
     print("Creating database tables...")
@@ -213,9 +221,14 @@ def main():
         total_added += added
         total_updated += updated
     
+    # Data was loaded outside of the daily ingest: drop data versions so API ETags change,
+    # and drop review timelines so the API rebuilds them from the database
+    get_cache_manager().reset_data_versions()
+    get_review_timeline().reset()
+    
     # Create migration report
     duration = (datetime.utcnow() - start_time).total_seconds()
-    session = Session(engine)
+    session = Session(database.engine)
     
     try:
         report = ParseReport(
@@ -240,7 +253,7 @@ def main():
     print(f"Total reviews updated: {total_updated}")
     
     # Show database statistics
-    session = Session(engine)
+    session = Session(database.engine)
     try:
         total_branches = session.query(Branch).count()
         total_reviews = session.query(Review).count()
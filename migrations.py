@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Версионированные миграции схемы базы данных.
+
+Каждая миграция — список SQL-выражений, которые выполняются один раз
+и фиксируются в таблице schema_migrations. Выражения пишутся идемпотентно
+(IF EXISTS / IF NOT EXISTS), чтобы миграции можно было безопасно применять
+и к базе, созданной через init_db(), и к давно работающей базе.
+
+Запуск:
+    python migrations.py              # применить все новые миграции
+    python migrations.py --list       # показать статус миграций
+    python migrations.py --contract   # также применить contract-миграции
+
+Изменения схемы без простоя делаются в два шага: expand-миграции
+(новые колонки, триггеры совместимости, backfill) применяются до выкладки
+кода, contract-миграции (удаление старых колонок) — после того, как
+все процессы перезапущены с новым кодом.
+"""
+import sys
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, List, Set
+
+from sqlalchemy import text, inspect
+
+import database
+from database import Base, Review
+from partitions import ensure_future_partitions, create_index, insert_columns
+
+logger = logging.getLogger(__name__)
+
+
+def _copy_reviews_to_partitioned(conn):
+    """Перенос всех строк reviews в reviews_partitioned (колонки — по текущей схеме reviews)"""
+    columns = insert_columns(conn)
+    conn.execute(text(f"INSERT INTO reviews_partitioned ({columns}) SELECT {columns} FROM reviews"))
+
+
+# Порядок важен: миграции применяются сверху вниз.
+# transactional=False — выражения выполняются в autocommit
+# (нужно для CREATE/DROP INDEX CONCURRENTLY, не блокирующих запись).
+# optional=True — ошибка не останавливает остальные миграции,
+# миграция не фиксируется и будет повторена при следующем запуске.
+# contract=True — применяется только с флагом --contract; без него
+# пропускается, а следующие миграции применяются дальше.
+# requires=[...] — миграция ждет применения перечисленных (например,
+# перестройка таблицы, которой нужна схема после contract-миграции).
+# Выражение может быть функцией от соединения — для шагов, зависящих от
+# текущей схемы (например, индекс по партициям секционированной таблицы).
+MIGRATIONS: List[Dict] = [
+    {
+        'id': '0001_review_query_indexes',
+        'description': 'Составные и частичные индексы reviews под реальные запросы, удаление дублей',
+        'transactional': False,
+        'statements': [
+            # Уникальность review_id держим одним индексом (ограничение reviews_review_id_key)
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS reviews_review_id_key ON reviews (review_id)",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_reviews_review_id",
+            # Дубль первичного ключа
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_reviews_id",
+            # Последние N отзывов филиала / отзывы филиала за период
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reviews_branch_date "
+            "ON reviews (branch_id, date_created DESC)",
+            # branch_id был проиндексирован дважды, оба индекса покрываются составным
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_reviews_branch_id",
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_branch_id",
+            # Очередь уведомлений читает только неотправленные отзывы
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reviews_unsent "
+            "ON reviews (id) WHERE sent_to_telegram = false",
+            # created_at монотонно растет — BRIN вместо полноразмерного B-tree
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reviews_created_at_brin "
+            "ON reviews USING brin (created_at)",
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_created_at",
+            "ANALYZE reviews",
+        ],
+    },
+    {
+        'id': '0002_review_fulltext_search',
+        'description': 'Полнотекстовый поиск по отзывам: tsvector (russian) + GIN индекс',
+        'transactional': False,
+        'statements': [
+            # Генерируемая колонка: Postgres сам поддерживает ее актуальной при INSERT/UPDATE
+            "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS search_vector tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('russian', coalesce(text, ''))) STORED",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reviews_search_vector "
+            "ON reviews USING gin (search_vector)",
+        ],
+    },
+    {
+        'id': '0003_review_trigram_search',
+        'description': 'Триграммный индекс для поиска подстрок (search_mode=substring)',
+        'transactional': False,
+        # Расширение pg_trgm может быть недоступно без прав суперпользователя
+        'optional': True,
+        'statements': [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            # На секционированной reviews — ON ONLY + CONCURRENTLY по партициям (см. partitions.create_index)
+            lambda conn: create_index(conn, "idx_reviews_text_trgm", "USING gin (text gin_trgm_ops)"),
+        ],
+    },
+    {
+        'id': '0004_review_branch_fk_expand',
+        'description': 'reviews.branch_pk (integer FK на branches) + триггер совместимости со старым кодом',
+        'transactional': True,
+        'statements': [
+            "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS branch_pk INTEGER",
+            # Новый код не пишет branch_id/branch_name — снимаем NOT NULL (только метаданные)
+            "ALTER TABLE reviews ALTER COLUMN branch_id DROP NOT NULL",
+            "ALTER TABLE reviews ALTER COLUMN branch_name DROP NOT NULL",
+            # У каждого отзыва должен быть филиал в branches
+            "INSERT INTO branches (branch_id, branch_name, created_at, updated_at) "
+            "SELECT DISTINCT ON (r.branch_id) r.branch_id, r.branch_name, now(), now() "
+            "FROM reviews r WHERE r.branch_id IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM branches b WHERE b.branch_id = r.branch_id) "
+            "ORDER BY r.branch_id, r.id DESC "
+            "ON CONFLICT (branch_id) DO NOTHING",
+            # Пока старый и новый код работают одновременно, триггер заполняет недостающие колонки
+            """
+            CREATE OR REPLACE FUNCTION reviews_sync_branch_columns() RETURNS trigger AS $$
+            BEGIN
+                IF NEW.branch_pk IS NULL AND NEW.branch_id IS NOT NULL THEN
+                    SELECT id INTO NEW.branch_pk FROM branches WHERE branch_id = NEW.branch_id;
+                ELSIF NEW.branch_id IS NULL AND NEW.branch_pk IS NOT NULL THEN
+                    SELECT branch_id, branch_name INTO NEW.branch_id, NEW.branch_name
+                    FROM branches WHERE id = NEW.branch_pk;
+                END IF;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS reviews_sync_branch_columns ON reviews",
+            "CREATE TRIGGER reviews_sync_branch_columns BEFORE INSERT OR UPDATE OF branch_id, branch_pk "
+            "ON reviews FOR EACH ROW EXECUTE FUNCTION reviews_sync_branch_columns()",
+            # NOT VALID — без полной проверки таблицы под блокировкой
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'reviews_branch_pk_fkey') THEN
+                    ALTER TABLE reviews ADD CONSTRAINT reviews_branch_pk_fkey
+                        FOREIGN KEY (branch_pk) REFERENCES branches (id) NOT VALID;
+                END IF;
+            END
+            $$
+            """,
+        ],
+    },
+    {
+        'id': '0005_review_branch_fk_backfill',
+        'description': 'Заполнение reviews.branch_pk пачками, индекс, проверка FK и NOT NULL',
+        'transactional': False,
+        'statements': [
+            # Филиалы отзывов, записанных старым кодом после 0004
+            "INSERT INTO branches (branch_id, branch_name, created_at, updated_at) "
+            "SELECT DISTINCT ON (r.branch_id) r.branch_id, r.branch_name, now(), now() "
+            "FROM reviews r WHERE r.branch_pk IS NULL AND r.branch_id IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM branches b WHERE b.branch_id = r.branch_id) "
+            "ORDER BY r.branch_id, r.id DESC "
+            "ON CONFLICT (branch_id) DO NOTHING",
+            # Диапазоны id по 5000 с COMMIT после каждого — без длинных блокировок
+            # и без повторного сканирования таблицы; пачка без совпадений не обрывает обход
+            """
+            DO $$
+            DECLARE
+                last_id bigint;
+                max_id bigint;
+            BEGIN
+                SELECT min(id) - 1, max(id) INTO last_id, max_id FROM reviews WHERE branch_pk IS NULL;
+                WHILE last_id < max_id LOOP
+                    UPDATE reviews r SET branch_pk = b.id
+                    FROM branches b
+                    WHERE r.id > last_id AND r.id <= last_id + 5000
+                      AND r.branch_pk IS NULL
+                      AND b.branch_id = r.branch_id;
+                    last_id := last_id + 5000;
+                    COMMIT;
+                END LOOP;
+            END
+            $$
+            """,
+            # Отзывы без филиала (branch_id IS NULL) не дадут установить NOT NULL — понятная ошибка
+            """
+            DO $$
+            DECLARE
+                unmatched bigint;
+            BEGIN
+                SELECT count(*) INTO unmatched FROM reviews WHERE branch_pk IS NULL;
+                IF unmatched > 0 THEN
+                    RAISE EXCEPTION '% отзывов без филиала (branch_id IS NULL): исправьте их и повторите миграцию',
+                        unmatched;
+                END IF;
+            END
+            $$
+            """,
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reviews_branch_pk_date "
+            "ON reviews (branch_pk, date_created DESC)",
+            "ALTER TABLE reviews VALIDATE CONSTRAINT reviews_branch_pk_fkey",
+            # NOT NULL через проверенный CHECK: SET NOT NULL не сканирует таблицу повторно
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'reviews_branch_pk_not_null') THEN
+                    ALTER TABLE reviews ADD CONSTRAINT reviews_branch_pk_not_null
+                        CHECK (branch_pk IS NOT NULL) NOT VALID;
+                END IF;
+            END
+            $$
+            """,
+            "ALTER TABLE reviews VALIDATE CONSTRAINT reviews_branch_pk_not_null",
+            "ALTER TABLE reviews ALTER COLUMN branch_pk SET NOT NULL",
+            "ALTER TABLE reviews DROP CONSTRAINT IF EXISTS reviews_branch_pk_not_null",
+            "ANALYZE reviews",
+        ],
+    },
+    {
+        'id': '0006_review_branch_fk_contract',
+        'description': 'Удаление reviews.branch_id/branch_name и триггера совместимости',
+        'transactional': True,
+        'contract': True,
+        'statements': [
+            "DROP TRIGGER IF EXISTS reviews_sync_branch_columns ON reviews",
+            "DROP FUNCTION IF EXISTS reviews_sync_branch_columns()",
+            "DROP INDEX IF EXISTS idx_reviews_branch_date",
+            "ALTER TABLE reviews DROP COLUMN IF EXISTS branch_id",
+            "ALTER TABLE reviews DROP COLUMN IF EXISTS branch_name",
+        ],
+    },
+    {
+        'id': '0007_review_monthly_partitions',
+        'description': 'Секционирование reviews по месяцам date_created (перенос данных в одной транзакции)',
+        'transactional': True,
+        # Таблица копируется через LIKE reviews: старые колонки branch_id/branch_name должны быть удалены
+        'requires': ['0006_review_branch_fk_contract'],
+        'statements': [
+            # Чтение продолжает работать, запись ждет окончания переноса
+            "LOCK TABLE reviews IN EXCLUSIVE MODE",
+            # Ключ партиционирования не может быть NULL
+            "UPDATE reviews SET date_created = coalesce(created_at, now()) WHERE date_created IS NULL",
+            "CREATE TABLE reviews_partitioned "
+            "(LIKE reviews INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE) "
+            "PARTITION BY RANGE (date_created)",
+            "ALTER TABLE reviews_partitioned ALTER COLUMN date_created SET NOT NULL",
+            "CREATE TABLE reviews_partitioned_default PARTITION OF reviews_partitioned DEFAULT",
+            # Партиции от первого месяца с отзывами до трех месяцев вперед (имена как в partitions.py)
+            """
+            DO $$
+            DECLARE
+                month_start date;
+                last_month date := (date_trunc('month', now()) + interval '3 months')::date;
+            BEGIN
+                SELECT date_trunc('month', coalesce(min(date_created), now()))::date INTO month_start FROM reviews;
+                WHILE month_start <= last_month LOOP
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF reviews_partitioned FOR VALUES FROM (%L) TO (%L)',
+                        'reviews_y' || to_char(month_start, 'YYYY') || 'm' || to_char(month_start, 'MM'),
+                        month_start,
+                        (month_start + interval '1 month')::date
+                    );
+                    month_start := (month_start + interval '1 month')::date;
+                END LOOP;
+            END
+            $$
+            """,
+            # Колонки берутся из живой таблицы: 0010 (content_hash, hidden_reason, removed_at)
+            # может быть применена раньше, и ее значения должны перенестись
+            _copy_reviews_to_partitioned,
+            # Последовательность id переходит к новой таблице, иначе удалится вместе со старой
+            "ALTER SEQUENCE reviews_id_seq OWNED BY reviews_partitioned.id",
+            "DROP TABLE reviews",
+            "ALTER TABLE reviews_partitioned RENAME TO reviews",
+            "ALTER TABLE reviews_partitioned_default RENAME TO reviews_default",
+            # Ограничения и индексы на родительской таблице распространяются на все партиции
+            "ALTER TABLE reviews ADD CONSTRAINT reviews_pkey PRIMARY KEY (id, date_created)",
+            "ALTER TABLE reviews ADD CONSTRAINT reviews_review_id_key UNIQUE (review_id, date_created)",
+            "ALTER TABLE reviews ADD CONSTRAINT reviews_branch_pk_fkey "
+            "FOREIGN KEY (branch_pk) REFERENCES branches (id)",
+            "CREATE INDEX idx_reviews_review_id ON reviews (review_id)",
+            "CREATE INDEX idx_reviews_branch_pk_date ON reviews (branch_pk, date_created DESC)",
+            "CREATE INDEX idx_reviews_unsent ON reviews (id) WHERE sent_to_telegram = false",
+            "CREATE INDEX idx_reviews_created_at_brin ON reviews USING brin (created_at)",
+            "CREATE INDEX idx_reviews_search_vector ON reviews USING gin (search_vector)",
+            "CREATE INDEX idx_rating ON reviews (rating)",
+            "CREATE INDEX idx_date_created ON reviews (date_created)",
+            # Триграммный индекс — только если 0003 смогла установить pg_trgm
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                    CREATE INDEX idx_reviews_text_trgm ON reviews USING gin (text gin_trgm_ops);
+                END IF;
+            END
+            $$
+            """,
+            "ANALYZE reviews",
+        ],
+    },
+    {
+        'id': '0008_review_change_feed_index',
+        'description': 'Индекс (updated_at, id) для ленты изменений /api/v1/changes',
+        'transactional': True,
+        # Индекс строится на секционированной таблице: 0007 индексы не переносит
+        'requires': ['0007_review_monthly_partitions'],
+        'statements': [
+            # Лента изменений не видит строк без updated_at
+            "UPDATE reviews SET updated_at = coalesce(created_at, now()) WHERE updated_at IS NULL",
+            # Секционированная таблица не поддерживает CONCURRENTLY на родителе;
+            # построение блокирует только запись, чтение продолжается
+            "CREATE INDEX IF NOT EXISTS idx_reviews_updated_at_id ON reviews (updated_at, id)",
+        ],
+    },
+    {
+        'id': '0009_branch_poll_schedule',
+        'description': 'Расписание адаптивного опроса филиалов (next_poll_at)',
+        'transactional': True,
+        'statements': [
+            """
+            CREATE TABLE IF NOT EXISTS branch_poll_schedule (
+                branch_pk integer PRIMARY KEY REFERENCES branches(id) ON DELETE CASCADE,
+                next_poll_at timestamp NOT NULL DEFAULT now(),
+                last_polled_at timestamp,
+                arrival_rate double precision DEFAULT 0,
+                last_new_reviews integer DEFAULT 0,
+                last_status varchar(20)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_branch_poll_next ON branch_poll_schedule (next_poll_at)",
+        ],
+    },
+    {
+        'id': '0010_review_change_detection',
+        'description': 'Хеш содержимого, hidden_reason и removed_at отзывов, история правок review_edits',
+        'transactional': True,
+        'statements': [
+            # Nullable-колонки без значения по умолчанию: только изменение каталога, без перезаписи;
+            # на секционированной таблице добавляются во все партиции.
+            # Хеши существующих отзывов проставит первый полный обход.
+            # Не ждет contract-миграции 0006: если 0007 применится позже, она перенесет
+            # эти колонки вместе со значениями
+            "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS content_hash varchar(32)",
+            "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS hidden_reason varchar(100)",
+            "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS removed_at timestamp",
+            """
+            CREATE TABLE IF NOT EXISTS review_edits (
+                id serial PRIMARY KEY,
+                review_id varchar(100) NOT NULL,
+                branch_pk integer NOT NULL REFERENCES branches(id) ON DELETE CASCADE,
+                edited_at timestamp NOT NULL DEFAULT now(),
+                previous json,
+                content_hash varchar(32)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_review_edits_review_id ON review_edits (review_id, edited_at)",
+        ],
+    },
+    {
+        'id': '0011_branch_snapshots',
+        'description': 'Официальный рейтинг филиала по данным 2GIS на каждый обход (branch_snapshots)',
+        'transactional': True,
+        'statements': [
+            """
+            CREATE TABLE IF NOT EXISTS branch_snapshots (
+                id serial PRIMARY KEY,
+                branch_pk integer NOT NULL REFERENCES branches(id) ON DELETE CASCADE,
+                captured_at timestamp NOT NULL DEFAULT now(),
+                rating double precision,
+                reviews_count integer
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_branch_snapshots_branch_time ON branch_snapshots (branch_pk, captured_at)",
+        ],
+    },
+]
+
+
+def _ensure_migrations_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "id VARCHAR(100) PRIMARY KEY, "
+        "description TEXT, "
+        "applied_at TIMESTAMP NOT NULL)"
+    ))
+
+
+def get_applied_migrations() -> Set[str]:
+    """Получить множество ID уже примененных миграций"""
+    with database.engine.begin() as conn:
+        _ensure_migrations_table(conn)
+        rows = conn.execute(text("SELECT id FROM schema_migrations")).scalars().all()
+    return set(rows)
+
+
+def _stamp_migration(migration: Dict):
+    """Зафиксировать миграцию в schema_migrations"""
+    with database.engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO schema_migrations (id, description, applied_at) VALUES (:id, :description, :applied_at)"),
+            {'id': migration['id'], 'description': migration['description'], 'applied_at': datetime.utcnow()}
+        )
+
+
+def _execute_statement(conn, statement):
+    if callable(statement):
+        statement(conn)
+    else:
+        conn.execute(text(statement))
+
+
+def apply_migration(migration: Dict):
+    """Применить одну миграцию и зафиксировать ее в schema_migrations"""
+    if migration.get('transactional', True):
+        with database.engine.begin() as conn:
+            for statement in migration['statements']:
+                _execute_statement(conn, statement)
+    else:
+        with database.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for statement in migration['statements']:
+                _execute_statement(conn, statement)
+
+    _stamp_migration(migration)
+
+
+def apply_migrations(include_contract: bool = False) -> List[str]:
+    """
+    Применить все новые миграции по порядку
+
+    Args:
+        include_contract: Применять contract-миграции (после выкладки нового кода)
+
+    Returns:
+        Список ID примененных миграций
+    """
+    fresh_database = not inspect(database.engine).has_table(Review.__tablename__)
+
+    # Отсутствующие таблицы создаются из моделей, остальное — миграциями
+    Base.metadata.create_all(bind=database.engine)
+
+    applied = get_applied_migrations()
+    newly_applied = []
+
+    if fresh_database:
+        # Схема только что создана по текущим моделям — обязательные миграции уже отражены в ней
+        for migration in MIGRATIONS:
+            if migration['id'] not in applied and not migration.get('optional'):
+                _stamp_migration(migration)
+                applied.add(migration['id'])
+        logger.info("Новая база данных: схема создана по моделям, миграции отмечены как примененные")
+
+    for migration in MIGRATIONS:
+        if migration['id'] in applied:
+            continue
+
+        if migration.get('contract') and not include_contract:
+            logger.info(f"⏸ Миграция {migration['id']} (contract) ждет запуска с --contract после выкладки кода")
+            continue
+
+        waiting = [required for required in migration.get('requires', []) if required not in applied]
+        if waiting:
+            logger.info(f"⏸ Миграция {migration['id']} ждет применения {', '.join(waiting)}")
+            continue
+
+        logger.info(f"Применение миграции {migration['id']}: {migration['description']}")
+        try:
+            apply_migration(migration)
+        except Exception as e:
+            if not migration.get('optional'):
+                raise
+            logger.warning(f"⚠️ Необязательная миграция {migration['id']} пропущена: {e}")
+            continue
+        applied.add(migration['id'])
+        newly_applied.append(migration['id'])
+        logger.info(f"✅ Миграция {migration['id']} применена")
+
+    if not newly_applied:
+        logger.info("Новых миграций нет")
+
+    if '0007_review_monthly_partitions' in applied:
+        ensure_future_partitions()
+
+    return newly_applied
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    arg_parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    arg_parser.add_argument('--list', action='store_true', help="Показать статус миграций и выйти")
+    arg_parser.add_argument('--contract', action='store_true',
+                            help="Применить contract-миграции (только после перезапуска всех процессов с новым кодом)")
+    args = arg_parser.parse_args()
+
+    database.use_profile('script')
+    if args.list:
+        applied = get_applied_migrations()
+        for migration in MIGRATIONS:
+            status = "✅" if migration['id'] in applied else "⏳"
+            print(f"{status} {migration['id']} — {migration['description']}")
+        return
+
+    try:
+        apply_migrations(include_contract=args.contract)
+    except Exception as e:
+        logger.error(f"❌ Ошибка применения миграций: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
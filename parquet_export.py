@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Инкрементальная выгрузка отзывов в Parquet для офлайн-аналитики.
+
+Набор данных секционирован по месяцу date_created (Hive-разметка):
+
+    output/parquet/reviews/month=2025-01/part-20250201T030000-0.parquet
+
+Строковые колонки с повторяющимися значениями (филиал, имя автора) пишутся
+со словарным кодированием. Каждый запуск дописывает новые файлы только
+с отзывами, измененными после прошлой выгрузки (водяной знак по
+updated_at, id в _watermark.json). Измененный отзыв может оказаться в
+нескольких файлах — read_reviews() оставляет последнюю версию, --compact
+переписывает каждый месяц в один файл без дублей.
+
+Скрытые модерацией (hidden_reason) и удаленные из 2GIS (removed_at) отзывы
+выгружаются с этими отметками: их смена двигает updated_at, и строка попадает
+в следующую выгрузку. В файлах, записанных до появления колонок, они пустые —
+для полной картины один раз запустите --full.
+
+Запуск:
+    python parquet_export.py             # дописать изменения с прошлой выгрузки
+    python parquet_export.py --full      # выгрузить все заново
+    python parquet_export.py --compact   # склеить файлы месяцев
+
+Чтение:
+    from parquet_export import read_reviews
+    df = read_reviews(columns=['branch_name', 'rating'], date_from=datetime(2025, 1, 1))
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import select, and_, or_
+
+import database
+from database import Review, Branch
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.path.join(os.getenv("PARQUET_EXPORT_DIR", "output/parquet"), "reviews")
+WATERMARK_FILE = "_watermark.json"
+
+# Строк за одно чтение из серверного курсора
+CHUNK_SIZE = 10000
+# Отзывы, измененные в последние минуты, ждут следующего запуска: транзакция,
+# начатая раньше, может зафиксироваться с меньшим updated_at уже после выгрузки
+EXPORT_LAG = timedelta(minutes=5)
+
+REVIEW_SCHEMA = pa.schema([
+    ("review_id", pa.string()),
+    ("branch_id", pa.string()),
+    ("branch_name", pa.string()),
+    ("user_name", pa.string()),
+    ("rating", pa.float64()),
+    ("text", pa.string()),
+    ("date_created", pa.timestamp("us")),
+    ("date_edited", pa.timestamp("us")),
+    ("is_verified", pa.bool_()),
+    ("likes_count", pa.int32()),
+    ("comments_count", pa.int32()),
+    ("photos_count", pa.int32()),
+    ("photos_urls", pa.list_(pa.string())),
+    ("hidden_reason", pa.string()),
+    ("removed_at", pa.timestamp("us")),
+    ("created_at", pa.timestamp("us")),
+    ("updated_at", pa.timestamp("us")),
+])
+
+DICTIONARY_COLUMNS = ["branch_id", "branch_name", "user_name"]
+
+PARTITIONING = ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive")
+
+# Колонки в порядке REVIEW_SCHEMA, последней — id для водяного знака
+EXPORT_COLUMNS = (
+    Review.review_id,
+    Branch.branch_id,
+    Branch.branch_name,
+    Review.user_name,
+    Review.rating,
+    Review.text,
+    Review.date_created,
+    Review.date_edited,
+    Review.is_verified,
+    Review.likes_count,
+    Review.comments_count,
+    Review.photos_count,
+    Review.photos_urls,
+    Review.hidden_reason,
+    Review.removed_at,
+    Review.created_at,
+    Review.updated_at,
+    Review.id,
+)
+
+
+def _watermark_path() -> str:
+    return os.path.join(EXPORT_DIR, WATERMARK_FILE)
+
+
+def load_watermark() -> Optional[Dict]:
+    """Водяной знак прошлой выгрузки (None — выгрузок еще не было)"""
+    try:
+        with open(_watermark_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _save_watermark(watermark: Dict):
+    # Через временный файл: прерванная запись не портит прошлый водяной знак
+    tmp_path = _watermark_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(watermark, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, _watermark_path())
+
+
+def _changed_reviews_query(watermark: Optional[Dict], until: datetime):
+    query = select(*EXPORT_COLUMNS).join(Branch, Review.branch_pk == Branch.id)
+
+    if watermark is None:
+        query = query.where(or_(Review.updated_at < until, Review.updated_at.is_(None)))
+    else:
+        last_updated = datetime.fromisoformat(watermark['updated_at'])
+        query = query.where(
+            Review.updated_at < until,
+            or_(
+                Review.updated_at > last_updated,
+                and_(Review.updated_at == last_updated, Review.id > watermark['id'])
+            )
+        )
+
+    # NULL первыми: водяной знак берется из последней строки
+    return query.order_by(Review.updated_at.asc().nullsfirst(), Review.id)
+
+
+def _month_key(value: Optional[datetime]) -> str:
+    return value.strftime("%Y-%m") if value else "unknown"
+
+
+def export_reviews(full: bool = False) -> int:
+    """
+    Дописать в набор данных отзывы, измененные после прошлой выгрузки
+
+    Args:
+        full: Удалить набор данных и выгрузить все отзывы заново
+
+    Returns:
+        Количество выгруженных строк
+    """
+    if full and os.path.exists(EXPORT_DIR):
+        shutil.rmtree(EXPORT_DIR)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+
+    watermark = load_watermark()
+    started = datetime.utcnow()
+    query = _changed_reviews_query(watermark, until=started - EXPORT_LAG)
+
+    file_suffix = started.strftime("%Y%m%dT%H%M%S")
+    writers: Dict[str, pq.ParquetWriter] = {}
+    exported = 0
+    last_row = None
+
+    try:
+        with database.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=CHUNK_SIZE).execute(query)
+            for rows in result.partitions():
+                by_month: Dict[str, List] = {}
+                for row in rows:
+                    by_month.setdefault(_month_key(row.date_created), []).append(row)
+
+                for month, month_rows in by_month.items():
+                    writer = writers.get(month)
+                    if writer is None:
+                        month_dir = os.path.join(EXPORT_DIR, f"month={month}")
+                        os.makedirs(month_dir, exist_ok=True)
+                        writer = pq.ParquetWriter(
+                            os.path.join(month_dir, f"part-{file_suffix}-0.parquet"),
+                            REVIEW_SCHEMA,
+                            compression="zstd",
+                            use_dictionary=DICTIONARY_COLUMNS,
+                        )
+                        writers[month] = writer
+                    # Колонки из кортежей строк; id (последняя колонка) в файл не пишется
+                    columns = list(zip(*month_rows))
+                    writer.write_table(pa.Table.from_arrays(
+                        [pa.array(values, type=field.type) for values, field in zip(columns, REVIEW_SCHEMA)],
+                        schema=REVIEW_SCHEMA
+                    ))
+
+                exported += len(rows)
+                last_row = rows[-1]
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    # Водяной знак двигается только после успешной записи всех файлов;
+    # повтор после сбоя даст дубли, которые отбрасывает read_reviews()
+    if last_row is not None and last_row.updated_at is not None:
+        _save_watermark({
+            'updated_at': last_row.updated_at.isoformat(),
+            'id': last_row.id,
+            'exported_at': started.isoformat(),
+            'rows': exported,
+        })
+
+    logger.info(f"✅ Выгружено отзывов: {exported} (месяцев затронуто: {len(writers)})")
+    return exported
+
+
+def _dataset(path: str = EXPORT_DIR) -> ds.Dataset:
+    return ds.dataset(
+        path,
+        format="parquet",
+        partitioning=PARTITIONING,
+        schema=REVIEW_SCHEMA.append(pa.field("month", pa.string())),
+        exclude_invalid_files=True,
+        ignore_prefixes=["_", "."],
+    )
+
+
+def read_reviews(
+    columns: Optional[List[str]] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    branch_ids: Optional[List[str]] = None,
+    deduplicate: bool = True,
+    path: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Прочитать отзывы из Parquet
+
+    Читаются только нужные колонки и только файлы месяцев из периода.
+
+    Args:
+        columns: Колонки (по умолчанию все)
+        date_from: Начало периода по date_created (включительно)
+        date_to: Конец периода по date_created (включительно)
+        branch_ids: ID филиалов 2GIS
+        deduplicate: Оставить последнюю версию каждого отзыва
+        path: Каталог набора данных (по умолчанию EXPORT_DIR)
+
+    Returns:
+        DataFrame с отзывами
+    """
+    path = path or EXPORT_DIR
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=columns or REVIEW_SCHEMA.names)
+
+    requested = list(columns or REVIEW_SCHEMA.names)
+    read_columns = list(requested)
+    if deduplicate:
+        read_columns += [name for name in ("review_id", "updated_at") if name not in read_columns]
+
+    conditions = []
+    if date_from:
+        conditions.append(ds.field("month") >= date_from.strftime("%Y-%m"))
+        conditions.append(ds.field("date_created") >= pa.scalar(date_from, type=pa.timestamp("us")))
+    if date_to:
+        conditions.append(ds.field("month") <= date_to.strftime("%Y-%m"))
+        conditions.append(ds.field("date_created") <= pa.scalar(date_to, type=pa.timestamp("us")))
+    if branch_ids:
+        conditions.append(ds.field("branch_id").isin(branch_ids))
+
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+
+    df = _dataset(path).to_table(columns=read_columns, filter=row_filter).to_pandas()
+
+    if deduplicate and not df.empty:
+        df = df.sort_values("updated_at", kind="stable").drop_duplicates("review_id", keep="last")
+        df = df.sort_index()[requested]
+
+    return df.reset_index(drop=True)
+
+
+def compact() -> int:
+    """
+    Переписать каждый месяц из нескольких файлов в один, без дублей
+
+    Returns:
+        Количество переписанных месяцев
+    """
+    if not os.path.isdir(EXPORT_DIR):
+        return 0
+
+    compacted = 0
+    for entry in sorted(os.listdir(EXPORT_DIR)):
+        month_dir = os.path.join(EXPORT_DIR, entry)
+        if not entry.startswith("month=") or not os.path.isdir(month_dir):
+            continue
+        files = [name for name in os.listdir(month_dir) if name.endswith(".parquet")]
+        if len(files) < 2:
+            continue
+
+        table = ds.dataset(month_dir, format="parquet", schema=REVIEW_SCHEMA).to_table()
+        df = table.to_pandas().sort_values("updated_at", kind="stable").drop_duplicates("review_id", keep="last")
+        merged = pa.Table.from_pandas(df.sort_values("date_created"), schema=REVIEW_SCHEMA, preserve_index=False)
+
+        tmp_path = os.path.join(month_dir, "_compacted.parquet.tmp")
+        pq.write_table(merged, tmp_path, compression="zstd", use_dictionary=DICTIONARY_COLUMNS)
+        for name in files:
+            os.remove(os.path.join(month_dir, name))
+        os.replace(tmp_path, os.path.join(month_dir, f"part-{datetime.utcnow():%Y%m%dT%H%M%S}-c.parquet"))
+
+        compacted += 1
+        logger.info(f"🗜 {entry}: {len(files)} файлов -> 1 ({merged.num_rows} отзывов)")
+
+    return compacted
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    arg_parser = argparse.ArgumentParser(description="Выгрузка отзывов в Parquet")
+    arg_parser.add_argument('--full', action='store_true', help="Выгрузить все отзывы заново")
+    arg_parser.add_argument('--compact', action='store_true', help="Склеить файлы каждого месяца в один")
+    args = arg_parser.parse_args()
+
+    database.use_profile('script')
+
+    try:
+        export_reviews(full=args.full)
+        if args.compact:
+            compact()
+    except Exception as e:
+        logger.error(f"❌ Ошибка выгрузки в Parquet: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
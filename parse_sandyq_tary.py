@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+"""
+Полная выгрузка отзывов всех точек в output/ (CSV, JSON, отчет).
+
+Запуск:
+    python parse_sandyq_tary.py            # новый обход
+    python parse_sandyq_tary.py --resume   # продолжить прерванный обход: собранные
+                                           # страницы не запрашиваются повторно
+"""
+
 import csv
 import json
 import os
 import sys
+import argparse
 from datetime import datetime
 import time
 from parser import TwoGISReviewsParser
+from crawl_checkpoint import CrawlCheckpoint
+from api_keys import PRIORITY_LOW
 
 # Импортируем универсальный загрузчик
 from branches_loader import load_branches_from_csv as load_branches_google
@@ -64,7 +76,7 @@ def save_summary_report(all_reviews, branches, failed_branches, timestamp):
     
     return report_filename
 
-def main():
+def main(resume=False):
     """Основная функция парсинга"""
     
     print("="*60)
@@ -88,12 +100,17 @@ def main():
     print(f"\n✅ Загружено {len(branches)} точек продаж")
     
     # Создаем парсер
-    parser = TwoGISReviewsParser()
+    # Полная выгрузка не должна съедать квоту ежедневного обхода и опроса
+    parser = TwoGISReviewsParser(priority=PRIORITY_LOW)
+    
+    # Контрольная точка: отзывы сохраняются постранично и переживают падение
+    checkpoint = CrawlCheckpoint('parse_sandyq_tary', resume=resume)
     
     # Переменные для сбора данных
     all_reviews = []
     failed_branches = []
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Продолженный запуск пишет файлы под своим исходным timestamp
+    timestamp = checkpoint.run_id
     
     # Создаем директорию для результатов
     os.makedirs('output', exist_ok=True)
@@ -102,11 +119,31 @@ def main():
     print("\n📊 Начинаем сбор отзывов...\n")
     
     for i, branch in enumerate(branches, 1):
+        branch_id = branch['id_2gis']
+        
+        if checkpoint.is_done(branch_id):
+            reviews = checkpoint.collected(branch_id)
+            all_reviews.extend(reviews)
+            print(f"[{i}/{len(branches)}] ⏭  {branch['name']}: уже собрано {len(reviews)} отзывов")
+            continue
+        
         print(f"[{i}/{len(branches)}] 🏪 {branch['name']}")
-        print(f"    ID: {branch['id_2gis']}")
+        print(f"    ID: {branch_id}")
+        
+        checkpoint.start_branch(branch_id)
+        start_offset = checkpoint.offset(branch_id)
+        if start_offset:
+            print(f"    ♻️  Продолжаем с offset {start_offset}")
         
         try:
-            reviews = parser.parse_all_reviews(branch['id_2gis'], branch['name'])
+            parser.parse_all_reviews(
+                branch_id, branch['name'],
+                start_offset=start_offset,
+                on_page=lambda offset, page: checkpoint.update_offset(branch_id, offset, page)
+            )
+            # Все страницы филиала, включая собранные до прерывания
+            reviews = checkpoint.collected(branch_id)
+            checkpoint.complete_branch(branch_id)
             
             if reviews:
                 all_reviews.extend(reviews)
@@ -123,9 +160,10 @@ def main():
                 
         except Exception as e:
             print(f"    ❌ Ошибка: {str(e)}")
+            checkpoint.fail_branch(branch_id, str(e))
             failed_branches.append({
                 'name': branch['name'],
-                'id': branch['id_2gis'],
+                'id': branch_id,
                 'error': str(e)
             })
         
@@ -189,7 +227,11 @@ def main():
     else:
         print("\n❌ Не удалось получить ни одного отзыва")
     
+    checkpoint.finish()
     print("\n✅ Парсинг завершен!")
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(description="Полная выгрузка отзывов 2GIS")
+    arg_parser.add_argument('--resume', action='store_true', help="Продолжить прерванный обход")
+    args = arg_parser.parse_args()
+    main(resume=args.resume)
@@ -5,18 +5,31 @@ import csv
 from datetime import datetime
 import os
 
+from api_keys import get_api_key_pool, ApiQuotaExhausted, THROTTLE_STATUSES, PRIORITY_NORMAL
+
 class TwoGISReviewsParser:
-    def __init__(self):
+    def __init__(self, priority=PRIORITY_NORMAL):
         self.base_url = "https://public-api.reviews.2gis.com/2.0/branches/{}/reviews"
-        self.api_key = os.getenv("PARSER_API_KEY")
-        if not self.api_key:
-            raise ValueError("PARSER_API_KEY не найден в переменных окружения")
+        # Ключи и квоты — общий пул (api_keys.py); priority ограничивает долю квоты
+        self.key_pool = get_api_key_pool()
+        if not len(self.key_pool):
+            raise ValueError("PARSER_API_KEY / PARSER_API_KEYS не найдены в переменных окружения")
+        self.api_key = self.key_pool.keys[0].value
+        self.priority = priority
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
+        # Вызывается перед каждым запросом (общий лимит, см. rate_limiter.py)
+        self.throttle = None
+        # Сколько запросов к API сделал этот экземпляр
+        self.requests_count = 0
+        # Последний parse_all_reviews прошел все страницы
+        self.last_walk_complete = False
+        # meta первой страницы последнего parse_all_reviews (официальный рейтинг филиала)
+        self.last_meta = None
         
-    def get_reviews(self, branch_id, limit=12, offset=0):
-        """Получение отзывов для конкретной точки"""
+    def get_reviews(self, branch_id, limit=12, offset=0, priority=None):
+        """Получение отзывов для конкретной точки (priority — доля квоты ключей, по умолчанию self.priority)"""
         url = self.base_url.format(branch_id)
         
         params = {
@@ -26,34 +39,72 @@ class TwoGISReviewsParser:
             'rated': 'true',
             'sort_by': 'date_edited',
             'locale': 'ru_KZ',
-            'key': self.api_key,
             'limit': limit,
             'offset': offset
         }
         
-        try:
-            response = requests.get(url, params=params, headers=self.headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Ошибка при получении отзывов для {branch_id}: {e}")
-            return None
+        # Ограниченный ключ выводится из пула, запрос повторяется с другим
+        for _ in range(len(self.key_pool)):
+            try:
+                params['key'] = self.key_pool.acquire(priority or self.priority)
+            except ApiQuotaExhausted as e:
+                print(f"Квота API исчерпана, отзывы {branch_id} не получены: {e}")
+                return None
+            
+            if self.throttle is not None:
+                self.throttle()
+            self.requests_count += 1
+            
+            try:
+                response = requests.get(url, params=params, headers=self.headers)
+                if response.status_code in THROTTLE_STATUSES:
+                    self.key_pool.mark_throttled(params['key'])
+                    continue
+                response.raise_for_status()
+                return response.json()
+            except requests.exceptions.RequestException as e:
+                print(f"Ошибка при получении отзывов для {branch_id}: {e}")
+                return None
+        
+        print(f"Все ключи API ограничены 2GIS, отзывы {branch_id} не получены")
+        return None
     
-    def parse_all_reviews(self, branch_id, branch_name):
-        """Парсинг всех отзывов для точки"""
+    def parse_all_reviews(self, branch_id, branch_name, start_offset=0, on_page=None, stop_when=None,
+                          priority=None):
+        """
+        Парсинг всех отзывов для точки
+
+        start_offset — продолжить с этой страницы (контрольная точка обхода);
+        on_page(next_offset, page_reviews) вызывается после каждой страницы;
+        stop_when(page_reviews) -> True прекращает обход после страницы. Отзывы
+        приходят от новых к старым (sort_by=date_edited), поэтому, например,
+        страница из одних известных отзывов означает, что дальше новых нет.
+        
+        После вызова last_walk_complete — True, если пройдены все страницы
+        (без ошибки запроса и без stop_when): только такой обход годится
+        для сверки удаленных отзывов. last_meta — meta первой страницы
+        (branch_rating, branch_reviews_count) или None, если запрос не удался.
+        priority — приоритет квоты для этого филиала (по умолчанию self.priority).
+        """
+        self.last_walk_complete = False
+        self.last_meta = None
         all_reviews = []
-        offset = 0
+        offset = start_offset
         limit = 50  # Увеличиваем лимит для более быстрого парсинга
         
         while True:
             print(f"Получение отзывов для {branch_name} (offset: {offset})")
-            data = self.get_reviews(branch_id, limit=limit, offset=offset)
+            data = self.get_reviews(branch_id, limit=limit, offset=offset, priority=priority)
             
             if not data:
                 break
+            
+            if self.last_meta is None:
+                self.last_meta = data.get('meta', {})
                 
             reviews = data.get('reviews', [])
             if not reviews:
+                self.last_walk_complete = True
                 break
                 
             for review in reviews:
@@ -81,13 +132,22 @@ class TwoGISReviewsParser:
                     'likes_count': review.get('likes_count', 0),
                     'comments_count': review.get('comments_count', 0),
                     'photos_count': len(photos),
-                    'photos_urls': photos_urls
+                    'photos_urls': photos_urls,
+                    # Причина скрытия модерацией 2GIS (None у видимых отзывов)
+                    'hiding_reason': review.get('hiding_reason')
                 }
                 all_reviews.append(parsed_review)
             
+            if on_page is not None:
+                on_page(offset + limit, all_reviews[-len(reviews):])
+            
+            if stop_when is not None and stop_when(all_reviews[-len(reviews):]):
+                break
+            
             # Проверяем, есть ли еще отзывы
             total_count = data.get('meta', {}).get('total_count', 0)
             if offset + limit >= total_count:
+                self.last_walk_complete = True
                 break
                 
             offset += limit
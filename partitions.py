@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Управление месячными партициями таблицы reviews.
+
+reviews секционирована по RANGE (date_created): одна партиция на месяц
+(reviews_yYYYYmMM) и партиция по умолчанию reviews_default для дат вне
+созданных диапазонов. Скрипт заранее создает партиции на будущие месяцы
+и отсоединяет старые (отсоединенная партиция остается обычной таблицей —
+ее можно выгрузить в архив и удалить вручную).
+
+Запуск (cron, раз в сутки):
+    python partitions.py                          # создать партиции на 3 месяца вперед
+    python partitions.py --months-ahead 6
+    python partitions.py --detach-older-than 36   # отсоединить партиции старше 36 месяцев
+    python partitions.py --list
+"""
+import os
+import re
+import sys
+import logging
+import argparse
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+
+import database
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = "reviews"
+DEFAULT_PARTITION = "reviews_default"
+PARTITION_NAME_RE = re.compile(r"^reviews_y(\d{4})m(\d{2})$")
+
+# Сколько месяцев вперед держать готовые партиции
+MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Сколько месяцев хранить в основной таблице (пусто — не отсоединять)
+RETENTION_MONTHS = os.getenv("PARTITION_RETENTION_MONTHS")
+
+
+def month_start(value) -> date:
+    """Первое число месяца для даты/времени"""
+    return date(value.year, value.month, 1)
+
+
+def add_months(value: date, months: int) -> date:
+    """Сдвиг первого числа месяца на months месяцев"""
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    """Имя партиции месяца: reviews_y2025m03"""
+    return f"reviews_y{month.year:04d}m{month.month:02d}"
+
+
+def partition_month(name: str) -> Optional[date]:
+    """Месяц партиции по ее имени (None для reviews_default и чужих таблиц)"""
+    match = PARTITION_NAME_RE.match(name)
+    if not match:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def is_partitioned(conn) -> bool:
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"
+    ), {'table': PARENT_TABLE}).scalar()
+
+
+def list_partitions(conn) -> List[Dict]:
+    """Партиции reviews с границами и примерным числом строк"""
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table) "
+        "ORDER BY c.relname"
+    ), {'table': PARENT_TABLE}).all()
+    return [
+        {'name': name, 'bound': bound, 'month': partition_month(name), 'rows_estimate': max(int(tuples), 0)}
+        for name, bound, tuples in rows
+    ]
+
+
+def insert_columns(conn) -> str:
+    """Колонки reviews без генерируемых (search_vector вычисляет Postgres)"""
+    columns = conn.execute(text(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND is_generated = 'NEVER' "
+        "ORDER BY ordinal_position"
+    ), {'table': PARENT_TABLE}).scalars().all()
+    return ", ".join(f'"{column}"' for column in columns)
+
+
+def create_index(conn, name: str, definition: str):
+    """
+    Создать индекс reviews без блокировки записи (conn — в режиме AUTOCOMMIT)
+
+    Секционированная таблица не поддерживает CREATE INDEX CONCURRENTLY на родителе:
+    индекс создается ON ONLY reviews (пустой и невалидный), индекс каждой партиции
+    строится CONCURRENTLY и присоединяется к нему. После последней партиции
+    родительский индекс становится валидным. Повторный запуск продолжает с места сбоя.
+
+    Args:
+        name: Имя индекса на reviews
+        definition: Все после "ON reviews", например "USING gin (text gin_trgm_ops)"
+    """
+    if not is_partitioned(conn):
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {PARENT_TABLE} {definition}"))
+        return
+
+    valid = conn.execute(text(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+    ), {'name': name}).scalar()
+    if valid:
+        return
+
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {PARENT_TABLE} {definition}"))
+    for partition in list_partitions(conn):
+        partition_index = f"{partition['name']}_{name}"
+        conn.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {partition['name']} {definition}"
+        ))
+        # Уже присоединенный индекс Postgres пропускает без ошибки
+        conn.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}"))
+        logger.info(f"Индекс {partition_index} построен и присоединен к {name}")
+
+
+def create_partition(conn, month: date) -> bool:
+    """
+    Создать партицию месяца, если ее нет.
+
+    Если в reviews_default уже лежат строки этого месяца (скрипт долго не
+    запускался), они переносятся в новую партицию в той же транзакции.
+
+    Returns:
+        True, если партиция создана
+    """
+    name = partition_name(month)
+    if conn.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar():
+        return False
+
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    stray_rows = conn.execute(text(
+        f"SELECT count(*) FROM {DEFAULT_PARTITION} WHERE date_created >= :start AND date_created < :end"
+    ), bounds).scalar()
+
+    start_literal = month.isoformat()
+    end_literal = bounds['end'].isoformat()
+    if not stray_rows:
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF {PARENT_TABLE} "
+            f"FOR VALUES FROM ('{start_literal}') TO ('{end_literal}')"
+        ))
+        return True
+
+    columns = insert_columns(conn)
+    conn.execute(text(
+        f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE)"
+    ))
+    conn.execute(text(
+        f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {DEFAULT_PARTITION} "
+        "WHERE date_created >= :start AND date_created < :end"
+    ), bounds)
+    conn.execute(text(
+        f"DELETE FROM {DEFAULT_PARTITION} WHERE date_created >= :start AND date_created < :end"
+    ), bounds)
+    conn.execute(text(
+        f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{start_literal}') TO ('{end_literal}')"
+    ))
+    logger.info(f"Из {DEFAULT_PARTITION} в {name} перенесено {stray_rows} отзывов")
+    return True
+
+
+def ensure_future_partitions(months_ahead: int = MONTHS_AHEAD) -> List[str]:
+    """
+    Создать партиции текущего месяца и months_ahead следующих
+
+    Returns:
+        Имена созданных партиций
+    """
+    created = []
+    current = month_start(datetime.utcnow())
+
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        # Каждая партиция в своей транзакции: ошибка одной не откатывает остальные
+        with database.engine.begin() as conn:
+            if not is_partitioned(conn):
+                logger.error(f"Таблица {PARENT_TABLE} не секционирована — сначала примените migrations.py")
+                return created
+            if create_partition(conn, month):
+                created.append(partition_name(month))
+                logger.info(f"✅ Создана партиция {partition_name(month)}")
+
+    return created
+
+
+def detach_old_partitions(keep_months: int, concurrently: bool = False) -> List[str]:
+    """
+    Отсоединить партиции, целиком старше keep_months месяцев
+
+    Args:
+        keep_months: Сколько месяцев (включая текущий) оставить в reviews
+        concurrently: DETACH ... CONCURRENTLY (Postgres 14+), не блокирует чтение и запись
+
+    Returns:
+        Имена отсоединенных партиций
+    """
+    cutoff = add_months(month_start(datetime.utcnow()), -(keep_months - 1))
+
+    with database.engine.connect() as conn:
+        old_partitions = [
+            partition['name'] for partition in list_partitions(conn)
+            if partition['month'] is not None and partition['month'] < cutoff
+        ]
+
+    detached = []
+    for name in old_partitions:
+        if concurrently:
+            # CONCURRENTLY нельзя выполнять внутри транзакции
+            with database.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name} CONCURRENTLY"))
+        else:
+            with database.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+        detached.append(name)
+        logger.info(f"📦 Партиция {name} отсоединена (осталась отдельной таблицей)")
+
+    return detached
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    arg_parser = argparse.ArgumentParser(description="Управление месячными партициями reviews")
+    arg_parser.add_argument('--list', action='store_true', help="Показать партиции и выйти")
+    arg_parser.add_argument('--months-ahead', type=int, default=MONTHS_AHEAD,
+                            help="Сколько будущих месяцев подготовить")
+    arg_parser.add_argument('--detach-older-than', type=int,
+                            default=int(RETENTION_MONTHS) if RETENTION_MONTHS else None,
+                            help="Отсоединить партиции старше N месяцев")
+    arg_parser.add_argument('--concurrently', action='store_true',
+                            help="Отсоединять без блокировки таблицы (Postgres 14+)")
+    args = arg_parser.parse_args()
+
+    database.use_profile('script')
+
+    if args.list:
+        with database.engine.connect() as conn:
+            for partition in list_partitions(conn):
+                print(f"{partition['name']:<20} ~{partition['rows_estimate']:>8} строк  {partition['bound']}")
+        return
+
+    try:
+        ensure_future_partitions(args.months_ahead)
+        if args.detach_older_than:
+            detach_old_partitions(args.detach_older_than, concurrently=args.concurrently)
+    except Exception as e:
+        logger.error(f"❌ Ошибка управления партициями: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
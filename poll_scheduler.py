@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Адаптивный опрос филиалов для почти мгновенных уведомлений.
+
+Вместо одного обхода всех филиалов в сутки демон опрашивает каждый
+филиал по его собственному расписанию (branch_poll_schedule.next_poll_at):
+
+    интервал = TARGET_NEW_PER_POLL / частота новых отзывов,
+    в пределах [POLL_MIN_INTERVAL_MINUTES, POLL_MAX_INTERVAL_HOURS].
+
+Частота оценивается по истории: отзывов за последние RATE_WINDOW_DAYS дней.
+Оживленный филиал (10 отзывов в день) опрашивается раз в ~2.5 часа, тихий —
+раз в сутки. Опрос останавливается на первой странице без новых отзывов,
+обычно это один запрос.
+
+Все запросы проходят через общий бюджет POLL_REQUESTS_PER_HOUR (token bucket
+в Redis) и общий лимит парсера; при нехватке бюджета первыми опрашиваются
+самые просроченные филиалы. Неудачный опрос повторяется с удвоением
+интервала (от POLL_MIN_INTERVAL_MINUTES до POLL_MAX_INTERVAL_HOURS). Квота ключей API делится по филиалам: оживленные
+(от POLL_HIGH_PRIORITY_RATE отзывов в сутки) опрашиваются с высоким приоритетом,
+тихие — с обычным. Ежедневный daily_parse остается полной сверкой.
+
+Запуск:
+    python poll_scheduler.py   # poll-scheduler.service
+"""
+import os
+import sys
+import time
+import random
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, func, text
+
+from database import Branch, Review, BranchPollSchedule, SessionLocal, use_profile
+from daily_parse import ingest_branch, enqueue_review_notifications
+from lease_lock import run_lock, branch_lock
+from parser import TwoGISReviewsParser
+from api_keys import PRIORITY_HIGH, PRIORITY_NORMAL
+from rate_limiter import TokenBucket, get_crawl_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+POLL_MIN_INTERVAL = timedelta(minutes=int(os.getenv("POLL_MIN_INTERVAL_MINUTES", "15")))
+POLL_MAX_INTERVAL = timedelta(hours=int(os.getenv("POLL_MAX_INTERVAL_HOURS", "24")))
+# Бюджет запросов к 2GIS на опрос, в час
+POLL_REQUESTS_PER_HOUR = int(os.getenv("POLL_REQUESTS_PER_HOUR", "600"))
+# Окно истории для оценки частоты отзывов
+RATE_WINDOW_DAYS = 90
+# Сколько новых отзывов в среднем ожидать за один опрос
+TARGET_NEW_PER_POLL = 1.0
+# Разброс интервала, чтобы опросы филиалов не собирались в одну минуту
+INTERVAL_JITTER = 0.1
+# Филиалов за одну выборку из расписания
+DUE_BATCH = 20
+# Пауза, когда опрашивать некого
+IDLE_SLEEP_SECONDS = 30
+# С какой частоты отзывов (в сутки) филиал опрашивается с высоким приоритетом квоты;
+# тихие филиалы при нехватке квоты уступают ее оживленным
+HIGH_PRIORITY_ARRIVAL_RATE = float(os.getenv("POLL_HIGH_PRIORITY_RATE", "1"))
+
+
+def estimate_arrival_rate(session, branch_pk: int) -> float:
+    """Новых отзывов филиала в сутки по последним RATE_WINDOW_DAYS дням"""
+    since = datetime.utcnow() - timedelta(days=RATE_WINDOW_DAYS)
+    count = session.execute(
+        select(func.count()).select_from(Review).where(
+            Review.branch_pk == branch_pk,
+            Review.date_created >= since
+        )
+    ).scalar() or 0
+    return count / RATE_WINDOW_DAYS
+
+
+def poll_interval(arrival_rate: float) -> timedelta:
+    """Интервал до следующего опроса для частоты отзывов (в сутки)"""
+    if arrival_rate <= 0:
+        interval = POLL_MAX_INTERVAL
+    else:
+        interval = timedelta(days=TARGET_NEW_PER_POLL / arrival_rate)
+        interval = min(max(interval, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+    return interval * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER)
+
+
+def ensure_schedule(session) -> int:
+    """Добавить в расписание филиалы без записи (первый опрос — в течение часа)"""
+    added = session.execute(text("""
+        INSERT INTO branch_poll_schedule (branch_pk, next_poll_at)
+        SELECT b.id, (now() at time zone 'utc') + random() * interval '1 hour'
+        FROM branches b
+        WHERE NOT EXISTS (SELECT 1 FROM branch_poll_schedule s WHERE s.branch_pk = b.id)
+    """)).rowcount
+    session.commit()
+    if added:
+        logger.info(f"📅 В расписание опроса добавлено филиалов: {added}")
+    return added
+
+
+def due_branches(session, limit: int = DUE_BATCH) -> List[Tuple[BranchPollSchedule, Branch]]:
+    """Филиалы, которым пора на опрос, от самых просроченных"""
+    return session.execute(
+        select(BranchPollSchedule, Branch)
+        .join(Branch, Branch.id == BranchPollSchedule.branch_pk)
+        .where(BranchPollSchedule.next_poll_at <= datetime.utcnow())
+        .order_by(BranchPollSchedule.next_poll_at)
+        .limit(limit)
+    ).all()
+
+
+def seconds_until_next_poll(session) -> float:
+    next_poll_at = session.execute(select(func.min(BranchPollSchedule.next_poll_at))).scalar()
+    if next_poll_at is None:
+        return IDLE_SLEEP_SECONDS
+    return min(max((next_poll_at - datetime.utcnow()).total_seconds(), 1), IDLE_SLEEP_SECONDS)
+
+
+def failure_backoff(schedule: BranchPollSchedule, now: datetime) -> timedelta:
+    """Интервал до повтора после неудачного опроса: удваивается с каждой неудачей подряд"""
+    if schedule.last_status not in (None, 'success') and schedule.last_polled_at is not None:
+        interval = (now - schedule.last_polled_at) * 2
+    else:
+        interval = POLL_MIN_INTERVAL
+    return min(max(interval, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+
+
+def record_poll_failure(session, schedule: BranchPollSchedule):
+    """Отложить опрос филиала, упавший с исключением"""
+    now = datetime.utcnow()
+    schedule.next_poll_at = now + failure_backoff(schedule, now)
+    schedule.last_polled_at = now
+    schedule.last_status = 'error'
+    session.commit()
+
+
+def branch_priority(arrival_rate: Optional[float]) -> str:
+    """Приоритет квоты ключей API для опроса филиала"""
+    if arrival_rate is not None and arrival_rate >= HIGH_PRIORITY_ARRIVAL_RATE:
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+
+def poll_branch(parser: TwoGISReviewsParser, session, schedule: BranchPollSchedule, branch: Branch) -> int:
+    """
+    Опросить филиал и назначить следующий опрос
+
+    Returns:
+        Количество новых отзывов
+    """
+    now = datetime.utcnow()
+    lock = branch_lock(branch.branch_id)
+    if not lock.acquire():
+        # Филиал обходит daily_parse или воркер — его данные и так обновятся
+        schedule.next_poll_at = now + POLL_MIN_INTERVAL
+        session.commit()
+        return 0
+
+    try:
+        result = ingest_branch(
+            parser,
+            {'name': branch.branch_name, 'id_2gis': branch.branch_id},
+            session,
+            stop_when_known=True,
+            lock=lock,
+            priority=branch_priority(schedule.arrival_rate)
+        )
+    finally:
+        lock.release()
+
+    arrival_rate = estimate_arrival_rate(session, branch.id)
+    if result['status'] == 'success':
+        schedule.next_poll_at = now + poll_interval(arrival_rate)
+    else:
+        schedule.next_poll_at = now + failure_backoff(schedule, now)
+    schedule.last_polled_at = now
+    schedule.last_status = result['status']
+    schedule.last_new_reviews = result.get('new_reviews', 0)
+    schedule.arrival_rate = arrival_rate
+    session.commit()
+
+    logger.info(
+        f"🔎 {branch.branch_name}: +{schedule.last_new_reviews}, "
+        f"{arrival_rate:.2f} отз./сут., следующий опрос {schedule.next_poll_at:%d.%m %H:%M} UTC"
+    )
+    return schedule.last_new_reviews
+
+
+def run_scheduler():
+    """Бесконечный цикл опроса"""
+    budget = TokenBucket(
+        'poll_budget',
+        rate=POLL_REQUESTS_PER_HOUR / 3600,
+        capacity=max(1, POLL_REQUESTS_PER_HOUR // 12)
+    )
+    crawl_limiter = get_crawl_rate_limiter()
+
+    def throttle():
+        budget.acquire()
+        crawl_limiter.acquire()
+
+    parser = TwoGISReviewsParser(priority=PRIORITY_HIGH)
+    parser.throttle = throttle
+
+    last_schedule_sync = None
+    while True:
+        session = SessionLocal()
+        try:
+            # Новые филиалы (sync_branches) попадают в расписание раз в час
+            if last_schedule_sync is None or time.monotonic() - last_schedule_sync > 3600:
+                ensure_schedule(session)
+                last_schedule_sync = time.monotonic()
+
+            due = due_branches(session)
+            if not due:
+                time.sleep(seconds_until_next_poll(session))
+                continue
+
+            new_reviews = 0
+            for schedule, branch in due:
+                try:
+                    new_reviews += poll_branch(parser, session, schedule, branch)
+                except Exception as e:
+                    # Без переноса next_poll_at филиал выбирался бы снова в каждом цикле
+                    logger.error(f"❌ Ошибка опроса {branch.branch_name}: {e}", exc_info=True)
+                    session.rollback()
+                    record_poll_failure(session, schedule)
+            # Кэш API не сбрасывается: ingest_branch уже сменил версию данных и ленту филиала
+            if new_reviews:
+                enqueue_review_notifications()
+        except Exception as e:
+            logger.error(f"❌ Ошибка цикла опроса: {e}", exc_info=True)
+            session.rollback()
+            time.sleep(IDLE_SLEEP_SECONDS)
+        finally:
+            session.close()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    use_profile('crawler')
+
+    lock = run_lock('poll_scheduler')
+    if not lock.acquire():
+        logger.error("Планировщик опроса уже запущен в другом процессе")
+        sys.exit(1)
+    try:
+        logger.info(
+            f"🚀 Планировщик опроса: интервал {POLL_MIN_INTERVAL}–{POLL_MAX_INTERVAL}, "
+            f"бюджет {POLL_REQUESTS_PER_HOUR} запросов/час"
+        )
+        run_scheduler()
+    finally:
+        lock.release()
+
+
+if __name__ == "__main__":
+    main()
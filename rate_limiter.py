@@ -0,0 +1,103 @@
+"""
+Общий для всех процессов лимит запросов к 2GIS (token bucket в Redis).
+
+Ведро пополняется со скоростью rate токенов в секунду до capacity; каждый
+HTTP-запрос парсера забирает один токен. Состояние и время берутся в самом
+Redis (TIME внутри Lua), поэтому лимит соблюдается суммарно по всем
+воркерам и хостам независимо от расхождения их часов.
+
+Без Redis лимит действует в пределах процесса: не чаще rate запросов в секунду.
+"""
+import os
+import time
+import logging
+import threading
+from typing import Optional
+
+from cache_manager import CacheManager, get_cache_manager
+
+logger = logging.getLogger(__name__)
+
+# Запросов к 2GIS в секунду на все процессы вместе и допустимый всплеск
+CRAWL_RATE_PER_SECOND = float(os.getenv("CRAWL_RATE_PER_SECOND", "2"))
+CRAWL_RATE_BURST = int(os.getenv("CRAWL_RATE_BURST", "5"))
+
+# KEYS: bucket; ARGV: rate, capacity. Возвращает, сколько мс ждать (0 — токен выдан)
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+
+class TokenBucket:
+    """Token bucket в Redis, общий для всех процессов"""
+
+    def __init__(self, name: str, rate: float, capacity: int, cache: Optional[CacheManager] = None):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.cache = cache or get_cache_manager()
+        self.key = self.cache._make_key('ratelimit', name)
+        self._script = None
+        # Локальный fallback без Redis
+        self._lock = threading.Lock()
+        self._next_local = 0.0
+
+    def _take(self) -> Optional[float]:
+        """Попытка взять токен: секунды ожидания (0 — взят) или None без Redis"""
+        if not self.cache.is_available():
+            return None
+        try:
+            if self._script is None:
+                self._script = self.cache.redis_client.register_script(_TAKE_SCRIPT)
+            return int(self._script(keys=[self.key], args=[self.rate, self.capacity])) / 1000
+        except Exception as e:
+            logger.error(f"Ошибка лимита запросов {self.name}: {str(e)}")
+            return None
+
+    def _acquire_local(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_local - now
+            self._next_local = max(now, self._next_local) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def acquire(self):
+        """Дождаться токена"""
+        while True:
+            wait = self._take()
+            if wait is None:
+                self._acquire_local()
+                return
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+
+_crawl_bucket: Optional[TokenBucket] = None
+
+
+def get_crawl_rate_limiter() -> TokenBucket:
+    """Общий лимит запросов парсера к 2GIS"""
+    global _crawl_bucket
+    if _crawl_bucket is None:
+        _crawl_bucket = TokenBucket('2gis', CRAWL_RATE_PER_SECOND, CRAWL_RATE_BURST)
+    return _crawl_bucket
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Фоновое обновление общего снимка списка филиалов.
+
+Единственный процесс, который читает Google Sheets: раз в
+BRANCHES_REFRESH_INTERVAL секунд перечитывает таблицу и, если хеш
+содержимого изменился, публикует новый снимок в Redis и в
+BRANCHES_SNAPSHOT_PATH. Остальные процессы подхватывают его в течение
+BRANCHES_SNAPSHOT_CHECK_SECONDS.
+
+Запуск:
+    python refresh_branches.py           # цикл (branches-refresher.service)
+    python refresh_branches.py --once    # одно обновление (cron, деплой)
+    python refresh_branches.py --force   # опубликовать снимок даже без изменений
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+from branches_loader import refresh_branches_snapshot
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = int(os.getenv("BRANCHES_REFRESH_INTERVAL", "300"))
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    arg_parser = argparse.ArgumentParser(description="Обновление снимка филиалов из Google Sheets")
+    arg_parser.add_argument('--once', action='store_true', help="Обновить один раз и выйти")
+    arg_parser.add_argument('--force', action='store_true', help="Опубликовать снимок даже без изменений")
+    arg_parser.add_argument('--interval', type=int, default=REFRESH_INTERVAL, help="Период обновления, секунд")
+    args = arg_parser.parse_args()
+
+    if args.once:
+        try:
+            refresh_branches_snapshot(force=args.force)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления снимка филиалов: {e}")
+            sys.exit(1)
+        return
+
+    logger.info(f"🔄 Обновление снимка филиалов каждые {args.interval} сек")
+    force = args.force
+    while True:
+        try:
+            refresh_branches_snapshot(force=force)
+            force = False
+        except Exception as e:
+            # Ошибка одного цикла не останавливает обновитель: читатели живут на прошлом снимке
+            logger.error(f"❌ Ошибка обновления снимка филиалов: {e}")
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
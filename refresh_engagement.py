@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Обновление лайков и комментариев недавних отзывов.
+
+likes_count и comments_count меняются в первые недели после публикации,
+а полный обход ради них слишком дорог. Задача проходит страницы каждого
+филиала только до отзывов старше ENGAGEMENT_WINDOW_DAYS (ранний останов
+parse_all_reviews, обычно одна-две страницы) и одним пакетным UPDATE
+обновляет только строки, у которых счетчики изменились.
+
+Запросы идут с низким приоритетом квоты ключей и через общий лимит парсера.
+
+Запуск:
+    python refresh_engagement.py             # окно ENGAGEMENT_WINDOW_DAYS
+    python refresh_engagement.py --days 7
+    # crontab: 0 14 * * * cd /root/projects/reviews-parser && venv/bin/python refresh_engagement.py
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, update
+
+from database import Branch, Review, SessionLocal, use_profile, record_branch_snapshot
+from parser import TwoGISReviewsParser
+from api_keys import PRIORITY_LOW
+from cache_manager import get_cache_manager
+from lease_lock import run_lock, branch_lock
+from rate_limiter import get_crawl_rate_limiter
+from review_changes import parse_review_date
+from review_timeline import get_review_timeline
+
+logger = logging.getLogger(__name__)
+
+ENGAGEMENT_WINDOW_DAYS = int(os.getenv("ENGAGEMENT_WINDOW_DAYS", "30"))
+
+
+def _activity_date(review_data: Dict) -> Optional[datetime]:
+    """Дата последней правки (или публикации) отзыва, naive UTC"""
+    value = parse_review_date(review_data.get('date_edited')) or parse_review_date(review_data.get('date_created'))
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _page_reaches_cutoff(page: List[Dict], cutoff: datetime) -> bool:
+    # Страницы идут по date_edited от новых к старым: дальше окна только старые отзывы
+    dates = [date for date in (_activity_date(review) for review in page) if date is not None]
+    return bool(dates) and min(dates) < cutoff
+
+
+def refresh_branch(parser: TwoGISReviewsParser, session, branch: Branch, cutoff: datetime) -> int:
+    """
+    Обновить счетчики отзывов филиала в окне
+
+    Returns:
+        Количество обновленных отзывов
+    """
+    reviews = parser.parse_all_reviews(
+        branch.branch_id,
+        branch.branch_name,
+        stop_when=lambda page: _page_reaches_cutoff(page, cutoff)
+    )
+    record_branch_snapshot(session, branch.id, parser.last_meta)
+    fresh = {
+        review['review_id']: (review.get('likes_count') or 0, review.get('comments_count') or 0)
+        for review in reviews
+        if review.get('review_id')
+    }
+    if not fresh:
+        session.commit()
+        return 0
+
+    stored = session.execute(
+        select(Review.id, Review.date_created, Review.review_id, Review.likes_count, Review.comments_count)
+        .where(Review.branch_pk == branch.id, Review.review_id.in_(list(fresh)))
+    ).all()
+
+    now = datetime.utcnow()
+    changed = []
+    for row in stored:
+        likes_count, comments_count = fresh[row.review_id]
+        if (row.likes_count or 0, row.comments_count or 0) != (likes_count, comments_count):
+            changed.append({
+                'id': row.id,
+                'date_created': row.date_created,
+                'likes_count': likes_count,
+                'comments_count': comments_count,
+                'updated_at': now,
+            })
+
+    if changed:
+        # Пакетный UPDATE по первичному ключу (id, date_created)
+        session.execute(update(Review), changed)
+    session.commit()
+
+    if changed:
+        # Лента перестроится из Postgres при следующем чтении
+        get_review_timeline().reset(branch.branch_id)
+        # Версия данных последней: вместе с ней сбрасывается кэш ответов филиала
+        get_cache_manager().bump_data_version(branch.branch_id)
+    return len(changed)
+
+
+def run_refresh(days: int):
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    parser = TwoGISReviewsParser(priority=PRIORITY_LOW)
+    parser.throttle = get_crawl_rate_limiter().acquire
+
+    session = SessionLocal()
+    try:
+        branches = session.execute(select(Branch).order_by(Branch.id)).scalars().all()
+        logger.info(f"🔄 Обновление лайков и комментариев за {days} дн. для {len(branches)} филиалов")
+
+        updated = 0
+        failed = 0
+        skipped = 0
+        for branch in branches:
+            lock = branch_lock(branch.branch_id)
+            if not lock.acquire():
+                skipped += 1
+                continue
+            try:
+                count = refresh_branch(parser, session, branch, cutoff)
+                updated += count
+                if count:
+                    logger.info(f"  👍 {branch.branch_name}: обновлено {count}")
+            except Exception as e:
+                logger.error(f"  ❌ {branch.branch_name}: {e}")
+                session.rollback()
+                failed += 1
+            finally:
+                lock.release()
+
+        logger.info(
+            f"✅ Обновлено отзывов: {updated}, запросов к API: {parser.requests_count}, "
+            f"ошибок: {failed}, пропущено: {skipped}"
+        )
+    finally:
+        session.close()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    arg_parser = argparse.ArgumentParser(description="Обновление лайков и комментариев недавних отзывов")
+    arg_parser.add_argument('--days', type=int, default=ENGAGEMENT_WINDOW_DAYS, help="Окно отзывов, дней")
+    args = arg_parser.parse_args()
+
+    use_profile('crawler')
+    lock = run_lock('refresh_engagement')
+    if not lock.acquire():
+        logger.warning("⏭  Обновление счетчиков уже выполняется в другом процессе, выходим")
+        return
+    try:
+        run_refresh(args.days)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления счетчиков: {e}", exc_info=True)
+        sys.exit(1)
+    finally:
+        lock.release()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Обнаружение изменений отзывов по хешу содержимого.
+
+Для каждого отзыва из 2GIS считается content_hash — md5 полей, которые
+меняют автор или модерация (текст, оценка, дата правки, фото, hiding_reason).
+Хеш хранится в reviews.content_hash. При обходе филиала из базы читаются
+только ID, ключ строки и хеш, а обновляются лишь строки с разошедшимся
+хешем: стоимость — O(измененных отзывов), а не перезапись филиала.
+
+Скрытые модерацией отзывы 2GIS отдает с hiding_reason (сохраняется в
+hidden_reason). Отзывы, которых нет в полном обходе филиала, отмечаются
+removed_at — разность множеств ID; вернувшийся отзыв отметку снимает.
+С REVIEW_EDIT_HISTORY=1 прежние значения измененных полей пишутся в review_edits.
+
+Лайки и комментарии в хеш не входят: они меняются постоянно и
+обновляются отдельно.
+"""
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from sqlalchemy import bindparam, select, update
+
+from database import Review, ReviewEdit
+
+logger = logging.getLogger(__name__)
+
+# Писать прежние значения измененных отзывов в review_edits
+EDIT_HISTORY_ENABLED = os.getenv("REVIEW_EDIT_HISTORY", "0") == "1"
+# Если из полного обхода пропала большая доля отзывов филиала, это скорее
+# сбой API, чем удаление: отметка removed_at пропускается
+MAX_REMOVED_SHARE = 0.5
+
+# Поля отзыва парсера, входящие в хеш, и колонки reviews, куда они пишутся
+CONTENT_FIELDS = ('user_name', 'rating', 'text', 'date_edited', 'is_verified', 'photos_urls', 'hiding_reason')
+CONTENT_COLUMNS = ('user_name', 'rating', 'text', 'date_edited', 'is_verified', 'photos_count',
+                   'photos_urls', 'hidden_reason')
+
+
+class ReviewState(NamedTuple):
+    """Сохраненное состояние отзыва, достаточное для сверки"""
+    id: int
+    date_created: datetime
+    content_hash: Optional[str]
+    removed_at: Optional[datetime]
+
+
+def parse_review_date(value: Optional[str]) -> Optional[datetime]:
+    """Дата из ответа 2GIS (ISO 8601 или 'YYYY-MM-DD HH:MM:SS')"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            logger.warning(f"Не удалось распарсить дату: {value}")
+            return None
+
+
+def review_content_hash(review_data: Dict) -> str:
+    """md5 содержимого отзыва (поля CONTENT_FIELDS в ответе парсера)"""
+    content = [review_data.get(field) for field in CONTENT_FIELDS]
+    return hashlib.md5(
+        json.dumps(content, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+def review_values(review_data: Dict) -> Dict:
+    """
+    Отзыв парсера -> значения колонок reviews (без branch_pk)
+
+    date_created — None, если дату не удалось разобрать: она входит в ключ
+    уникальности (review_id, date_created), и подставленное текущее время давало
+    бы новый ключ при каждой вставке. Такие отзывы вызывающий код пропускает.
+    """
+    rating = review_data.get('rating')
+    return {
+        'review_id': review_data.get('review_id') or review_data.get('id'),
+        'user_name': review_data.get('user_name') or 'Аноним',
+        'rating': float(rating) if rating is not None else None,
+        'text': review_data.get('text') or '',
+        'date_created': parse_review_date(review_data.get('date_created')),
+        'date_edited': parse_review_date(review_data.get('date_edited')),
+        'is_verified': bool(review_data.get('is_verified', False)),
+        'likes_count': review_data.get('likes_count') or 0,
+        'comments_count': review_data.get('comments_count') or 0,
+        'photos_count': review_data.get('photos_count') or 0,
+        'photos_urls': review_data.get('photos_urls') or [],
+        'hidden_reason': review_data.get('hiding_reason') or None,
+        'content_hash': review_content_hash(review_data),
+    }
+
+
+def load_review_states(session, branch_pk: int) -> Dict[str, ReviewState]:
+    """review_id -> состояние для всех отзывов филиала"""
+    rows = session.execute(
+        select(Review.review_id, Review.id, Review.date_created, Review.content_hash, Review.removed_at)
+        .where(Review.branch_pk == branch_pk)
+    ).all()
+    return {row.review_id: ReviewState(row.id, row.date_created, row.content_hash, row.removed_at) for row in rows}
+
+
+def is_unchanged(state: Optional[ReviewState], review_data: Dict) -> bool:
+    """
+    Отзыв уже есть в базе и не менялся.
+    Строки без хеша (до миграции 0010) считаются неизменными: хеш им проставит полный обход.
+    """
+    if state is None or state.removed_at is not None:
+        return False
+    return state.content_hash is None or state.content_hash == review_content_hash(review_data)
+
+
+def _record_edits(session, branch_pk: int, changed: List[Dict], now: datetime):
+    """Прежние значения изменившихся полей -> review_edits (один SELECT на пачку)"""
+    old_rows = session.execute(
+        select(Review.id, Review.review_id, *[getattr(Review, column) for column in CONTENT_COLUMNS])
+        .where(Review.id.in_([values['id'] for values in changed]))
+    ).all()
+    new_by_pk = {values['id']: values for values in changed}
+    for row in old_rows:
+        new_values = new_by_pk[row.id]
+        previous = {
+            column: getattr(row, column)
+            for column in CONTENT_COLUMNS
+            if getattr(row, column) != new_values[column]
+        }
+        session.add(ReviewEdit(
+            review_id=row.review_id,
+            branch_pk=branch_pk,
+            edited_at=now,
+            previous=json.loads(json.dumps(previous, ensure_ascii=False, default=str)),
+            content_hash=new_values['content_hash'],
+        ))
+
+
+def _write_hashes(session, rows: List[Dict]):
+    """
+    Проставить content_hash без изменения updated_at: заполнение хешей после миграции
+    не должно попадать в ленту изменений и инкрементальную выгрузку
+    """
+    table = Review.__table__
+    session.execute(
+        update(table)
+        .where(table.c.id == bindparam('b_id'), table.c.date_created == bindparam('b_date_created'))
+        # Явное значение отключает onupdate колонки updated_at
+        .values(content_hash=bindparam('b_content_hash'), updated_at=table.c.updated_at),
+        [
+            {'b_id': row['id'], 'b_date_created': row['date_created'], 'b_content_hash': row['content_hash']}
+            for row in rows
+        ]
+    )
+
+
+def update_changed_reviews(session, reviews: Iterable[Dict], states: Dict[str, ReviewState],
+                           branch_pk: int) -> List[Review]:
+    """
+    Обновить отзывы, у которых разошелся хеш содержимого (и вернувшиеся после удаления)
+
+    Returns:
+        Измененные отзывы — несвязанные с сессией объекты Review с новыми значениями
+        (для ленты Redis)
+    """
+    now = datetime.utcnow()
+    changed: List[Dict] = []
+    changed_ids: List[str] = []
+    hash_only: List[Dict] = []
+
+    for review_data in reviews:
+        state = states.get(review_data.get('review_id'))
+        if state is None:
+            continue
+        content_hash = review_content_hash(review_data)
+        if state.content_hash == content_hash and state.removed_at is None:
+            continue
+        if state.content_hash is None and state.removed_at is None and not review_data.get('hiding_reason'):
+            # Первая сверка после миграции: прежнее содержимое неизвестно, только запоминаем хеш.
+            # Скрытый отзыв обновляется целиком — отметка hidden_reason должна попасть в выгрузки
+            hash_only.append({'id': state.id, 'date_created': state.date_created, 'content_hash': content_hash})
+            continue
+        values = review_values(review_data)
+        params = {column: values[column] for column in CONTENT_COLUMNS}
+        # Счетчики из того же ответа: без них объект для ленты Redis отдавал бы 0 лайков
+        params.update(id=state.id, date_created=state.date_created, content_hash=values['content_hash'],
+                      likes_count=values['likes_count'], comments_count=values['comments_count'],
+                      removed_at=None, updated_at=now)
+        changed.append(params)
+        changed_ids.append(review_data['review_id'])
+
+    if hash_only:
+        _write_hashes(session, hash_only)
+    if not changed:
+        return []
+
+    if EDIT_HISTORY_ENABLED:
+        _record_edits(session, branch_pk, changed, now)
+    # Пакетный UPDATE по первичному ключу (id, date_created)
+    session.execute(update(Review), changed)
+
+    return [
+        Review(review_id=review_id, branch_pk=branch_pk,
+               **{key: value for key, value in params.items() if key not in ('id', 'updated_at', 'removed_at')})
+        for review_id, params in zip(changed_ids, changed)
+    ]
+
+
+def mark_removed_reviews(session, states: Dict[str, ReviewState], seen_ids: Iterable[str]) -> int:
+    """
+    Отметить removed_at отзывы филиала, которых нет в полном обходе
+
+    Вызывать только после обхода всех страниц: при раннем останове или
+    оборванном обходе разность множеств ложно «удалит» непрочитанные отзывы.
+
+    Returns:
+        Количество отмеченных отзывов
+    """
+    seen = set(seen_ids)
+    active = [state for state in states.values() if state.removed_at is None]
+    missing = [state for review_id, state in states.items() if review_id not in seen and state.removed_at is None]
+    if not missing:
+        return 0
+    if len(missing) > len(active) * MAX_REMOVED_SHARE:
+        logger.warning(
+            f"  ⚠️  В обходе нет {len(missing)} из {len(active)} отзывов филиала — "
+            f"похоже на сбой API, отметка удаленных пропущена"
+        )
+        return 0
+
+    now = datetime.utcnow()
+    session.execute(update(Review), [
+        {'id': state.id, 'date_created': state.date_created, 'removed_at': now, 'updated_at': now}
+        for state in missing
+    ])
+    return len(missing)
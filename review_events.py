@@ -0,0 +1,196 @@
+"""
+События о новых отзывах для SSE-потока API.
+
+Ingest после коммита публикует каждый новый отзыв дважды:
+    review_events:stream — ограниченный Redis Stream (XADD MAXLEN ~), ID записи
+                           служит ID события и позволяет догнать пропущенное
+                           по Last-Event-ID;
+    review_events        — pub/sub канал для мгновенной доставки.
+
+Процесс API держит одну подписку на канал (ReviewEventBroker) и раздает
+события подключенным клиентам через asyncio.Queue — на клиента не
+открывается отдельное соединение с Redis.
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set
+
+import redis.asyncio as aioredis
+
+from cache_manager import get_cache_manager
+from fast_json import dumps
+
+logger = logging.getLogger(__name__)
+
+EVENTS_CHANNEL = "review_events"
+EVENTS_STREAM = "review_events:stream"
+# Сколько последних событий хранится для переподключения по Last-Event-ID
+STREAM_MAXLEN = int(os.getenv("REVIEW_EVENTS_STREAM_MAXLEN", "10000"))
+# Очередь клиента; медленный клиент, переполнивший ее, отключается и догоняет через replay
+SUBSCRIBER_QUEUE_SIZE = 1000
+# Сколько ждать подтверждения SUBSCRIBE от Redis перед replay, секунд
+SUBSCRIBE_CONFIRM_TIMEOUT = 5
+
+
+def publish_new_reviews(branch_id: str, reviews: List[Dict]) -> int:
+    """
+    Опубликовать новые отзывы (dict по схеме ReviewResponse)
+
+    Returns:
+        Количество опубликованных событий (0, если Redis недоступен)
+    """
+    cache = get_cache_manager()
+    if not reviews or not cache.is_available():
+        return 0
+
+    try:
+        payloads = [dumps(review).decode("utf-8") for review in reviews]
+
+        pipe = cache.redis_client.pipeline()
+        for payload in payloads:
+            pipe.xadd(
+                EVENTS_STREAM,
+                {"branch_id": branch_id, "payload": payload},
+                maxlen=STREAM_MAXLEN,
+                approximate=True
+            )
+        event_ids = pipe.execute()
+
+        pipe = cache.redis_client.pipeline()
+        for event_id, payload in zip(event_ids, payloads):
+            pipe.publish(EVENTS_CHANNEL, json.dumps(
+                {"id": event_id, "branch_id": branch_id, "payload": payload},
+                ensure_ascii=False
+            ))
+        pipe.execute()
+        return len(payloads)
+    except Exception as e:
+        logger.error(f"Ошибка публикации событий отзывов {branch_id}: {str(e)}")
+        return 0
+
+
+def event_id_key(event_id: str):
+    """ID записи Redis Stream ('1700000000000-0') -> ключ для сравнения"""
+    ms, _, seq = event_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class Subscription:
+    """Подписка одного SSE-клиента"""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+
+class ReviewEventBroker:
+    """Одна подписка Redis на процесс API, раздача событий клиентам SSE"""
+
+    def __init__(self, redis_url: str):
+        self.redis_url = redis_url
+        self._redis: Optional[aioredis.Redis] = None
+        self._subscriptions: Set[Subscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        # Установлен, пока Redis подтвердил подписку на канал
+        self._subscribed = asyncio.Event()
+
+    def _client(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.from_url(self.redis_url, decode_responses=True)
+        return self._redis
+
+    async def subscribe(self) -> Subscription:
+        """
+        Подписать клиента; слушатель канала запускается при первой подписке.
+
+        Возвращается после подтверждения SUBSCRIBE от Redis: событие, опубликованное
+        между replay из Stream и подпиской на канал, иначе не попало бы ни туда, ни туда.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen())
+        subscription = Subscription()
+        self._subscriptions.add(subscription)
+        try:
+            await asyncio.wait_for(self._subscribed.wait(), timeout=SUBSCRIBE_CONFIRM_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Redis не подтвердил подписку на {EVENTS_CHANNEL} за {SUBSCRIBE_CONFIRM_TIMEOUT} сек")
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+
+    @property
+    def subscribers_count(self) -> int:
+        return len(self._subscriptions)
+
+    def _dispatch(self, event: Dict):
+        for subscription in list(self._subscriptions):
+            if subscription.overflowed:
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+
+    async def _listen(self):
+        """Чтение pub/sub канала с переподключением при ошибках Redis"""
+        delay = 1
+        while True:
+            try:
+                pubsub = self._client().pubsub()
+                await pubsub.subscribe(EVENTS_CHANNEL)
+                logger.info(f"Подписка на канал {EVENTS_CHANNEL} установлена")
+                delay = 1
+                try:
+                    async for message in pubsub.listen():
+                        if message.get("type") == "message":
+                            self._dispatch(json.loads(message["data"]))
+                        elif message.get("type") == "subscribe":
+                            self._subscribed.set()
+                finally:
+                    self._subscribed.clear()
+                    await pubsub.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка подписки на {EVENTS_CHANNEL}: {str(e)}, повтор через {delay} сек")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def replay(self, last_event_id: str) -> List[Dict]:
+        """События после last_event_id из Redis Stream (пусто, если Redis недоступен)"""
+        try:
+            entries = await self._client().xrange(EVENTS_STREAM, min=f"({last_event_id}", max="+")
+        except Exception as e:
+            logger.error(f"Ошибка чтения {EVENTS_STREAM} после {last_event_id}: {str(e)}")
+            return []
+        return [
+            {"id": entry_id, "branch_id": fields.get("branch_id"), "payload": fields.get("payload")}
+            for entry_id, fields in entries
+        ]
+
+    async def stop(self):
+        self._subscribed.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+_broker: Optional[ReviewEventBroker] = None
+
+
+def get_review_event_broker() -> ReviewEventBroker:
+    """Брокер событий процесса API"""
+    global _broker
+    if _broker is None:
+        _broker = ReviewEventBroker(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+    return _broker
@@ -0,0 +1,211 @@
+"""
+Лента последних отзывов филиала в Redis.
+
+Для каждого филиала хранятся:
+    timeline:{branch_id}          — sorted set review_id по date_created
+    timeline:{branch_id}:reviews  — hash review_id -> готовый JSON отзыва (схема ReviewResponse)
+    timeline:{branch_id}:ready    — лента содержит последние min(TIMELINE_CAP, всего) отзывов
+
+Ingest дописывает новые отзывы сразу после коммита (write-through), API
+читает последние N одним Lua-скриптом и отдает JSON без разбора.
+Пока флага ready нет (новый Redis, сброс), API читает Postgres и
+заполняет ленту сам. Все три ключа истекают одновременно через
+REVIEW_TIMELINE_TTL_SECONDS после заполнения, поэтому лента, которую
+какой-то путь записи забыл обновить, сама перестраивается из Postgres.
+Без Redis все работает через Postgres.
+"""
+import os
+import calendar
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from cache_manager import CacheManager, get_cache_manager
+from fast_json import dumps
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних отзывов держать на филиал (максимальный count в API)
+TIMELINE_CAP = 1000
+# Отзывов за один вызов скрипта записи (ограничение unpack в Lua)
+WRITE_BATCH = 500
+# Время жизни заполненной ленты, секунд
+TIMELINE_TTL = int(os.getenv("REVIEW_TIMELINE_TTL_SECONDS", str(24 * 3600)))
+
+# KEYS: zset, hash, ready; ARGV: count. nil — лента не заполнена
+_READ_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return false
+end
+local ids = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #ids == 0 then
+    return {}
+end
+return redis.call('HMGET', KEYS[2], unpack(ids))
+"""
+
+# KEYS: zset, hash; ARGV: cap, затем тройки score, review_id, payload
+_WRITE_SCRIPT = """
+for i = 2, #ARGV, 3 do
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('HSET', KEYS[2], ARGV[i + 1], ARGV[i + 2])
+end
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[1])
+if excess > 0 then
+    local old = redis.call('ZRANGE', KEYS[1], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    redis.call('HDEL', KEYS[2], unpack(old))
+end
+return redis.call('ZCARD', KEYS[1])
+"""
+
+
+def _score(value: Optional[datetime]) -> float:
+    """date_created (UTC без зоны) -> секунды эпохи"""
+    if value is None:
+        return 0.0
+    return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+
+
+def review_payload(review, branch_id: str, branch_name: str) -> Dict:
+    """Отзыв ORM (еще не закоммиченный) -> dict по схеме ReviewResponse"""
+    return {
+        "review_id": review.review_id,
+        "branch_id": branch_id,
+        "branch_name": branch_name,
+        "user_name": review.user_name,
+        "rating": float(review.rating) if review.rating is not None else None,
+        "text": review.text,
+        "date_created": review.date_created,
+        "date_edited": review.date_edited,
+        "is_verified": bool(review.is_verified),
+        "likes_count": review.likes_count or 0,
+        "comments_count": review.comments_count or 0,
+        "photos_count": review.photos_count or 0,
+        "photos_urls": review.photos_urls or [],
+    }
+
+
+class ReviewTimeline:
+    """Лента последних отзывов филиалов (sorted set + hash в Redis)"""
+
+    def __init__(self, cache: CacheManager):
+        self.cache = cache
+        self._read = None
+        self._write = None
+
+    def _keys(self, branch_id: str):
+        zset_key = self.cache._make_key('timeline', branch_id)
+        return zset_key, f"{zset_key}:reviews", f"{zset_key}:ready"
+
+    def is_available(self) -> bool:
+        return self.cache.is_available()
+
+    def _scripts(self):
+        if self._read is None:
+            self._read = self.cache.redis_client.register_script(_READ_SCRIPT)
+            self._write = self.cache.redis_client.register_script(_WRITE_SCRIPT)
+        return self._read, self._write
+
+    def latest(self, branch_id: str, count: int) -> Optional[List[str]]:
+        """
+        Последние count отзывов филиала (JSON-строки, от новых к старым)
+
+        Returns:
+            None, если лента не заполнена или Redis недоступен — читать Postgres
+        """
+        if count > TIMELINE_CAP or not self.is_available():
+            return None
+
+        try:
+            read, _ = self._scripts()
+            payloads = read(keys=list(self._keys(branch_id)), args=[count])
+            # Отзыв без тела — лента повреждена, пусть ее перестроит Postgres
+            if payloads is None or any(payload is None for payload in payloads):
+                return None
+            return payloads
+        except Exception as e:
+            logger.error(f"Ошибка чтения ленты отзывов {branch_id}: {str(e)}")
+            return None
+
+    def latest_many(self, branch_ids: List[str], count: int) -> Dict[str, List[str]]:
+        """
+        Последние count отзывов нескольких филиалов одним pipeline
+
+        Returns:
+            branch_id -> JSON-строки отзывов, только для заполненных лент
+        """
+        if not branch_ids or count > TIMELINE_CAP or not self.is_available():
+            return {}
+
+        try:
+            read, _ = self._scripts()
+            pipe = self.cache.redis_client.pipeline(transaction=False)
+            for branch_id in branch_ids:
+                read(keys=list(self._keys(branch_id)), args=[count], client=pipe)
+            results = pipe.execute()
+        except Exception as e:
+            logger.error(f"Ошибка чтения лент отзывов {len(branch_ids)} филиалов: {str(e)}")
+            return {}
+        return {
+            branch_id: payloads
+            for branch_id, payloads in zip(branch_ids, results)
+            if payloads is not None and all(payload is not None for payload in payloads)
+        }
+
+    def add(self, branch_id: str, reviews: List[Dict]) -> bool:
+        """Дописать отзывы (dict по схеме ReviewResponse) в ленту филиала"""
+        if not reviews or not self.is_available():
+            return False
+
+        try:
+            zset_key, hash_key, _ = self._keys(branch_id)
+            _, write = self._scripts()
+            for start in range(0, len(reviews), WRITE_BATCH):
+                args = [TIMELINE_CAP]
+                for review in reviews[start:start + WRITE_BATCH]:
+                    args += [_score(review["date_created"]), review["review_id"], dumps(review).decode("utf-8")]
+                write(keys=[zset_key, hash_key], args=args)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка записи ленты отзывов {branch_id}: {str(e)}")
+            return False
+
+    def rebuild(self, branch_id: str, latest_reviews: List[Dict]) -> bool:
+        """
+        Заполнить ленту последними TIMELINE_CAP отзывами из Postgres и отметить готовой.
+        Отзывы, которые ingest успел дописать раньше, не теряются: запись только добавляет.
+        Лента и флаг получают общий TTL (ZADD/HSET его не сбрасывают).
+        """
+        if not self.is_available():
+            return False
+        if latest_reviews and not self.add(branch_id, latest_reviews):
+            return False
+        try:
+            zset_key, hash_key, ready_key = self._keys(branch_id)
+            pipe = self.cache.redis_client.pipeline()
+            pipe.expire(zset_key, TIMELINE_TTL)
+            pipe.expire(hash_key, TIMELINE_TTL)
+            pipe.set(ready_key, 1, ex=TIMELINE_TTL)
+            pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка отметки ленты отзывов {branch_id}: {str(e)}")
+            return False
+
+    def reset(self, branch_id: Optional[str] = None) -> int:
+        """Удалить ленту филиала (или все ленты) — следующее чтение перестроит ее из Postgres"""
+        if branch_id is None:
+            return self.cache.delete_pattern(self.cache._make_key('timeline', '*'))
+        return sum(1 for key in self._keys(branch_id) if self.cache.delete(key))
+
+
+_review_timeline = None
+
+
+def get_review_timeline() -> ReviewTimeline:
+    """Глобальная лента отзывов поверх общего клиента Redis"""
+    global _review_timeline
+    if _review_timeline is None:
+        _review_timeline = ReviewTimeline(get_cache_manager())
+    return _review_timeline
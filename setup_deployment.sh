@@ -33,9 +33,11 @@ python migrate_to_db.py
 
 # 5. Setup systemd service
 echo "5. Setting up systemd service..."
-cp reviews-api.service /etc/systemd/system/
+cp reviews-api.service branches-refresher.service /etc/systemd/system/
 systemctl daemon-reload
-systemctl enable reviews-api.service
+python refresh_branches.py --once
+systemctl enable reviews-api.service branches-refresher.service
+systemctl start branches-refresher.service
 systemctl start reviews-api.service
 
 # 6. Get SSL certificate for subdomain
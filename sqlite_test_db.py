@@ -0,0 +1,56 @@
+"""
+Схема reviews в SQLite для тестов.
+
+Модели рассчитаны на Postgres: reviews секционирована и имеет составной
+первичный ключ (id, date_created), а search_vector — вычисляемая колонка
+tsvector. Здесь схема создается по копии метаданных, где id не помечен
+автоинкрементом (SQLite его не поддерживает для составного ключа), а id новых
+отзывов выдает слушатель before_insert. Общие метаданные моделей не меняются.
+"""
+import itertools
+
+from sqlalchemy import MetaData, create_engine, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.compiler import compiles
+
+from database import Base, Review
+
+
+@compiles(TSVECTOR, "sqlite")
+def _compile_tsvector_sqlite(type_, compiler, **kw):
+    # search_vector в SQLite — просто текст
+    return "TEXT"
+
+
+def create_sqlite_engine(test_case, tables=None):
+    """
+    SQLite в памяти со схемой моделей; слушатель id снимается в cleanup теста
+
+    Args:
+        test_case: unittest.TestCase (для addCleanup)
+        tables: Имена таблиц (по умолчанию все)
+    """
+    engine = create_engine("sqlite:///:memory:")
+
+    @event.listens_for(engine, "connect")
+    def _register_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function("to_tsvector", 2, lambda config, value: value, deterministic=True)
+
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        if tables is None or table.name in tables:
+            table.to_metadata(metadata)
+    if Review.__tablename__ in metadata.tables:
+        metadata.tables[Review.__tablename__].c.id.autoincrement = False
+    metadata.create_all(engine)
+
+    review_ids = itertools.count(1)
+
+    def _assign_review_id(mapper, connection, review):
+        if review.id is None:
+            review.id = next(review_ids)
+
+    event.listen(Review, "before_insert", _assign_review_id)
+    test_case.addCleanup(event.remove, Review, "before_insert", _assign_review_id)
+    test_case.addCleanup(engine.dispose)
+    return engine
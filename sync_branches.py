@@ -3,19 +3,30 @@
 """
 Скрипт для синхронизации филиалов из Google Sheets в базу данных.
 Автоматически добавляет новые филиалы и обновляет существующие.
+
+Список из таблицы сравнивается с базой по хешам строк: если хеш всего
+списка совпадает с последней синхронизацией, база не читается вовсе.
+Изменения применяются одним INSERT ... ON CONFLICT DO UPDATE, первичный
+парсинг новых филиалов идет параллельно в пуле потоков.
 """
 
 import os
 import sys
+import json
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from typing import Dict, List, Tuple
 from dotenv import load_dotenv
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 
-from database import Branch, Review
+from database import Branch, Review, SessionLocal, use_profile, ensure_branch, record_branch_snapshot
 from branches_loader import load_branches_from_csv
 from cache_manager import get_cache_manager
+from lease_lock import run_lock, branch_lock
+from review_changes import review_values
 import requests
 
 # Загрузка переменных окружения
@@ -31,24 +42,99 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Подключение к базе данных
-DATABASE_URL = os.getenv('DATABASE_URL')
-if not DATABASE_URL:
-    logger.error("DATABASE_URL не задан в переменных окружения")
-    sys.exit(1)
+# Хеш списка филиалов последней синхронизации; TTL — раз в сутки полная сверка с базой
+SYNCED_HASH_KEY = "branches:synced_hash"
+SYNCED_HASH_TTL = 24 * 3600
+# Параллельный первичный парсинг новых филиалов (каждый поток — своя сессия)
+BACKFILL_WORKERS = int(os.getenv("BRANCH_BACKFILL_WORKERS", "3"))
+
+# branch_id -> (branch_name, city, address)
+BranchRows = Dict[str, Tuple[str, str, str]]
+
+
+def desired_branches(branches_data: List[Dict]) -> BranchRows:
+    """Список филиалов из таблицы -> строки для branches (повтор ID — побеждает первый)"""
+    rows: BranchRows = {}
+    for branch_data in branches_data:
+        branch_id = branch_data.get('id_2gis')
+        branch_name = branch_data.get('name')
+        if not branch_id or not branch_name:
+            logger.warning(f"Пропущен филиал без ID или названия: {branch_data}")
+            continue
+        rows.setdefault(branch_id, (branch_name, branch_data.get('city', ''), branch_data.get('address', '')))
+    return rows
+
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def rows_hash(rows: BranchRows) -> str:
+    """Хеш набора строк филиалов (не зависит от порядка)"""
+    payload = json.dumps(sorted(rows.items()), ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
 
-def parse_new_branch_immediately(branch_id: str, branch_name: str, session):
-    """Немедленный парсинг отзывов для нового филиала"""
+def existing_branches(session) -> BranchRows:
+    """Строки branches из базы (кортежи, без ORM-объектов); NULL приводится к ''"""
+    result = session.execute(select(Branch.branch_id, Branch.branch_name, Branch.city, Branch.address))
+    return {
+        branch_id: (branch_name, city or '', address or '')
+        for branch_id, branch_name, city, address in result
+    }
+
+
+def upsert_branches(session, rows: BranchRows) -> int:
+    """Добавить и обновить филиалы одним INSERT ... ON CONFLICT DO UPDATE"""
+    if not rows:
+        return 0
+    now = datetime.utcnow()
+    stmt = insert(Branch).values([
+        {
+            'branch_id': branch_id,
+            'branch_name': branch_name,
+            'city': city,
+            'address': address,
+            'created_at': now,
+            'updated_at': now,
+        }
+        for branch_id, (branch_name, city, address) in rows.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Branch.branch_id],
+        set_={
+            'branch_name': stmt.excluded.branch_name,
+            'city': stmt.excluded.city,
+            'address': stmt.excluded.address,
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+    return session.execute(stmt).rowcount
+
+
+def parse_new_branch_immediately(branch_id: str, branch_name: str, session=None):
+    """Немедленный парсинг отзывов для нового филиала (без session — в собственной сессии)"""
+    # Филиал уже обходит другой процесс (daily_parse) — он и добавит отзывы
+    lock = branch_lock(branch_id)
+    if not lock.acquire():
+        logger.info(f"⏭  Новый филиал {branch_name} уже обходит другой процесс, пропускаем")
+        return 0
+    try:
+        return _parse_new_branch(branch_id, branch_name, session)
+    finally:
+        lock.release()
+
+
+def _parse_new_branch(branch_id: str, branch_name: str, session=None):
+    own_session = session is None
+    if own_session:
+        session = SessionLocal()
     try:
         from parser import TwoGISReviewsParser
+        from api_keys import PRIORITY_HIGH
+        from rate_limiter import get_crawl_rate_limiter
         
         logger.info(f"🚀 Запуск немедленного парсинга для нового филиала: {branch_name} (ID: {branch_id})")
         
-        parser = TwoGISReviewsParser()
+        parser = TwoGISReviewsParser(priority=PRIORITY_HIGH)
+        # Общий лимит запросов с daily_parse и воркерами crawl_queue
+        parser.throttle = get_crawl_rate_limiter().acquire
         reviews = parser.parse_all_reviews(branch_id, branch_name)
         
         if not reviews:
@@ -58,39 +144,18 @@ def parse_new_branch_immediately(branch_id: str, branch_name: str, session):
         logger.info(f"📥 Получено {len(reviews)} отзывов для нового филиала")
         
         # Добавляем отзывы в базу данных
+        branch_pk = ensure_branch(session, branch_id, branch_name)
+        record_branch_snapshot(session, branch_pk, parser.last_meta)
         new_count = 0
         for review_data in reviews:
-            review_id = review_data.get('id') or review_data.get('review_id')
-            
-            if not review_id:
+            if not (review_data.get('review_id') or review_data.get('id')):
                 continue
-                
-            # Преобразование даты
-            date_str = review_data.get('date_created', '')
-            date_created = None
-            if date_str:
-                try:
-                    date_created = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                except:
-                    try:
-                        date_created = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-                    except:
-                        pass
             
-            review = Review(
-                review_id=review_id,
-                branch_id=branch_id,
-                branch_name=branch_name,
-                user_name=review_data.get('user', {}).get('name', 'Аноним'),
-                rating=int(review_data.get('rating', 0)),
-                text=review_data.get('text', ''),
-                date_created=date_created,
-                is_verified=review_data.get('verified', False),
-                likes_count=review_data.get('likes_count', 0),
-                comments_count=review_data.get('comments_count', 0),
-                photos_count=review_data.get('photos_count', 0),
-                photos_urls=review_data.get('photos_urls', [])
-            )
+            values = review_values(review_data)
+            if values['date_created'] is None:
+                logger.warning(f"Пропущен отзыв {values['review_id']} без даты создания")
+                continue
+            review = Review(branch_pk=branch_pk, **values)
             
             session.add(review)
             new_count += 1
@@ -103,10 +168,49 @@ def parse_new_branch_immediately(branch_id: str, branch_name: str, session):
         logger.error(f"❌ Ошибка при парсинге нового филиала {branch_name}: {e}")
         session.rollback()
         return 0
+    finally:
+        if own_session:
+            session.close()
+
+
+def backfill_new_branches(new_branches: List[Tuple[str, str]]) -> int:
+    """
+    Первичный парсинг новых филиалов в пуле из BACKFILL_WORKERS потоков
+
+    Returns:
+        Всего добавлено отзывов
+    """
+    total_new_reviews = 0
+    with ThreadPoolExecutor(max_workers=max(1, BACKFILL_WORKERS), thread_name_prefix="branch-backfill") as executor:
+        futures = {
+            executor.submit(parse_new_branch_immediately, branch_id, branch_name): branch_id
+            for branch_id, branch_name in new_branches
+        }
+        for future in as_completed(futures):
+            branch_id = futures[future]
+            new_reviews_count = future.result()
+            total_new_reviews += new_reviews_count
+            if new_reviews_count > 0:
+                get_cache_manager().bump_data_version(branch_id)
+    return total_new_reviews
 
 
 def sync_branches_to_db():
-    """Синхронизация филиалов из Google Sheets в базу данных"""
+    """
+    Синхронизация филиалов из Google Sheets в базу данных.
+    Если синхронизация уже идет в другом процессе, повторно не выполняется.
+    """
+    lock = run_lock('sync_branches')
+    if not lock.acquire():
+        logger.info("⏭  Синхронизация филиалов уже выполняется в другом процессе")
+        return True
+    try:
+        return _sync_branches_to_db()
+    finally:
+        lock.release()
+
+
+def _sync_branches_to_db():
     session = SessionLocal()
     try:
         # Загрузка филиалов из Google Sheets
@@ -119,65 +223,49 @@ def sync_branches_to_db():
             
         logger.info(f"Загружено {len(branches_data)} филиалов из Google Sheets")
         
-        # Получаем все существующие филиалы из БД
-        existing_branches = {b.branch_id: b for b in session.query(Branch).all()}
-        logger.info(f"В базе данных найдено {len(existing_branches)} филиалов")
+        desired = desired_branches(branches_data)
+        desired_hash = rows_hash(desired)
+        cache = get_cache_manager()
+        if cache.get(SYNCED_HASH_KEY) == desired_hash:
+            logger.info(f"✅ Список филиалов не изменился ({desired_hash[:12]}), синхронизация не нужна")
+            return True
         
-        added_count = 0
-        updated_count = 0
-        new_branches = []  # Список новых филиалов для немедленного парсинга
+        # Построчная сверка с базой: в upsert попадают только новые и измененные филиалы
+        existing = existing_branches(session)
+        logger.info(f"В базе данных найдено {len(existing)} филиалов")
         
-        # Синхронизация каждого филиала
-        for branch_data in branches_data:
-            branch_id = branch_data.get('id_2gis')
-            branch_name = branch_data.get('name')
-            city = branch_data.get('city', '')
-            address = branch_data.get('address', '')
-            
-            if not branch_id or not branch_name:
-                logger.warning(f"Пропущен филиал без ID или названия: {branch_data}")
-                continue
-                
-            if branch_id in existing_branches:
-                # Обновление существующего филиала
-                branch = existing_branches[branch_id]
-                if (branch.branch_name != branch_name or 
-                    branch.city != city or 
-                    branch.address != address):
-                    branch.branch_name = branch_name
-                    branch.city = city
-                    branch.address = address
-                    branch.updated_at = datetime.utcnow()
-                    updated_count += 1
-                    logger.info(f"Обновлен филиал: {branch_name} (ID: {branch_id})")
-            else:
-                # Добавление нового филиала
-                new_branch = Branch(
-                    branch_id=branch_id,
-                    branch_name=branch_name,
-                    city=city,
-                    address=address
-                )
-                session.add(new_branch)
-                added_count += 1
-                new_branches.append((branch_id, branch_name))
-                logger.info(f"Добавлен новый филиал: {branch_name} (ID: {branch_id})")
+        changed = {
+            branch_id: row
+            for branch_id, row in desired.items()
+            if existing.get(branch_id) != row
+        }
+        new_branches = [(branch_id, row[0]) for branch_id, row in changed.items() if branch_id not in existing]
+        added_count = len(new_branches)
+        updated_count = len(changed) - added_count
+        
+        for branch_id, (branch_name, _, _) in changed.items():
+            action = "Обновлен филиал" if branch_id in existing else "Добавлен новый филиал"
+            logger.info(f"{action}: {branch_name} (ID: {branch_id})")
         
         # Сохранение изменений
+        upsert_branches(session, changed)
         session.commit()
+        cache.set(SYNCED_HASH_KEY, desired_hash, ttl=SYNCED_HASH_TTL)
         
         logger.info(f"\n✅ Синхронизация завершена:")
         logger.info(f"  - Добавлено новых филиалов: {added_count}")
         logger.info(f"  - Обновлено филиалов: {updated_count}")
-        logger.info(f"  - Всего филиалов в БД: {len(existing_branches) + added_count}")
+        logger.info(f"  - Всего филиалов в БД: {len(existing) + added_count}")
         
         # Немедленный парсинг новых филиалов
         total_new_reviews = 0
         if new_branches:
             logger.info(f"\n🚀 Запуск немедленного парсинга для {len(new_branches)} новых филиалов...")
-            for branch_id, branch_name in new_branches:
-                new_reviews_count = parse_new_branch_immediately(branch_id, branch_name, session)
-                total_new_reviews += new_reviews_count
+            total_new_reviews = backfill_new_branches(new_branches)
+        
+        # Изменился список филиалов — новая общая версия данных для ETag
+        if added_count > 0 or updated_count > 0:
+            get_cache_manager().bump_data_version()
         
         # Очистка кэша если были изменения или новые отзывы
         if added_count > 0 or updated_count > 0 or total_new_reviews > 0:
@@ -223,5 +311,6 @@ def sync_branches_to_db():
 
 
 if __name__ == "__main__":
+    use_profile('crawler')
     success = sync_branches_to_db()
     sys.exit(0 if success else 1)
\ No newline at end of file
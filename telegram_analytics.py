@@ -16,7 +16,7 @@ import tempfile
 
 from sqlalchemy.orm import Session
 from sqlalchemy import func, and_, desc
-from database import Review, Branch
+from database import Review, Branch, branch_pk_for
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -36,7 +36,7 @@ class TelegramAnalytics:
         """Получить отзывы за период"""
         return self.db.query(Review).filter(
             and_(
-                Review.branch_id == branch_id,
+                Review.branch_pk == branch_pk_for(branch_id),
                 Review.date_created >= date_from,
                 Review.date_created <= date_to
             )
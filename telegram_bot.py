@@ -22,7 +22,7 @@ from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, desc
 from dotenv import load_dotenv
 
-from database import SessionLocal, TelegramUser, TelegramSubscription, TelegramUserState, Review, Branch
+from database import SessionLocal, use_profile, branch_pk_for, TelegramUser, TelegramSubscription, TelegramUserState, Review, Branch
 from telegram_calendar import create_calendar, process_calendar_selection
 from telegram_analytics import generate_analytics_report
 
@@ -1125,7 +1125,7 @@ async def show_reviews_for_period(update_or_query, context: ContextTypes.DEFAULT
         # Получить отзывы за период
         reviews = db.query(Review).filter(
             and_(
-                Review.branch_id == branch_id,
+                Review.branch_pk == branch_pk_for(branch_id),
                 Review.date_created >= datetime.combine(date_from, datetime.min.time()),
                 Review.date_created <= datetime.combine(date_to, datetime.max.time())
             )
@@ -1346,6 +1346,9 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN не найден в переменных окружения")
         return
     
+    # Пул БД с настройками профиля бота
+    use_profile('bot')
+    
     # Создать приложение
     application = Application.builder().token(BOT_TOKEN).build()
     
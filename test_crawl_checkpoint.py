@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Тесты контрольных точек обхода (crawl_checkpoint.CrawlCheckpoint)
+"""
+import os
+import tempfile
+import unittest
+
+from crawl_checkpoint import BRANCH_DONE, BRANCH_FAILED, CrawlCheckpoint
+
+
+class CrawlCheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+
+    def _checkpoint(self, resume: bool = False) -> CrawlCheckpoint:
+        return CrawlCheckpoint('daily_parse', resume=resume, directory=self.directory)
+
+    def test_resume_continues_interrupted_run(self):
+        """После падения --resume пропускает готовые филиалы и продолжает с offset"""
+        checkpoint = self._checkpoint()
+        checkpoint.start_branch('b1')
+        checkpoint.complete_branch('b1', {'branch_id': 'b1', 'new_reviews': 3})
+        checkpoint.start_branch('b2')
+        checkpoint.update_offset('b2', 100)
+
+        resumed = self._checkpoint(resume=True)
+
+        self.assertTrue(resumed.resumed)
+        self.assertEqual(resumed.run_id, checkpoint.run_id)
+        self.assertTrue(resumed.is_done('b1'))
+        self.assertFalse(resumed.is_done('b2'))
+        self.assertEqual(resumed.offset('b2'), 100)
+        self.assertEqual(resumed.offset('b3'), 0)
+        self.assertEqual(resumed.results(), [{'branch_id': 'b1', 'new_reviews': 3}])
+
+    def test_failed_branch_is_retried(self):
+        """Неудачный филиал не считается завершенным"""
+        checkpoint = self._checkpoint()
+        checkpoint.start_branch('b1')
+        checkpoint.fail_branch('b1', 'timeout')
+
+        resumed = self._checkpoint(resume=True)
+        self.assertFalse(resumed.is_done('b1'))
+        self.assertEqual(resumed.branch('b1')['status'], BRANCH_FAILED)
+
+    def test_finished_run_starts_fresh(self):
+        """Завершенный запуск не продолжается; без --resume прошлое состояние отбрасывается"""
+        checkpoint = self._checkpoint()
+        checkpoint.complete_branch('b1')
+        checkpoint.finish()
+        self.assertFalse(self._checkpoint(resume=True).resumed)
+
+        checkpoint = self._checkpoint()
+        checkpoint.complete_branch('b1')
+        fresh = self._checkpoint()
+        self.assertFalse(fresh.resumed)
+        self.assertEqual(fresh.branch('b1'), {})
+
+    def test_collected_pages(self):
+        """Отзывы страниц дописываются на диск и читаются без дублей"""
+        checkpoint = self._checkpoint()
+        checkpoint.update_offset('b1', 50, [{'review_id': 'r1', 'text': 'а'}, {'review_id': 'r2'}])
+        # Страница повторилась после падения между записью данных и offset
+        checkpoint.update_offset('b1', 50, [{'review_id': 'r2'}])
+        checkpoint.update_offset('b1', 100, [{'review_id': 'r3'}])
+
+        collected = self._checkpoint(resume=True).collected('b1')
+        self.assertEqual(sorted(review['review_id'] for review in collected), ['r1', 'r2', 'r3'])
+
+        checkpoint.finish()
+        self.assertEqual(checkpoint.collected('b1'), [])
+        self.assertEqual(checkpoint.branch('b1')['offset'], 100)
+
+    def test_corrupted_checkpoint(self):
+        """Поврежденный файл — новый запуск вместо ошибки"""
+        with open(os.path.join(self.directory, 'daily_parse.json'), 'w', encoding='utf-8') as f:
+            f.write('{"job": "daily_parse", "bran')
+        with self.assertLogs('crawl_checkpoint', level='ERROR'):
+            checkpoint = self._checkpoint(resume=True)
+        self.assertFalse(checkpoint.resumed)
+        checkpoint.complete_branch('b1')
+        self.assertEqual(self._checkpoint(resume=True).branch('b1')['status'], BRANCH_DONE)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
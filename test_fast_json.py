@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Тесты быстрой JSON-сериализации ответов API (fast_json.py)
+"""
+import json
+import unittest
+from datetime import date, datetime
+from decimal import Decimal
+from unittest.mock import patch
+
+import fast_json
+from fast_json import FastJSONResponse, dumps, loads
+
+CONTENT = {
+    'review_id': '1',
+    'text': 'Очень вкусно',
+    'rating': Decimal('4.50'),
+    'date_created': datetime(2025, 7, 10, 10, 0, 0, 123456),
+    'day': date(2025, 7, 10),
+    'photos_urls': [],
+    'by_rating': {5: 10},
+}
+EXPECTED = {
+    'review_id': '1',
+    'text': 'Очень вкусно',
+    'rating': 4.5,
+    'date_created': '2025-07-10T10:00:00.123456',
+    'day': '2025-07-10',
+    'photos_urls': [],
+    'by_rating': {'5': 10},
+}
+
+
+class FastJsonTestCase(unittest.TestCase):
+    def test_dumps(self):
+        """datetime в ISO 8601 (как у Pydantic), Decimal — число, ключи-числа — строки"""
+        self.assertEqual(json.loads(dumps(CONTENT)), EXPECTED)
+        self.assertIn('Очень вкусно'.encode('utf-8'), dumps(CONTENT))
+
+    def test_stdlib_fallback_matches(self):
+        """Без orjson формат ответа тот же"""
+        with patch.object(fast_json, 'orjson', None):
+            encoded = dumps(CONTENT)
+            self.assertEqual(loads(encoded), EXPECTED)
+        self.assertEqual(json.loads(encoded), json.loads(dumps(CONTENT)))
+
+    def test_unsupported_type(self):
+        """Неизвестный тип — ошибка, а не молчаливая строка"""
+        with self.assertRaises(TypeError):
+            dumps({'value': object()})
+        with patch.object(fast_json, 'orjson', None), self.assertRaises(TypeError):
+            dumps({'value': object()})
+
+    def test_response(self):
+        """FastJSONResponse отдает тот же JSON с типом application/json"""
+        response = FastJSONResponse(CONTENT)
+        self.assertEqual(response.media_type, 'application/json')
+        self.assertEqual(loads(response.body), EXPECTED)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -8,13 +8,13 @@ import tempfile
 import os
 from datetime import datetime, timedelta
 from unittest.mock import Mock, patch, MagicMock
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 # Импорт тестируемых модулей
 from parser import TwoGISReviewsParser
 from database import Base, Review, Branch, ParseReport
 from daily_parse import get_existing_review_ids, save_new_reviews_to_db
+from sqlite_test_db import create_sqlite_engine
 
 
 class TestParser(unittest.TestCase):
@@ -167,10 +167,13 @@ class TestDatabase(unittest.TestCase):
     
     def setUp(self):
         # Создаем тестовую БД в памяти
-        self.engine = create_engine('sqlite:///:memory:')
-        Base.metadata.create_all(self.engine)
+        self.engine = create_sqlite_engine(self)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        branch = Branch(branch_id='test_branch', branch_name='Тестовый филиал')
+        self.session.add(branch)
+        self.session.commit()
+        self.branch_pk = branch.id
         
     def tearDown(self):
         self.session.close()
@@ -180,8 +183,7 @@ class TestDatabase(unittest.TestCase):
         # Добавляем первый отзыв
         review1 = Review(
             review_id='duplicate_test',
-            branch_id='test_branch',
-            branch_name='Тестовый филиал',
+            branch_pk=self.branch_pk,
             user_name='Пользователь',
             rating=5,
             text='Отличный магазин!',
@@ -191,7 +193,7 @@ class TestDatabase(unittest.TestCase):
         self.session.commit()
         
         # Получаем существующие ID
-        existing_ids = get_existing_review_ids(self.session, 'test_branch')
+        existing_ids = get_existing_review_ids(self.session, self.branch_pk)
         self.assertIn('duplicate_test', existing_ids)
         
         # Пытаемся добавить дубликат
@@ -207,14 +209,13 @@ class TestDatabase(unittest.TestCase):
         count = save_new_reviews_to_db(
             self.session, 
             new_reviews, 
-            'test_branch', 
-            'Тестовый филиал',
+            self.branch_pk,
             existing_ids
         )
         
         # Проверяем, что дубликат не добавлен
         self.assertEqual(count, 0)
-        total_reviews = self.session.query(Review).filter_by(branch_id='test_branch').count()
+        total_reviews = self.session.query(Review).filter_by(branch_pk=self.branch_pk).count()
         self.assertEqual(total_reviews, 1)
         
     def test_new_review_detection(self):
@@ -223,8 +224,7 @@ class TestDatabase(unittest.TestCase):
         for i in range(3):
             review = Review(
                 review_id=f'old_review_{i}',
-                branch_id='test_branch',
-                branch_name='Тестовый филиал',
+                branch_pk=self.branch_pk,
                 user_name=f'Пользователь {i}',
                 rating=4,
                 text=f'Отзыв {i}',
@@ -233,7 +233,7 @@ class TestDatabase(unittest.TestCase):
             self.session.add(review)
         self.session.commit()
         
-        existing_ids = get_existing_review_ids(self.session, 'test_branch')
+        existing_ids = get_existing_review_ids(self.session, self.branch_pk)
         self.assertEqual(len(existing_ids), 3)
         
         # Добавляем новые отзывы
@@ -250,13 +250,12 @@ class TestDatabase(unittest.TestCase):
         count = save_new_reviews_to_db(
             self.session,
             new_reviews,
-            'test_branch',
-            'Тестовый филиал', 
+            self.branch_pk,
             existing_ids
         )
         
         self.assertEqual(count, 1)
-        total_reviews = self.session.query(Review).filter_by(branch_id='test_branch').count()
+        total_reviews = self.session.query(Review).filter_by(branch_pk=self.branch_pk).count()
         self.assertEqual(total_reviews, 4)
 
 